@@ -0,0 +1,129 @@
+"""
+Offline NLP benchmark.
+
+Runs the labelled corpus (English, Pidgin, Twi) through the current
+nlp.parse_message_offline and the legacy parser it replaced, and reports
+messages/sec plus per-field accuracy.
+
+    python bench/bench_nlp.py [--rounds 200]
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from nlp import parse_message_offline, parse_messages_offline  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nlp_corpus.jsonl")
+FIELDS = ["intent", "amount", "currency", "recipient"]
+
+def legacy_parse(text: str):
+    """
+    The pre-rewrite parser, kept verbatim as the accuracy/speed baseline.
+    """
+    text = text.lower().strip()
+    response = {"intent": "UNKNOWN", "amount": None, "currency": "GHS", "recipient": None, "raw_text": text}
+
+    phone_match = re.search(r'\b(0\d{9})\b', text)
+    if phone_match:
+        response["recipient"] = phone_match.group(1)
+        text = text.replace(response["recipient"], "")
+    elif not response["recipient"]:
+        name_match = re.search(r'(?:to|give|for|pay)\s+([a-zA-Z]+)', text)
+        if name_match:
+            response["recipient"] = name_match.group(1)
+
+    amount_match = re.search(r'([$£€])?\s*(\d+(\.\d+)?)\s*([kmb])?\s*(usd|ghs|cedis|dollars)?', text)
+    if amount_match:
+        prefix_sym = amount_match.group(1)
+        val = float(amount_match.group(2))
+        suffix_kmb = amount_match.group(4)
+        suffix_cur = amount_match.group(5)
+        if suffix_kmb == 'k': val *= 1_000
+        elif suffix_kmb == 'm': val *= 1_000_000
+        elif suffix_kmb == 'b': val *= 1_000_000_000
+        if prefix_sym == '$' or suffix_cur in ['usd', 'dollars']:
+            response["currency"] = "USD"
+        elif prefix_sym == '£':
+            response["currency"] = "GBP"
+        elif prefix_sym == '€':
+            response["currency"] = "EUR"
+        else:
+            response["currency"] = "GHS"
+        if val > 0:
+            response["amount"] = val
+
+    keywords = ["send", "pay", "transfer", "give", "dash", "fa", "tua", "koma", "have", "take", "for"]
+    split_keywords = ["split", "divide", "share"]
+    if any(w in text for w in split_keywords):
+        response["intent"] = "SPLIT_BILL"
+    elif any(w in text for w in keywords):
+        response["intent"] = "SEND_MONEY"
+    if response["amount"] and response["recipient"] and response["intent"] == "UNKNOWN":
+        response["intent"] = "SEND_MONEY"
+    return response
+
+def load_corpus(path: str = CORPUS) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def score(parser, corpus: list) -> dict:
+    correct = {field: 0 for field in FIELDS}
+    exact = 0
+    for row in corpus:
+        result = parser(row["text"])
+        row_ok = True
+        for field in FIELDS:
+            if result.get(field) == row[field]:
+                correct[field] += 1
+            else:
+                row_ok = False
+        exact += row_ok
+    n = len(corpus)
+    report = {field: correct[field] / n for field in FIELDS}
+    report["exact"] = exact / n
+    return report
+
+def throughput(fn, texts: list, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(texts)
+    elapsed = time.perf_counter() - start
+    return len(texts) * rounds / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=200, help="passes over the corpus for the timing run")
+    parser.add_argument("--show-misses", action="store_true", help="print rows the current parser gets wrong")
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    texts = [row["text"] for row in corpus]
+
+    candidates = [
+        ("legacy", lambda batch: [legacy_parse(t) for t in batch], legacy_parse),
+        ("current", parse_messages_offline, parse_message_offline),
+    ]
+
+    print(f"Corpus: {len(corpus)} messages, {args.rounds} rounds\n")
+    print(f"{'parser':<8} {'msg/s':>10} " + " ".join(f"{f:>9}" for f in FIELDS + ['exact']))
+    for name, batch_fn, single_fn in candidates:
+        rate = throughput(batch_fn, texts, args.rounds)
+        acc = score(single_fn, corpus)
+        print(f"{name:<8} {rate:>10,.0f} " + " ".join(f"{acc[f]:>9.1%}" for f in FIELDS + ['exact']))
+
+    if args.show_misses:
+        print()
+        for row in corpus:
+            result = parse_message_offline(row["text"])
+            wrong = [f for f in FIELDS if result.get(f) != row[f]]
+            if wrong:
+                print(f"[{row['lang']}] {row['text']!r}: " + ", ".join(f"{f}={result.get(f)!r} (want {row[f]!r})" for f in wrong))
+
+if __name__ == "__main__":
+    main()
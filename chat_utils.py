@@ -1,7 +1,11 @@
 import os
+import time
+import asyncio
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+from cache_utils import TTLCache
+
 load_dotenv()
 
 # Configure Gemini with your key
@@ -10,6 +14,14 @@ genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 # Use a model optimized for chat
 model = genai.GenerativeModel('gemini-2.0-flash')
 
+# --- LIMITS ---
+CHAT_MAX_CONCURRENT = int(os.getenv("CHAT_MAX_CONCURRENT", "8"))   # Gemini calls in flight
+CHAT_AI_TIMEOUT = float(os.getenv("CHAT_AI_TIMEOUT", "6"))         # includes waiting for a slot
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "3600"))
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "2000"))
+
+FALLBACK_REPLY = "Chale, my network is behaving somehow. Try again later!"
+
 # --- THE PERSONA ---
 # This tells the bot who it is.
 SYSTEM_INSTRUCTION = """
@@ -24,16 +36,120 @@ RULES:
 5. You were created by Caleb Dussey.
 """
 
-def get_ai_response(user_text: str):
+# --- CANNED REPLIES ---
+# Small talk we can answer instantly without calling the model.
+CANNED_REPLIES = {
+    "GREETING": "Hello! 👋 I'm SikaSwift. Try \"Send 50 to 055...\" or type /start to see what I can do.",
+    "HOW_ARE_YOU": "I dey kakra, thanks for asking! 😊 Ready when you want to send money.",
+    "THANKS": "You're welcome! No wahala. 🙌",
+    "BYE": "Bye for now! 👋 I'm here whenever you need to send money.",
+    "HELP": "I can send Mobile Money for you. Try \"Send 50 to 0551234567\", /save a contact, /myqr or /history.",
+    "CREATOR": "I was created by Caleb Dussey. 🇬🇭",
+    "SECURITY": "Your PIN is hashed and your PIN messages are deleted right away. I will never ask you for your PIN in chat. 🔐",
+}
+
+# Whole-message phrases (after normalize_text)
+_CANNED_PHRASES = {
+    "how are you": "HOW_ARE_YOU", "how far": "HOW_ARE_YOU", "chale how far": "HOW_ARE_YOU",
+    "how you dey": "HOW_ARE_YOU", "wo ho te sen": "HOW_ARE_YOU", "wo ho te sɛn": "HOW_ARE_YOU",
+    "thank you": "THANKS", "thanks a lot": "THANKS", "thank you very much": "THANKS",
+    "what can you do": "HELP", "help": "HELP", "how does this work": "HELP", "how do i send money": "HELP",
+    "who made you": "CREATOR", "who created you": "CREATOR", "who built you": "CREATOR",
+    "is it safe": "SECURITY", "is it safe to use": "SECURITY", "is this safe": "SECURITY",
+    "good morning": "GREETING", "good afternoon": "GREETING", "good evening": "GREETING",
+    "good night": "BYE",
+}
+
+# Single words that carry the whole intent of a short message ("hi there", "thanks chale")
+_CANNED_WORDS = {
+    "hi": "GREETING", "hello": "GREETING", "hey": "GREETING", "hiya": "GREETING", "yo": "GREETING",
+    "maakye": "GREETING", "maaha": "GREETING", "maadwo": "GREETING", "akwaaba": "GREETING",
+    "thanks": "THANKS", "thx": "THANKS", "medaase": "THANKS", "meda": "THANKS",
+    "bye": "BYE", "goodbye": "BYE", "later": "BYE",
+}
+_SHORT_MESSAGE_WORDS = 4
+
+# Replies from the model, keyed by normalized text (frequent FAQs repeat verbatim)
+reply_cache = TTLCache(maxsize=CHAT_CACHE_SIZE, ttl=CHAT_CACHE_TTL)
+chat_stats = {"messages": 0, "canned": 0, "ai_calls": 0, "ai_timeouts": 0, "ai_errors": 0, "ai_latency_ms_total": 0.0}
+_slots = None
+
+def normalize_text(text: str) -> str:
+    cleaned = "".join(ch if ch.isalnum() or ch.isspace() else " " for ch in text.lower())
+    return " ".join(cleaned.split())
+
+def classify_small_talk(normalized: str):
+    """
+    Cheap local classifier: returns a CANNED_REPLIES key or None.
+    """
+    intent = _CANNED_PHRASES.get(normalized)
+    if intent:
+        return intent
+    words = normalized.split()
+    if 0 < len(words) <= _SHORT_MESSAGE_WORDS:
+        for w in words:
+            intent = _CANNED_WORDS.get(w)
+            if intent:
+                return intent
+    return None
+
+async def get_ai_response(user_text: str):
     """
-    Sends text to Gemini and gets a 'chatty' response.
+    Async: Answers small talk. Canned replies and cached model replies are
+    instant; everything else goes to Gemini under a concurrency cap and a
+    CHAT_AI_TIMEOUT deadline.
     """
+    chat_stats["messages"] += 1
+    normalized = normalize_text(user_text)
+
+    # Bare digits may be a PIN or OTP: never sent to (or cached from) the model
+    intent = "HELP" if normalized.replace(" ", "").isdigit() else classify_small_talk(normalized)
+    if intent:
+        chat_stats["canned"] += 1
+        return CANNED_REPLIES[intent]
+
+    return await reply_cache.get_or_load(
+        normalized,
+        lambda: _ask_model(user_text),
+        ttl_for=lambda reply: None if reply == FALLBACK_REPLY else CHAT_CACHE_TTL,
+    )
+
+async def _ask_model(user_text: str) -> str:
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(CHAT_MAX_CONCURRENT)
+
+    chat_stats["ai_calls"] += 1
+    started = time.perf_counter()
     try:
+        return await asyncio.wait_for(_generate(user_text), timeout=CHAT_AI_TIMEOUT)
+    except asyncio.TimeoutError:
+        chat_stats["ai_timeouts"] += 1
+        print(f"AI Chat Timeout after {CHAT_AI_TIMEOUT}s")
+        return FALLBACK_REPLY
+    except Exception as e:
+        chat_stats["ai_errors"] += 1
+        print(f"AI Chat Error: {e}")
+        return FALLBACK_REPLY
+    finally:
+        chat_stats["ai_latency_ms_total"] += (time.perf_counter() - started) * 1000
+
+async def _generate(user_text: str) -> str:
+    async with _slots:
         # We combine the system instruction with the user's text
         prompt = f"{SYSTEM_INSTRUCTION}\n\nUser: {user_text}\nSikaSwift:"
-        
-        response = model.generate_content(prompt)
+
+        response = await model.generate_content_async(prompt)
         return response.text.strip()
-    except Exception as e:
-        print(f"AI Chat Error: {e}")
-        return "Chale, my network is behaving somehow. Try again later!"
\ No newline at end of file
+
+def get_chat_stats() -> dict:
+    messages = chat_stats["messages"]
+    calls = chat_stats["ai_calls"]
+    cache = reply_cache.stats()
+    instant = chat_stats["canned"] + cache["hits"]
+    return {
+        **{k: v for k, v in chat_stats.items() if k != "ai_latency_ms_total"},
+        "instant_rate": round(instant / messages, 4) if messages else 0.0,
+        "ai_avg_latency_ms": round(chat_stats["ai_latency_ms_total"] / calls, 1) if calls else 0.0,
+        "cache": cache,
+    }
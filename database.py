@@ -1,29 +1,87 @@
-from sqlmodel import SQLModel, create_engine, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 import os
+import logging
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger("sikaswift.db")
+
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is not set.")
 
-engine = create_engine(DATABASE_URL, echo=True)
+# --- POOL TUNING ---
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_LOG_SQL = os.getenv("DB_LOG_SQL", "false").lower() == "true"
+DB_MIGRATE_ON_STARTUP = os.getenv("DB_MIGRATE_ON_STARTUP", "true").lower() == "true"
+
+def to_async_url(url: str) -> str:
+    """
+    Turns a plain 'postgresql://' URL (what Heroku/Render/Supabase hand out)
+    into an asyncpg URL. asyncpg spells 'sslmode' as 'ssl'.
+    """
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    if url.startswith("postgresql://") or url.startswith("postgresql+psycopg2://"):
+        url = "postgresql+asyncpg://" + url.split("://", 1)[1]
+    if url.startswith("postgresql+asyncpg://"):
+        url = url.replace("sslmode=", "ssl=")
+    return url
+
+ASYNC_DATABASE_URL = to_async_url(DATABASE_URL)
+
+# SQL statements are logged through the standard 'sqlalchemy.engine' logger
+# (opt-in via DB_LOG_SQL) instead of echo=True printing everything to stdout.
+if DB_LOG_SQL:
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO)
 
-def init_db():
+_pool_args = {}
+if not ASYNC_DATABASE_URL.startswith("sqlite"):
+    _pool_args = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+
+engine = create_async_engine(ASYNC_DATABASE_URL, pool_pre_ping=DB_POOL_PRE_PING, **_pool_args)
+
+# expire_on_commit=False: handlers keep reading `user.state` etc. after commit,
+# and an async session cannot lazily refresh expired attributes.
+async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+async def init_db():
     """
-    Creates the tables defined in models.py.
+    Brings the schema up to date (see migrations.py). A failed migration
+    fails startup: the app must not run against a schema it does not expect.
+    Set DB_MIGRATE_ON_STARTUP=false to run `python migrations.py` as a deploy step instead.
     """
-    try: 
-        SQLModel.metadata.create_all(engine)
-        print("Database tables created successfully.")
+    if not DB_MIGRATE_ON_STARTUP:
+        return
+    from migrations import upgrade
+    try:
+        applied = await upgrade()
+        logger.info(f"Database migrated ({len(applied)} pending migration(s) applied).")
     except Exception as e:
-        print(f"Error creating database tables: {e}")
+        logger.error(f"Error migrating database: {e}")
+        raise
+
+async def close_db():
+    """
+    Disposes the connection pool on shutdown.
+    """
+    await engine.dispose()
 
-def get_session():
+async def get_session():
     """
     Dependency to get a DB session per request.
     """
-    with Session(engine) as session:
-        yield session
\ No newline at end of file
+    async with async_session() as session:
+        yield session
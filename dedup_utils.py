@@ -0,0 +1,156 @@
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import delete
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import select
+from sqlalchemy.exc import IntegrityError
+from dotenv import load_dotenv
+
+from cache_utils import TTLCache
+from database import async_session
+from models import ProcessedUpdate
+
+load_dotenv()
+
+# Telegram keeps undelivered updates for 24h, so a redelivery never arrives later than that.
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", "20000"))
+UPDATE_DEDUP_RETENTION = float(os.getenv("UPDATE_DEDUP_RETENTION", "86400"))
+UPDATE_DEDUP_PRUNE_EVERY = int(os.getenv("UPDATE_DEDUP_PRUNE_EVERY", "1000"))
+
+class UpdateDeduplicator:
+    """
+    Remembers which Telegram update_ids were processed.
+    - Recent ids live in a bounded in-memory window, so a redelivery to this
+      process is rejected without touching the DB or the network.
+    - The processed_update table (primary key = update_id) catches
+      redeliveries that land on another worker/process.
+    """
+    def __init__(self, window: int = UPDATE_DEDUP_WINDOW, retention: float = UPDATE_DEDUP_RETENTION):
+        self.seen = TTLCache(maxsize=window, ttl=retention)
+        self.retention = retention
+        self.stats_counters = {"claimed": 0, "memory_hits": 0, "db_hits": 0, "pruned": 0, "db_errors": 0}
+        self._since_prune = 0
+
+    def seen_recently(self, update_id) -> bool:
+        """
+        Memory-window check only: True if this process already handled the update.
+        """
+        if update_id is not None and self.seen.get(update_id):
+            self.stats_counters["memory_hits"] += 1
+            return True
+        return False
+
+    async def claim(self, update_id) -> bool:
+        """
+        True if this update is new (and now recorded), False if it was already seen.
+        Updates without an update_id are always treated as new.
+        """
+        if update_id is None:
+            return True
+        if self.seen.get(update_id):
+            self.stats_counters["memory_hits"] += 1
+            return False
+
+        try:
+            async with async_session() as session:
+                session.add(ProcessedUpdate(update_id=update_id))
+                await session.commit()
+        except IntegrityError:
+            self.seen.set(update_id, True)
+            self.stats_counters["db_hits"] += 1
+            return False
+        except Exception as e:
+            # DB trouble shouldn't stop the bot; the memory window still protects this process.
+            self.stats_counters["db_errors"] += 1
+            print(f"⚠️ Update dedup DB error: {e}")
+
+        self.seen.set(update_id, True)
+        self.stats_counters["claimed"] += 1
+        await self._count_for_prune(1)
+        return True
+
+    async def unseen(self, update_ids: list) -> set:
+        """
+        For getUpdates batches: the ids not yet processed, in one SELECT.
+        Records nothing; the caller claim_many()s the batch once its handlers have run.
+        """
+        fresh = []
+        for update_id in update_ids:
+            if self.seen.get(update_id):
+                self.stats_counters["memory_hits"] += 1
+            else:
+                fresh.append(update_id)
+        if not fresh:
+            return set()
+
+        try:
+            async with async_session() as session:
+                known = set((await session.exec(
+                    select(ProcessedUpdate.update_id).where(ProcessedUpdate.update_id.in_(fresh))
+                )).all())
+            for update_id in known:
+                self.seen.set(update_id, True)
+            self.stats_counters["db_hits"] += len(known)
+            fresh = [u for u in fresh if u not in known]
+        except Exception as e:
+            # Only one getUpdates consumer exists per bot, so the memory window is enough to carry on
+            self.stats_counters["db_errors"] += 1
+            print(f"⚠️ Update dedup DB error: {e}")
+        return set(fresh)
+
+    async def claim_many(self, update_ids: list) -> set:
+        """
+        Records a batch of update_ids with one multi-row
+        INSERT ... ON CONFLICT DO NOTHING RETURNING. Returns the ids this call recorded.
+        """
+        if not update_ids:
+            return set()
+        for update_id in update_ids:
+            self.seen.set(update_id, True)
+        now = datetime.utcnow()
+        try:
+            async with async_session() as session:
+                insert = postgresql.insert if session.get_bind().dialect.name == "postgresql" else sqlite.insert
+                result = await session.execute(
+                    insert(ProcessedUpdate)
+                    .values([{"update_id": update_id, "created_at": now} for update_id in update_ids])
+                    .on_conflict_do_nothing(index_elements=["update_id"])
+                    .returning(ProcessedUpdate.update_id)
+                )
+                claimed = set(result.scalars().all())
+                await session.commit()
+        except Exception as e:
+            self.stats_counters["db_errors"] += 1
+            print(f"⚠️ Update dedup DB error: {e}")
+            return set()
+        self.stats_counters["claimed"] += len(claimed)
+        self.stats_counters["db_hits"] += len(update_ids) - len(claimed)
+        await self._count_for_prune(len(claimed))
+        return claimed
+
+    async def _count_for_prune(self, recorded: int):
+        self._since_prune += recorded
+        if self._since_prune >= UPDATE_DEDUP_PRUNE_EVERY:
+            self._since_prune = 0
+            await self.prune()
+
+    async def prune(self):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.retention)
+        try:
+            async with async_session() as session:
+                result = await session.execute(delete(ProcessedUpdate).where(ProcessedUpdate.created_at < cutoff))
+                await session.commit()
+                self.stats_counters["pruned"] += result.rowcount or 0
+        except Exception as e:
+            print(f"⚠️ Update dedup prune failed: {e}")
+
+    def stats(self) -> dict:
+        hits = self.stats_counters["memory_hits"] + self.stats_counters["db_hits"]
+        seen = hits + self.stats_counters["claimed"]
+        return {
+            **self.stats_counters,
+            "duplicate_rate": round(hits / seen, 4) if seen else 0.0,
+            "window": len(self.seen),
+        }
+
+update_dedup = UpdateDeduplicator()
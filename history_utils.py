@@ -0,0 +1,190 @@
+import os
+import uuid
+import base64
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlmodel import select
+from sqlalchemy import tuple_
+from dotenv import load_dotenv
+
+from models import Transaction
+
+load_dotenv()
+
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "8"))
+STATEMENT_BATCH = int(os.getenv("STATEMENT_BATCH", "500"))   # rows fetched per round trip
+
+# Filter words for /history and /statement
+STATUS_GROUPS = {
+    "done": ("COMPLETE", "DISBURSING"),
+    "pending": ("INIT", "WAITING_FOR_OTP", "PENDING_DEBIT", "DEBIT_SUCCESS", "PENDING_DISBURSE"),
+    "failed": ("DEBIT_FAILED", "ABANDONED", "TRANSFER_FAILED", "RECIPIENT_FAIL", "REFUND_FAILED"),
+    "refunded": ("REFUNDED", "PARTIAL_REFUND"),
+}
+
+def recipient_label(recipient_phone: str) -> str:
+    # Split bill parents have no single recipient (their legs do)
+    return recipient_phone or "Split bill"
+
+def status_icon(status: str) -> str:
+    if "FAIL" in status or "REFUND" in status or status == "ABANDONED": return "❌"
+    if "WAIT" in status or "PENDING" in status or status in ("INIT", "DEBIT_SUCCESS"): return "⏳"
+    return "✅"
+
+class HistoryFilter:
+    """
+    Status group plus an inclusive date range (UTC days), e.g. "/history failed 2024-01-01 2024-03-31".
+    """
+    __slots__ = ("group", "since", "until")
+
+    def __init__(self, group: Optional[str] = None, since: Optional[datetime] = None, until: Optional[datetime] = None):
+        self.group = group
+        self.since = since
+        self.until = until
+
+    @classmethod
+    def parse(cls, words: list) -> "HistoryFilter":
+        """
+        Raises ValueError on anything that is not a status group or a YYYY-MM-DD date.
+        """
+        flt = cls()
+        for word in words:
+            if word.lower() in STATUS_GROUPS:
+                flt.group = word.lower()
+                continue
+            day = datetime.strptime(word, "%Y-%m-%d")
+            if flt.since is None:
+                flt.since = day
+            elif flt.until is None:
+                flt.until = day
+            else:
+                raise ValueError(f"Too many dates: {word}")
+        if flt.since and flt.until and flt.until < flt.since:
+            flt.since, flt.until = flt.until, flt.since
+        return flt
+
+    def clauses(self) -> list:
+        clauses = []
+        if self.group:
+            clauses.append(Transaction.status.in_(STATUS_GROUPS[self.group]))
+        if self.since:
+            clauses.append(Transaction.created_at >= self.since)
+        if self.until:
+            clauses.append(Transaction.created_at < self.until + timedelta(days=1))
+        return clauses
+
+    def describe(self) -> str:
+        parts = [self.group] if self.group else []
+        if self.since or self.until:
+            since = self.since.strftime("%d-%b-%Y") if self.since else "start"
+            until = self.until.strftime("%d-%b-%Y") if self.until else "today"
+            parts.append(f"{since} → {until}")
+        return ", ".join(parts)
+
+    # Packed into callback_data (Telegram allows 64 bytes): "<group initial>|<since>|<until>"
+    def pack(self) -> str:
+        day = lambda d: d.strftime("%Y%m%d") if d else ""
+        return f"{self.group[0] if self.group else ''}|{day(self.since)}|{day(self.until)}"
+
+    @classmethod
+    def unpack(cls, packed: str) -> "HistoryFilter":
+        initial, since, until = packed.split("|")
+        group = next((g for g in STATUS_GROUPS if g[0] == initial), None) if initial else None
+        day = lambda s: datetime.strptime(s, "%Y%m%d") if s else None
+        return cls(group, day(since), day(until))
+
+# --- PAGES (keyset on (sender_phone, created_at, id), newest first) ---
+
+def encode_cursor(txn_id: uuid.UUID) -> str:
+    return base64.urlsafe_b64encode(txn_id.bytes).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> uuid.UUID:
+    return uuid.UUID(bytes=base64.urlsafe_b64decode(cursor + "=="))
+
+def page_callback(direction: str, txn_id: uuid.UUID, flt: HistoryFilter) -> str:
+    """
+    callback_data for an "older" (o) / "newer" (n) button anchored at txn_id.
+    """
+    return f"hist|{direction}|{encode_cursor(txn_id)}|{flt.pack()}"
+
+def parse_page_callback(data: str):
+    """
+    (direction, anchor id, filter) from page_callback() data.
+    """
+    _, direction, cursor, packed = data.split("|", 3)
+    return direction, decode_cursor(cursor), HistoryFilter.unpack(packed)
+
+async def fetch_page(session, phone: str, flt: HistoryFilter, anchor_id: uuid.UUID = None,
+                     direction: str = "o", limit: int = HISTORY_PAGE_SIZE):
+    """
+    One page of a sender's top-level transactions, newest first.
+    Returns (rows, has_older, has_newer). Without an anchor: the newest page.
+    """
+    statement = select(Transaction).where(
+        Transaction.sender_phone == phone,
+        Transaction.parent_id == None,  # split legs are summarised by their parent
+        *flt.clauses(),
+    )
+    anchor = await session.get(Transaction, anchor_id) if anchor_id else None
+    if anchor is not None and anchor.sender_phone != phone:
+        anchor = None
+
+    key = tuple_(Transaction.created_at, Transaction.id)
+    if anchor is None:
+        statement = statement.order_by(Transaction.created_at.desc(), Transaction.id.desc())
+    elif direction == "n":
+        statement = statement.where(key > (anchor.created_at, anchor.id)).order_by(Transaction.created_at, Transaction.id)
+    else:
+        statement = statement.where(key < (anchor.created_at, anchor.id)).order_by(Transaction.created_at.desc(), Transaction.id.desc())
+
+    rows = (await session.exec(statement.limit(limit + 1))).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if anchor is None:
+        return rows, more, False
+    if direction == "n":
+        return rows[::-1], True, more
+    return rows, more, True
+
+def render_page(rows: list, flt: HistoryFilter, has_older: bool, has_newer: bool):
+    """
+    (text, inline keyboard or None) for a history page.
+    """
+    title = "📜 **Recent Activity**"
+    if flt.describe():
+        title += f" ({flt.describe()})"
+    if not rows:
+        return f"{title}\n\n📭 **No transactions found.**", None
+
+    lines = [title, ""]
+    for t in rows:
+        lines.append(f"{status_icon(t.status)} **GHS {t.amount:.2f}** ➡ {recipient_label(t.recipient_phone)}")
+        lines.append(f"📅 {t.created_at.strftime('%d-%b %H:%M')} | {t.status}")
+        lines.append("")
+    buttons = []
+    if has_newer:
+        buttons.append({"text": "⬅️ Newer", "callback_data": page_callback("n", rows[0].id, flt)})
+    if has_older:
+        buttons.append({"text": "Older ➡️", "callback_data": page_callback("o", rows[-1].id, flt)})
+    return "\n".join(lines).rstrip(), ({"inline_keyboard": [buttons]} if buttons else None)
+
+# --- STATEMENT ROWS ---
+
+STATEMENT_COLUMNS = ("created_at", "recipient_phone", "amount", "status", "paystack_reference")
+
+async def stream_statement_rows(session, phone: str, flt: HistoryFilter):
+    """
+    Yields a sender's transactions oldest first, STATEMENT_BATCH rows per round
+    trip (a server-side cursor on Postgres), without loading them all.
+    Rows are plain tuples in STATEMENT_COLUMNS order.
+    """
+    statement = select(*(getattr(Transaction, c) for c in STATEMENT_COLUMNS)).where(
+        Transaction.sender_phone == phone,
+        Transaction.parent_id == None,
+        *flt.clauses(),
+    ).order_by(Transaction.created_at, Transaction.id).execution_options(yield_per=STATEMENT_BATCH)
+
+    result = await session.stream(statement)
+    async for partition in result.partitions():
+        for row in partition:
+            yield row
@@ -0,0 +1,241 @@
+import os
+import json
+import random
+import asyncio
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import update, or_, and_
+from sqlmodel import select
+from dotenv import load_dotenv
+
+from database import async_session
+from models import Job
+
+load_dotenv()
+
+# --- CONFIGURATION ---
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))                       # max jobs running at once
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "2"))          # idle poll (seconds)
+# Lease of a running job. Keep it above the slowest Paystack call (see paystack_utils.max_call_time);
+# a running job renews it every JOB_HEARTBEAT_INTERVAL, so a slow job is never taken for a dead one.
+JOB_VISIBILITY_TIMEOUT = float(os.getenv("JOB_VISIBILITY_TIMEOUT", "300"))
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", str(JOB_VISIBILITY_TIMEOUT / 3)))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE = float(os.getenv("JOB_RETRY_BASE", "5"))               # backoff base (seconds)
+JOB_RETRY_MAX = float(os.getenv("JOB_RETRY_MAX", "600"))
+
+# kind -> async handler(job, session)
+HANDLERS = {}
+
+class RetryLater(Exception):
+    """
+    Raised by a handler that could not start yet (e.g. a row another worker
+    holds): the job runs again after `delay` seconds without using up an attempt.
+    """
+    def __init__(self, message: str, delay: float = 1.0):
+        super().__init__(message)
+        self.delay = delay
+
+def job_handler(kind: str):
+    """
+    Registers an async handler for a job kind:
+
+        @job_handler("disburse")
+        async def disburse(job, session): ...
+
+    Raising an exception schedules a retry with backoff; RetryLater
+    reschedules it without counting the attempt.
+    """
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+def enqueue(session, kind: str, payload: dict, delay: float = 0, max_attempts: int = JOB_MAX_ATTEMPTS) -> Job:
+    """
+    Adds a job to `session`. It becomes durable when the caller commits, so it
+    lands in the same DB transaction as whatever state change triggered it.
+    Call notify() after the commit to wake an idle worker.
+    """
+    job = Job(
+        kind=kind,
+        payload=json.dumps(payload),
+        max_attempts=max_attempts,
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+    session.add(job)
+    return job
+
+def retry_delay(attempts: int) -> float:
+    """
+    Exponential backoff with jitter for the Nth failed attempt.
+    """
+    delay = min(JOB_RETRY_MAX, JOB_RETRY_BASE * (2 ** (attempts - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+class JobWorkerPool:
+    """
+    Runs queued jobs on JOB_WORKERS asyncio tasks.
+
+    Claiming is a compare-and-set UPDATE, so several processes can share the
+    table. A claimed job holds a lease (`locked_until`) that a heartbeat
+    renews while it runs; if the process dies mid-job the lease expires and
+    another worker picks it up again.
+    """
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = workers
+        self._tasks = []
+        self._wake = None
+        self._stopping = False
+
+    def notify(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def start(self):
+        self._stopping = False
+        self._wake = asyncio.Event()
+        recovered = await self.recover()
+        if recovered:
+            print(f"♻️ Re-queued {recovered} interrupted job(s).")
+        self._tasks = [asyncio.create_task(self._run(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        self._stopping = True
+        self._wake.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def recover(self) -> int:
+        """
+        Crash recovery: puts RUNNING jobs whose lease has expired back to PENDING.
+        """
+        now = datetime.utcnow()
+        async with async_session() as session:
+            result = await session.execute(
+                update(Job)
+                .where(Job.status == "RUNNING", Job.locked_until < now)
+                .values(status="PENDING", locked_until=None, run_at=now, updated_at=now)
+            )
+            await session.commit()
+            return result.rowcount or 0
+
+    async def claim(self, session):
+        """
+        Leases the next due job, or returns None.
+        """
+        now = datetime.utcnow()
+        due = or_(
+            and_(Job.status == "PENDING", Job.run_at <= now),
+            and_(Job.status == "RUNNING", Job.locked_until < now),  # lease expired
+        )
+        candidates = (await session.exec(select(Job).where(due).order_by(Job.run_at).limit(5))).all()
+
+        for job in candidates:
+            result = await session.execute(
+                update(Job)
+                .where(Job.id == job.id, Job.status == job.status, Job.attempts == job.attempts)
+                .values(
+                    status="RUNNING",
+                    attempts=job.attempts + 1,
+                    locked_until=now + timedelta(seconds=JOB_VISIBILITY_TIMEOUT),
+                    updated_at=now,
+                )
+            )
+            await session.commit()
+            if result.rowcount == 1:
+                await session.refresh(job)
+                return job
+        return None
+
+    async def _run(self, idx: int):
+        while not self._stopping:
+            try:
+                async with async_session() as session:
+                    job = await self.claim(session)
+                    if job is None:
+                        self._wake.clear()
+                        try:
+                            await asyncio.wait_for(self._wake.wait(), timeout=JOB_POLL_INTERVAL)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                    await self._execute(job, session)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Job worker {idx} error: {e}")
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    async def _execute(self, job: Job, session):
+        handler = HANDLERS.get(job.kind)
+        job_id = job.id
+        now = datetime.utcnow()
+        try:
+            if handler is None:
+                raise RuntimeError(f"No handler registered for job kind '{job.kind}'")
+            heartbeat = asyncio.create_task(self._heartbeat(job_id, job.attempts))
+            try:
+                await handler(job, session)
+            finally:
+                heartbeat.cancel()
+            job.status = "DONE"
+            job.last_error = None
+        except RetryLater as e:
+            await session.rollback()
+            job = await session.get(Job, job_id, populate_existing=True)
+            job.last_error = f"RetryLater: {e}"[:500]
+            job.status = "PENDING"
+            job.attempts -= 1  # handlers read attempts > 1 as "an earlier attempt may have reached Paystack"
+            job.run_at = now + timedelta(seconds=e.delay)
+        except Exception as e:
+            await session.rollback()
+            job = await session.get(Job, job_id, populate_existing=True)
+            job.last_error = f"{type(e).__name__}: {e}"[:500]
+            if job.attempts >= job.max_attempts:
+                job.status = "DEAD"
+                print(f"❌ Job {job.id} ({job.kind}) dead after {job.attempts} attempts: {e}")
+                traceback.print_exc()
+            else:
+                job.status = "PENDING"
+                job.run_at = now + timedelta(seconds=retry_delay(job.attempts))
+        job.locked_until = None
+        job.updated_at = datetime.utcnow()
+        session.add(job)
+        await session.commit()
+
+    async def _heartbeat(self, job_id: int, attempts: int):
+        """
+        Renews a running job's lease until cancelled. Uses its own session: the
+        handler's transaction holds row locks and must not be committed from here.
+        """
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            now = datetime.utcnow()
+            try:
+                async with async_session() as session:
+                    result = await session.execute(
+                        update(Job)
+                        .where(Job.id == job_id, Job.status == "RUNNING", Job.attempts == attempts)
+                        .values(locked_until=now + timedelta(seconds=JOB_VISIBILITY_TIMEOUT), updated_at=now)
+                    )
+                    await session.commit()
+            except Exception as e:
+                print(f"⚠️ Job {job_id} heartbeat failed: {e}")
+                continue
+            if result.rowcount != 1:
+                print(f"⚠️ Job {job_id} lost its lease to another worker")
+                return
+
+job_pool = JobWorkerPool()
+
+def notify():
+    """
+    Wakes an idle worker after a commit that enqueued work.
+    """
+    job_pool.notify()
+
+def load_payload(job: Job) -> dict:
+    return json.loads(job.payload or "{}")
@@ -1,338 +1,575 @@
 import os
 import hmac
 import hashlib
+import uuid
+import json
 import asyncio
-import httpx 
-from fastapi import FastAPI, Request, Depends
+import logging
+from datetime import datetime
+from fastapi import FastAPI, Request, Depends, HTTPException
 from contextlib import asynccontextmanager
-from sqlmodel import Session, select
+from sqlmodel import select
+from sqlalchemy import func
+from sqlmodel.ext.asyncio.session import AsyncSession
 from dotenv import load_dotenv
 
-from database import init_db, get_session
+from database import init_db, close_db, get_session, async_session
 from models import Transaction, User, Beneficiary
-from nlp import parse_message
+from nlp import parse_message, get_nlp_stats
 # Imported async functions from updated utils
 from telegram_utils import (
-    BASE_URL, send_message, send_photo, send_name_confirmation, 
-    request_phone_number, delete_message_buttons, delete_message, answer_callback
+    send_message, send_name_confirmation, send_split_confirmation, send_chat_action, send_history_page, send_document,
+    request_phone_number, delete_message_buttons, delete_message, answer_callback,
+    start_client as start_telegram_client, close_client as close_telegram_client, get_outbound_stats
 )
 from paystack_utils import (
-    initiate_charge, submit_otp, create_transfer_recipient, 
-    initiate_transfer, resolve_mobile_money, refund_charge
+    initiate_charge, submit_otp,
+    initiate_transfer, initiate_bulk_transfer, resolve_mobile_money, refund_charge, verify_transfer, resolve_cache,
+    to_pesewas, new_reference, max_call_time, ENDPOINT_TIMEOUTS,
+    start_client as start_paystack_client, close_client as close_paystack_client
 )
-from security_utils import hash_pin, verify_pin
-from receipt_utils import generate_receipt
-from qr_utils import generate_payment_qr
-from chat_utils import get_ai_response
+from recipient_utils import get_recipient_code, is_stale_recipient_error, recipient_cache
+from job_queue import (
+    job_pool, job_handler, enqueue, notify as notify_jobs, load_payload, JOB_VISIBILITY_TIMEOUT, JOB_HEARTBEAT_INTERVAL,
+)
+from security_utils import (
+    hash_pin_async, verify_pin_async, needs_rehash,
+    PinBusyError, PinRateLimitError, shutdown as shutdown_pin_pool
+)
+from receipt_utils import warm_up as warm_up_receipts, shutdown as shutdown_receipt_pool
+from qr_utils import send_payment_qr, qr_cache
+from chat_utils import get_ai_response, get_chat_stats
+from pipeline_utils import UpdatePipeline
+from dedup_utils import update_dedup
+from router_utils import Router, RouteTimer, load_user, require_user
+from state_utils import state_store, PaymentDraft, RecipientDraft, SplitDraft, SplitLeg, IDLE, PIN_EXPIRED
+from reconcile_utils import reconciler
+from txn_state_utils import (
+    transition, transition_many, set_status, can_transition, lock_transaction, lock_legs, complete_split_parents
+)
+from outbox_utils import outbox_relay, queue_message, queue_receipt
+from history_utils import HistoryFilter, fetch_page, render_page, parse_page_callback, stream_statement_rows
+from statement_utils import build_statement, StatementTooLarge, STATEMENT_FORMATS
 
 load_dotenv()
+
+logger = logging.getLogger("sikaswift.app")
+
 PAYSTACK_SECRET = os.getenv("PAYSTACK_SECRET_KEY")
 ADMIN_ID = os.getenv("ADMIN_ID", "YOUR_ADMIN_ID")
+# Seconds to wait after charge.success before paying out (lets the balance settle)
+DISBURSE_DELAY = float(os.getenv("DISBURSE_DELAY", "2"))
+SPLIT_MAX_RECIPIENTS = int(os.getenv("SPLIT_MAX_RECIPIENTS", "10"))
+SPLIT_RESOLVE_CONCURRENCY = int(os.getenv("SPLIT_RESOLVE_CONCURRENCY", "5"))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    init_db()
+    # A job lease shorter than one Paystack call would let a second worker re-run a live disbursement
+    slowest = max(max_call_time(endpoint) for endpoint in ENDPOINT_TIMEOUTS)
+    if JOB_VISIBILITY_TIMEOUT <= max(slowest, JOB_HEARTBEAT_INTERVAL):
+        raise ValueError(
+            f"JOB_VISIBILITY_TIMEOUT ({JOB_VISIBILITY_TIMEOUT:.0f}s) must exceed the slowest Paystack call "
+            f"({slowest:.0f}s) and JOB_HEARTBEAT_INTERVAL ({JOB_HEARTBEAT_INTERVAL:.0f}s)."
+        )
+    await init_db()
+    await start_telegram_client()
+    await start_paystack_client()
+    warm_up_receipts()
+    await job_pool.start()
+    await reconciler.start()
+    await outbox_relay.start()
+    update_pipeline.start()
     yield
+    await update_pipeline.stop()
+    await outbox_relay.stop()
+    await reconciler.stop()
+    await job_pool.stop()
+    await close_paystack_client()
+    await close_telegram_client()
+    await close_db()
+    shutdown_pin_pool()
+    shutdown_receipt_pool()
 
 app = FastAPI(lifespan=lifespan, title="SikaSwift Bot 🤖")
 
+@app.get("/metrics")
+async def metrics():
+    """
+    In-process counters for caches and queues (JSON).
+    """
+    return {
+        "resolve_cache": resolve_cache.stats(),
+        "recipient_cache": recipient_cache.stats(),
+        "nlp": get_nlp_stats(),
+        "chat": get_chat_stats(),
+        "qr_cache": qr_cache.stats(),
+        "telegram_outbound": get_outbound_stats(),
+        "updates": update_pipeline.stats(),
+        "update_dedup": update_dedup.stats(),
+        "routes": route_timer.stats(),
+        "conversation_state": state_store.stats(),
+        "reconciler": reconciler.stats(),
+        "paystack_events": dict(paystack_event_stats),
+        "outbox": outbox_relay.stats(),
+    }
+
 @app.post("/telegram-webhook")
-async def telegram_webhook(request: Request, session: Session = Depends(get_session)):
+async def telegram_webhook(request: Request):
+    """
+    Acks Telegram as soon as the update is queued; processing happens on the
+    update pipeline. If the pipeline is saturated we answer 503 so Telegram
+    holds the update and redelivers it later. Redeliveries of an update this
+    process already handled are acked without doing anything.
+
+    The update_id is recorded when a pipeline worker picks the update up, not
+    here: a queued update lost in a crash was acked, so Telegram will not send
+    it again, but any copy it does send is not mistaken for a duplicate.
+    """
     data = await request.json()
-    
-    if "callback_query" in data:
-        await handle_callback(data["callback_query"], session)
-        return {"status": "ok"}
-    
-    if "message" in data:
-        msg = data["message"]
-        chat_id = str(msg["chat"]["id"])
-        message_id = msg.get("message_id")
-
-        # 1. UX: TYPING INDICATOR
-        # Fire immediately so the user knows we are processing
-        try: 
-            async with httpx.AsyncClient() as client:
-                await client.post(f"{BASE_URL}/sendChatAction", json={"chat_id": chat_id, "action": "typing"})
-        except: pass
-        
-        # 2. CONTACT SHARING
-        if "contact" in msg:
-            phone = msg["contact"]["phone_number"].replace("+", "")
-            user = session.get(User, chat_id)
-            
-            if user and user.state == "AWAITING_RESET_AUTH":
-                if user.phone_number == phone:
-                    user.pin_hash = None
-                    user.state = "AWAITING_NEW_PIN"
-                    session.add(user)
-                    session.commit()
-                    await send_message(chat_id, "✅ **Identity Verified!**\nEnter **NEW 4-digit PIN**:")
+    if update_dedup.seen_recently(data.get("update_id")):
+        return {"status": "duplicate"}
+    if not await update_pipeline.submit(data):
+        raise HTTPException(status_code=503, detail="Busy, retry later")
+    return {"status": "ok"}
+
+async def process_update(data: dict):
+    """
+    Pipeline worker entry point: claims the update_id (one worker or process
+    wins a redelivered update), then handles it with one session.
+    """
+    if not await update_dedup.claim(data.get("update_id")):
+        return
+    async with async_session() as session:
+        await handle_update(data, session)
+
+update_pipeline = UpdatePipeline(process_update)
+
+router = Router(user_loader=lambda session, chat_id: session.get(User, chat_id), state_loader=state_store.get)
+route_timer = RouteTimer()
+
+async def show_typing(ctx, call_next):
+    # UX: fire immediately so the user knows we are processing
+    if ctx.route.name != "callback":
+        await send_chat_action(ctx.chat_id, "typing")
+    await call_next()
+
+async def ask_to_register(ctx):
+    await send_message(ctx.chat_id, "Register first.")
+
+router.use(route_timer)
+router.use(show_typing)
+router.use(load_user)
+router.use(require_user(ask_to_register))
+
+async def handle_update(data: dict, session: AsyncSession):
+    await router.dispatch(data, session)
+
+# --- CALLBACKS & CONTACT SHARING ---
+
+@router.callback()
+async def on_callback(ctx):
+    await handle_callback(ctx.callback, ctx.session)
+
+@router.contact()
+async def on_contact(ctx):
+    chat_id, session, user = ctx.chat_id, ctx.session, ctx.user
+    phone = ctx.msg["contact"]["phone_number"].replace("+", "")
+
+    if user and (await ctx.get_state()).name == "AWAITING_RESET_AUTH":
+        if user.phone_number == phone:
+            user.pin_hash = None
+            session.add(user)
+            await state_store.set(session, chat_id, "AWAITING_NEW_PIN")
+            await send_message(chat_id, "✅ **Identity Verified!**\nEnter **NEW 4-digit PIN**:")
+        else:
+            await state_store.clear(session, chat_id)
+            await send_message(chat_id, "❌ Number mismatch.")
+        return
+
+    if not user:
+        user = User(telegram_id=chat_id, phone_number=phone, state=IDLE)
+        await session.merge(user)
+        await session.commit()
+        await send_message(chat_id, "✅ Phone saved! **Type /setpin to secure your account.**")
+
+# --- CONVERSATION STATES ---
+
+def looks_like_pin(text: str) -> bool:
+    return len(text) == 4 and text.isdigit()
+
+async def delete_pin_message(ctx):
+    # AUTO-DELETE PIN
+    if looks_like_pin(ctx.text):
+        await delete_message(ctx.chat_id, ctx.message_id)
+
+@router.state(PIN_EXPIRED, load_user=True)
+async def on_expired_pin(ctx):
+    """
+    A PIN prompt timed out. A late PIN reply is deleted and not acted on;
+    anything else is handled as normal text.
+    """
+    await state_store.clear(ctx.session, ctx.chat_id)
+    if looks_like_pin(ctx.text):
+        await delete_message(ctx.chat_id, ctx.message_id)
+        await send_message(ctx.chat_id, "⌛ PIN prompt expired, please start again.")
+        return
+    await on_text(ctx)
+
+@router.state("AWAITING_NEW_PIN", load_user=True)
+async def on_new_pin(ctx):
+    chat_id, session, user, text = ctx.chat_id, ctx.session, ctx.user, ctx.text
+    await delete_pin_message(ctx)
+    if len(text) == 4 and text.isdigit():
+        try:
+            user.pin_hash = await hash_pin_async(text)
+        except PinBusyError:
+            await send_message(chat_id, "⏳ System busy. Please enter your PIN again.")
+            return
+        session.add(user)
+        await state_store.clear(session, chat_id)
+        await send_message(chat_id, "🔐 **PIN Set Successfully!**")
+    else:
+        await send_message(chat_id, "❌ PIN must be 4 digits.")
+
+@router.state("AWAITING_PIN_AUTH", load_user=True)
+@router.state("AWAITING_SPLIT_PIN", load_user=True)
+async def on_payment_pin(ctx):
+    chat_id, session, user, text = ctx.chat_id, ctx.session, ctx.user, ctx.text
+    await delete_pin_message(ctx)
+    try:
+        pin_ok = await verify_pin_async(text, user.pin_hash, user_key=chat_id)
+    except PinRateLimitError as e:
+        await send_message(chat_id, f"🚫 **Too many attempts.** Try again in {int(e.retry_after // 60) + 1} min.")
+        await state_store.clear(session, chat_id)
+        return
+    except PinBusyError:
+        await send_message(chat_id, "⏳ System busy. Please enter your PIN again.")
+        return
+
+    if pin_ok:
+        # Upgrade hashes made at an older bcrypt cost
+        if needs_rehash(user.pin_hash):
+            try: user.pin_hash = await hash_pin_async(text)
+            except PinBusyError: pass
+            session.add(user)
+        draft = ctx.state.payload
+        await state_store.clear(session, chat_id)
+        if not isinstance(draft, (PaymentDraft, SplitDraft)):
+            await send_message(chat_id, "❌ Error. Try again.")
+            return
+        try:
+            await send_message(chat_id, "🔓 **PIN Verified.** Processing...")
+            if isinstance(draft, SplitDraft):
+                await execute_charge(chat_id, user, draft.total, None, session, legs=draft.legs)
+            else:
+                await execute_charge(chat_id, user, draft.amount, draft.recipient, session)
+        except:
+            await send_message(chat_id, "❌ Error. Try again.")
+    else:
+        await send_message(chat_id, "❌ **Wrong PIN.** Cancelled.")
+        await state_store.clear(session, chat_id)
+
+@router.state("AWAITING_EDIT_AMOUNT")
+async def on_edit_amount(ctx):
+    chat_id, session, text = ctx.chat_id, ctx.session, ctx.text
+    clean_text = text.replace('.', '', 1)
+    if clean_text.isdigit():
+        new_amount = float(text)
+        recipient_phone = ctx.state.payload.recipient # Stored in the edit_ callback
+
+        await state_store.clear(session, chat_id)
+
+        # Re-confirm with new amount
+        verification = await resolve_mobile_money(recipient_phone)
+        name = verification["account_name"] if verification["status"] else "Unknown"
+
+        await send_message(chat_id, "🔄 Updating...")
+        await send_name_confirmation(chat_id, new_amount, recipient_phone, name)
+    else:
+        await send_message(chat_id, "❌ Invalid amount. Please enter a number (e.g. 50).")
+
+@router.state("AWAITING_QR_AMOUNT")
+async def on_qr_amount(ctx):
+    chat_id, session, text = ctx.chat_id, ctx.session, ctx.text
+    if text.replace('.', '', 1).isdigit():
+        amount = float(text)
+        recipient = ctx.state.payload.recipient
+
+        await state_store.clear(session, chat_id)
+
+        verification = await resolve_mobile_money(recipient)
+        name = verification["account_name"] if verification["status"] else "Unknown"
+        await send_name_confirmation(chat_id, amount, recipient, name)
+    else:
+        await send_message(chat_id, "❌ Invalid amount.")
+
+# --- COMMANDS ---
+
+@router.command("/save")
+async def cmd_save(ctx):
+    chat_id, session = ctx.chat_id, ctx.session
+    try:
+        parts = ctx.text.split()
+        if len(parts) != 3:
+            await send_message(chat_id, "⚠️ Usage: `/save Mom 0555111222`")
+            return
+
+        name_alias = parts[1].lower()
+        number = parts[2]
+
+        if not number.isdigit() or len(number) != 10:
+            await send_message(chat_id, "❌ Invalid phone number.")
+            return
+
+        contact = Beneficiary(user_id=chat_id, name=name_alias, phone_number=number)
+        session.add(contact)
+        await session.commit()
+        await send_message(chat_id, f"✅ Saved **{parts[1]}** ({number})")
+    except:
+        await send_message(chat_id, "❌ Error saving contact.")
+
+@router.command("/contacts")
+async def cmd_contacts(ctx):
+    contacts = (await ctx.session.exec(select(Beneficiary).where(Beneficiary.user_id == ctx.chat_id))).all()
+    if not contacts:
+        await send_message(ctx.chat_id, "📭 No contacts. Use `/save Mom 055...`")
+    else:
+        msg = "📖 **My Contacts**\n\n"
+        for c in contacts:
+            msg += f"👤 **{c.name.title()}**: {c.phone_number}\n"
+        await send_message(ctx.chat_id, msg)
+
+@router.command("/start")
+async def cmd_start(ctx):
+    await send_message(ctx.chat_id, "👋 **Welcome!**\n\n/setpin\n/save [Name] [Number]\n/myqr\n/history\n/statement")
+
+@router.command("/setpin", load_user=True)
+async def cmd_setpin(ctx):
+    if not ctx.user: await request_phone_number(ctx.chat_id)
+    else:
+        await state_store.set(ctx.session, ctx.chat_id, "AWAITING_NEW_PIN")
+        await send_message(ctx.chat_id, "🔐 Enter **4-digit PIN**:")
+
+@router.command("/resetpin", auth=True)
+async def cmd_resetpin(ctx):
+    await state_store.set(ctx.session, ctx.chat_id, "AWAITING_RESET_AUTH")
+    await request_phone_number(ctx.chat_id)
+    await send_message(ctx.chat_id, "⚠️ **Security Check**\nTap 'Share Phone Number' below.")
+
+@router.command("/myqr", auth=True)
+async def cmd_myqr(ctx):
+    phone = ctx.user.phone_number
+    await send_payment_qr(ctx.chat_id, phone, caption=f"Scan to pay **{phone}**")
+
+HISTORY_USAGE = "Usage: /history [done|pending|failed|refunded] [YYYY-MM-DD] [YYYY-MM-DD]"
+STATEMENT_USAGE = "Usage: /statement [csv|pdf] [done|pending|failed|refunded] [YYYY-MM-DD] [YYYY-MM-DD]"
+
+@router.command("/history", auth=True)
+async def cmd_history(ctx):
+    try:
+        flt = HistoryFilter.parse(ctx.args.split())
+    except ValueError:
+        await send_message(ctx.chat_id, HISTORY_USAGE)
+        return
+    rows, has_older, has_newer = await fetch_page(ctx.session, ctx.user.phone_number, flt)
+    text, keyboard = render_page(rows, flt, has_older, has_newer)
+    await send_history_page(ctx.chat_id, text, keyboard)
+
+async def show_history_page(chat_id, message_id, action_data, session):
+    """
+    "Older" / "Newer" buttons: replaces the page in place.
+    """
+    user = await session.get(User, chat_id)
+    if not user:
+        return
+    try:
+        direction, anchor_id, flt = parse_page_callback(action_data)
+    except ValueError:
+        return
+    rows, has_older, has_newer = await fetch_page(session, user.phone_number, flt, anchor_id, direction)
+    text, keyboard = render_page(rows, flt, has_older, has_newer)
+    await send_history_page(chat_id, text, keyboard, message_id=message_id)
+
+@router.command("/statement", auth=True)
+async def cmd_statement(ctx):
+    words = ctx.args.split()
+    fmt = "csv"
+    if words and words[0].lower() in STATEMENT_FORMATS:
+        fmt = words.pop(0).lower()
+    try:
+        flt = HistoryFilter.parse(words)
+    except ValueError:
+        await send_message(ctx.chat_id, STATEMENT_USAGE)
+        return
+
+    await send_message(ctx.chat_id, "⏳ Preparing your statement...")
+    phone = ctx.user.phone_number
+    title = f"SikaSwift statement for {phone}"
+    if flt.since or flt.until:
+        title += f", {flt.since:%d-%b-%Y} to" if flt.since else ", up to"
+        title += f" {flt.until:%d-%b-%Y}" if flt.until else " today"
+    try:
+        document, count = await build_statement(stream_statement_rows(ctx.session, phone, flt), fmt, title)
+    except StatementTooLarge:
+        await send_message(ctx.chat_id, "📦 That statement is too large to send. Pick a shorter date range.")
+        return
+
+    with document:
+        if not count:
+            await send_message(ctx.chat_id, "📭 **No transactions found.**")
+            return
+        filename = f"statement_{phone}_{datetime.utcnow():%Y%m%d}.{fmt}"
+        resp = await send_document(ctx.chat_id, document, filename, caption=f"🧾 {count} transactions",
+                                   mime=STATEMENT_FORMATS[fmt].mime)
+    if not resp or not resp.get("ok"):
+        await send_message(ctx.chat_id, "❌ Could not send the statement. Please try again.")
+
+# --- DEEP LINKS (/start <payload>) ---
+
+@router.deep_link("pay_", load_user=True)
+async def link_pay(ctx):
+    chat_id, session, user = ctx.chat_id, ctx.session, ctx.user
+    try:
+        target = ctx.args
+        if not user:
+            await request_phone_number(chat_id)
+            return
+        verification = await resolve_mobile_money(target)
+        name = verification["account_name"] if verification["status"] else "Unknown"
+        await state_store.set(session, chat_id, "AWAITING_QR_AMOUNT", RecipientDraft(recipient=target))
+        await send_message(chat_id, f"✅ **Recipient:** {name}\n**Enter Amount:**")
+    except:
+        await send_message(chat_id, "❌ Invalid QR.")
+
+# --- FREE TEXT (OTP, send money, chat) ---
+
+@router.text()
+async def on_text(ctx):
+    chat_id, session, user, text = ctx.chat_id, ctx.session, ctx.user, ctx.text
+
+    # OTP CHECK
+    if user:
+        statement = select(Transaction).where(Transaction.sender_phone == user.phone_number, Transaction.status == "WAITING_FOR_OTP")
+        pending_txn = (await session.exec(statement)).first()
+        if pending_txn:
+            await handle_otp_entry(chat_id, text, pending_txn, session)
+            return
+
+    # A PIN nobody asked for: delete it, never parse or chat about it
+    if looks_like_pin(text):
+        await delete_message(chat_id, ctx.message_id)
+        await send_message(chat_id, "🔐 No PIN was requested. Start a payment first, e.g. 'Send 50 to 055...'")
+        return
+
+    # SEND MONEY LOGIC
+    nlp_result = await parse_message(text)
+    if nlp_result["intent"] == "SEND_MONEY":
+        if nlp_result["amount"] and nlp_result["recipient"]:
+
+            recipient_input = nlp_result["recipient"]
+            final_number = None
+
+            if recipient_input.isdigit() and len(recipient_input) >= 10:
+                final_number = recipient_input
+            else:
+                contact = (await session.exec(select(Beneficiary).where(Beneficiary.user_id == chat_id, Beneficiary.name == recipient_input.lower()))).first()
+                if contact:
+                    final_number = contact.phone_number
+                    await send_message(chat_id, f"📖 Found: **{contact.name.title()}** ({final_number})")
                 else:
-                    user.state = "IDLE"
-                    session.add(user)
-                    session.commit()
-                    await send_message(chat_id, "❌ Number mismatch.")
-                return {"status": "ok"}
-            
+                    await send_message(chat_id, f"❌ Unknown contact '{recipient_input}'.\nUse `/save {recipient_input} 055...`")
+                    return
+
             if not user:
-                user = User(telegram_id=chat_id, phone_number=phone, state="IDLE")
-                session.merge(user)
-                session.commit()
-                await send_message(chat_id, "✅ Phone saved! **Type /setpin to secure your account.**")
-                return {"status": "ok"}
-            
-        # 3. TEXT PROCESSING
-        if "text" in msg:
-            text = msg["text"].strip()
-            user = session.get(User, chat_id)
-            
-            if user:
-                # AUTO-DELETE PIN
-                if user.state in ["AWAITING_NEW_PIN", "AWAITING_PIN_AUTH"] and len(text) == 4 and text.isdigit():
-                    await delete_message(chat_id, message_id)
-
-                # STATE: SET PIN
-                if user.state == "AWAITING_NEW_PIN":
-                    if len(text) == 4 and text.isdigit():
-                        user.pin_hash = hash_pin(text)
-                        user.state = "IDLE"
-                        session.add(user)
-                        session.commit()
-                        await send_message(chat_id, "🔐 **PIN Set Successfully!**")
-                    else:
-                        await send_message(chat_id, "❌ PIN must be 4 digits.")
-                    return {"status": "ok"}
-
-                # STATE: VERIFY PIN (PAYMENT)
-                if user.state == "AWAITING_PIN_AUTH":
-                    if verify_pin(text, user.pin_hash):
-                        try:
-                            amount, recipient = user.temp_data.split("|")
-                            amount = float(amount)
-                            user.state = "IDLE"
-                            user.temp_data = None
-                            session.add(user)
-                            session.commit()
-                            
-                            await send_message(chat_id, "🔓 **PIN Verified.** Processing...")
-                            await execute_charge(chat_id, user, amount, recipient, session)
-                        except:
-                            await send_message(chat_id, "❌ Error. Try again.")
-                            user.state = "IDLE"
-                            session.add(user)
-                            session.commit()
-                    else:
-                        await send_message(chat_id, "❌ **Wrong PIN.** Cancelled.")
-                        user.state = "IDLE"
-                        user.temp_data = None
-                        session.add(user)
-                        session.commit()
-                    return {"status": "ok"}
-
-                # STATE: EDIT AMOUNT (UX)
-                if user.state == "AWAITING_EDIT_AMOUNT":
-                    clean_text = text.replace('.', '', 1)
-                    if clean_text.isdigit():
-                        new_amount = float(text)
-                        recipient_phone = user.temp_data # We stored phone here in the callback
-                        
-                        user.state = "IDLE"
-                        user.temp_data = None
-                        session.add(user)
-                        session.commit()
-                        
-                        # Re-confirm with new amount
-                        verification = await resolve_mobile_money(recipient_phone)
-                        name = verification["account_name"] if verification["status"] else "Unknown"
-                        
-                        await send_message(chat_id, "🔄 Updating...")
-                        await send_name_confirmation(chat_id, new_amount, recipient_phone, name)
-                    else:
-                        await send_message(chat_id, "❌ Invalid amount. Please enter a number (e.g. 50).")
-                    return {"status": "ok"}
-
-                # STATE: QR AMOUNT
-                if user.state == "AWAITING_QR_AMOUNT":
-                    if text.replace('.', '', 1).isdigit():
-                        amount = float(text)
-                        recipient = user.temp_data
-                        
-                        user.state = "IDLE"
-                        user.temp_data = None
-                        session.add(user)
-                        session.commit()
-                        
-                        verification = await resolve_mobile_money(recipient)
-                        name = verification["account_name"] if verification["status"] else "Unknown"
-                        await send_name_confirmation(chat_id, amount, recipient, name)
-                    else:
-                        await send_message(chat_id, "❌ Invalid amount.")
-                    return {"status": "ok"}
-                
-                # OTP CHECK
-                statement = select(Transaction).where(Transaction.sender_phone == user.phone_number, Transaction.status == "WAITING_FOR_OTP")
-                pending_txn = session.exec(statement).first()
-                if pending_txn:
-                    await handle_otp_entry(chat_id, text, pending_txn, session)
-                    return {"status": "ok"}
-
-            # --- COMMANDS ---
-
-            if text.startswith("/save"):
-                try:
-                    parts = text.split()
-                    if len(parts) != 3:
-                        await send_message(chat_id, "⚠️ Usage: `/save Mom 0555111222`")
-                        return {"status": "ok"}
-                    
-                    name_alias = parts[1].lower()
-                    number = parts[2]
-                    
-                    if not number.isdigit() or len(number) != 10:
-                        await send_message(chat_id, "❌ Invalid phone number.")
-                        return {"status": "ok"}
-
-                    contact = Beneficiary(user_id=chat_id, name=name_alias, phone_number=number)
-                    session.add(contact)
-                    session.commit()
-                    await send_message(chat_id, f"✅ Saved **{parts[1]}** ({number})")
-                except:
-                    await send_message(chat_id, "❌ Error saving contact.")
-                return {"status": "ok"}
-
-            if text == "/contacts":
-                contacts = session.exec(select(Beneficiary).where(Beneficiary.user_id == chat_id)).all()
-                if not contacts:
-                    await send_message(chat_id, "📭 No contacts. Use `/save Mom 055...`")
-                else:
-                    msg = "📖 **My Contacts**\n\n"
-                    for c in contacts:
-                        msg += f"👤 **{c.name.title()}**: {c.phone_number}\n"
-                    await send_message(chat_id, msg)
-                return {"status": "ok"}
-
-            if text == "/start":
-                await send_message(chat_id, "👋 **Welcome!**\n\n/setpin\n/save [Name] [Number]\n/myqr\n/history")
-                return {"status": "ok"}
-            
-            if text == "/setpin":
-                if not user: await request_phone_number(chat_id)
-                else:
-                    user.state = "AWAITING_NEW_PIN"
-                    session.add(user)
-                    session.commit()
-                    await send_message(chat_id, "🔐 Enter **4-digit PIN**:")
-                return {"status": "ok"}
-
-            if text == "/resetpin":
-                if not user: await send_message(chat_id, "Register first.")
-                else:
-                    user.state = "AWAITING_RESET_AUTH"
-                    session.add(user)
-                    session.commit()
-                    await request_phone_number(chat_id) 
-                    await send_message(chat_id, "⚠️ **Security Check**\nTap 'Share Phone Number' below.")
-                return {"status": "ok"}
-            
-            if text == "/myqr":
-                if not user:
-                    await send_message(chat_id, "Register first.")
-                    return {"status": "ok"}
-                qr_file = generate_payment_qr(user.phone_number)
-                await send_photo(chat_id, qr_file, caption=f"Scan to pay **{user.phone_number}**")
-                try: os.remove(qr_file) 
-                except: pass
-                return {"status": "ok"}
-
-            # NEW: HISTORY COMMAND
-            if text == "/history":
-                if not user:
-                    await send_message(chat_id, "Please register first.")
-                    return {"status": "ok"}
-
-                statement = select(Transaction).where(
-                    Transaction.sender_phone == user.phone_number
-                ).order_by(Transaction.created_at.desc()).limit(5)
-                
-                txns = session.exec(statement).all()
-
-                if not txns:
-                    await send_message(chat_id, "📭 **No transactions found.**")
-                else:
-                    msg = "📜 **Recent Activity**\n\n"
-                    for t in txns:
-                        icon = "✅"
-                        if "FAIL" in t.status or "REFUND" in t.status: icon = "❌"
-                        elif "WAIT" in t.status or "PENDING" in t.status: icon = "⏳"
-                        
-                        msg += f"{icon} **GHS {t.amount:.2f}** ➡ {t.recipient_phone}\n"
-                        msg += f"📅 {t.created_at.strftime('%d-%b %H:%M')} | {t.status}\n\n"
-                    
-                    await send_message(chat_id, msg)
-                return {"status": "ok"}
-            
-            if text.startswith("/start pay_"):
-                try:
-                    target = text.split("pay_")[1]
-                    if not user:
-                        await request_phone_number(chat_id)
-                        return {"status": "ok"}
-                    verification = await resolve_mobile_money(target)
-                    name = verification["account_name"] if verification["status"] else "Unknown"
-                    user.state = "AWAITING_QR_AMOUNT"
-                    user.temp_data = target
-                    session.add(user)
-                    session.commit()
-                    await send_message(chat_id, f"✅ **Recipient:** {name}\n**Enter Amount:**")
-                except:
-                    await send_message(chat_id, "❌ Invalid QR.")
-                return {"status": "ok"}
-
-            # SEND MONEY LOGIC
-            nlp_result = parse_message(text)
-            if nlp_result["intent"] == "SEND_MONEY":
-                if nlp_result["amount"] and nlp_result["recipient"]:
-                    
-                    recipient_input = nlp_result["recipient"]
-                    final_number = None
-
-                    if recipient_input.isdigit() and len(recipient_input) >= 10:
-                        final_number = recipient_input
-                    else:
-                        contact = session.exec(select(Beneficiary).where(Beneficiary.user_id == chat_id, Beneficiary.name == recipient_input.lower())).first()
-                        if contact:
-                            final_number = contact.phone_number
-                            await send_message(chat_id, f"📖 Found: **{contact.name.title()}** ({final_number})")
-                        else:
-                            await send_message(chat_id, f"❌ Unknown contact '{recipient_input}'.\nUse `/save {recipient_input} 055...`")
-                            return {"status": "ok"}
-
-                    if not user:
-                        await request_phone_number(chat_id)
-                        return {"status": "ok"}
-                    
-                    if not user.pin_hash:
-                        await send_message(chat_id, "⚠️ Set a PIN first: /setpin")
-                        return {"status": "ok"}
-
-                    await send_message(chat_id, "🔍 Verifying recipient...")
-                    verification = await resolve_mobile_money(final_number)
-                    
-                    if verification["status"]:
-                        await send_name_confirmation(chat_id, nlp_result["amount"], final_number, verification["account_name"])
-                    else:
-                        await send_message(chat_id, "⚠️ Could not verify name.")
-                
-                elif nlp_result["intent"] == "SEND_MONEY":
-                    await send_message(chat_id, "Try: 'Send 50 to 055...'")
-            
+                await request_phone_number(chat_id)
+                return
+
+            if not user.pin_hash:
+                await send_message(chat_id, "⚠️ Set a PIN first: /setpin")
+                return
+
+            await send_message(chat_id, "🔍 Verifying recipient...")
+            verification = await resolve_mobile_money(final_number)
+
+            if verification["status"]:
+                await send_name_confirmation(chat_id, nlp_result["amount"], final_number, verification["account_name"])
             else:
-                # CHAT MODE
-                ai_reply = get_ai_response(text)
-                await send_message(chat_id, ai_reply)
+                await send_message(chat_id, "⚠️ Could not verify name.")
 
-    return {"status": "ok"}
+        elif nlp_result["intent"] == "SEND_MONEY":
+            await send_message(chat_id, "Try: 'Send 50 to 055...'")
+
+    elif nlp_result["intent"] == "SPLIT_BILL":
+        recipients = nlp_result["recipient"]
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        if nlp_result["amount"] and recipients and len(recipients) >= 2:
+            await start_split_bill(ctx, nlp_result["amount"], recipients)
+        else:
+            await send_message(chat_id, "Try: 'Split 100 between Kofi and Ama'")
+
+    else:
+        # CHAT MODE
+        ai_reply = await get_ai_response(text)
+        await send_message(chat_id, ai_reply)
+
+# --- SPLIT BILL ---
+
+def split_amount(total: float, parts: int) -> list:
+    """
+    Equal shares in pesewas; the first shares absorb the remainder (100 / 3 -> 33.34, 33.33, 33.33).
+    """
+    base, extra = divmod(to_pesewas(total), parts)
+    return [(base + (1 if i < extra else 0)) / 100 for i in range(parts)]
+
+async def start_split_bill(ctx, amount: float, recipients: list):
+    chat_id, session, user = ctx.chat_id, ctx.session, ctx.user
+    if not user:
+        await request_phone_number(chat_id)
+        return
+    if not user.pin_hash:
+        await send_message(chat_id, "⚠️ Set a PIN first: /setpin")
+        return
+    if len(recipients) > SPLIT_MAX_RECIPIENTS:
+        await send_message(chat_id, f"⚠️ You can split between at most {SPLIT_MAX_RECIPIENTS} people.")
+        return
+
+    # Saved contacts in one query
+    names = [r.lower() for r in recipients if not (r.isdigit() and len(r) >= 10)]
+    contacts = {}
+    if names:
+        rows = (await session.exec(select(Beneficiary).where(Beneficiary.user_id == chat_id, Beneficiary.name.in_(names)))).all()
+        contacts = {c.name: c.phone_number for c in rows}
+    unknown = [n for n in names if n not in contacts]
+    if unknown:
+        missing = ", ".join(f"'{n}'" for n in unknown)
+        await send_message(chat_id, f"❌ Unknown contact {missing}.\nUse `/save {unknown[0]} 055...`")
+        return
+    numbers = list(dict.fromkeys(contacts.get(r.lower(), r) for r in recipients))
+    if len(numbers) < 2:
+        await send_message(chat_id, "Try: 'Split 100 between Kofi and Ama'")
+        return
+
+    # Verify every name at once, a few Paystack calls at a time
+    await send_message(chat_id, f"🔍 Verifying {len(numbers)} recipients...")
+    slots = asyncio.Semaphore(SPLIT_RESOLVE_CONCURRENCY)
+    async def resolve(number):
+        async with slots:
+            return await resolve_mobile_money(number)
+    results = await asyncio.gather(*(resolve(n) for n in numbers))
+
+    failed = [n for n, r in zip(numbers, results) if not r["status"]]
+    if failed:
+        await send_message(chat_id, f"⚠️ Could not verify: {', '.join(failed)}")
+        return
+
+    shares = split_amount(amount, len(numbers))
+    draft = SplitDraft(total=amount, legs=[
+        SplitLeg(recipient=n, name=r["account_name"], amount=share)
+        for n, r, share in zip(numbers, results, shares)
+    ])
+    await state_store.set(session, chat_id, "AWAITING_SPLIT_CONFIRM", draft)
+    await send_split_confirmation(chat_id, amount, [(leg.name, leg.recipient, leg.amount) for leg in draft.legs])
 
 # --- HELPER FUNCTIONS ---
 
@@ -343,139 +580,458 @@ async def handle_callback(callback, session):
     action_data = callback["data"]
     
     await answer_callback(callback_id) 
+    if action_data.startswith("hist|"):
+        await show_history_page(chat_id, message_id, action_data, session)
+        return
     await delete_message_buttons(chat_id, message_id)
     
     if action_data == "cancel":
+        await state_store.clear(session, chat_id)
         await send_message(chat_id, "🚫 Cancelled.")
         return
 
+    if action_data == "split_ok":
+        state = await state_store.get(session, chat_id)
+        if not state or state.name != "AWAITING_SPLIT_CONFIRM" or not isinstance(state.payload, SplitDraft):
+            await send_message(chat_id, "⌛ This split has expired. Send it again.")
+            return
+        await state_store.set(session, chat_id, "AWAITING_SPLIT_PIN", state.payload)
+        await send_message(chat_id, "🔒 **Security Check**\nEnter **4-digit PIN**:")
+        return
+
     # NEW: HANDLE EDIT AMOUNT
     if action_data.startswith("edit_"):
         target_phone = action_data.split("_")[1]
-        user = session.get(User, chat_id)
-        if user:
-            user.state = "AWAITING_EDIT_AMOUNT"
-            user.temp_data = target_phone
-            session.add(user)
-            session.commit()
+        if await state_store.set(session, chat_id, "AWAITING_EDIT_AMOUNT", RecipientDraft(recipient=target_phone)):
             await send_message(chat_id, f"📝 **Enter New Amount** for {target_phone}:")
         return
 
     if action_data.startswith("pay_"):
         parts = action_data.split("_")
-        amount = parts[1]
+        amount = float(parts[1])
         recipient = parts[2]
-        
-        user = session.get(User, chat_id)
-        if not user: return
 
-        user.state = "AWAITING_PIN_AUTH"
-        user.temp_data = f"{amount}|{recipient}"
-        session.add(user)
-        session.commit()
+        if not await state_store.set(session, chat_id, "AWAITING_PIN_AUTH", PaymentDraft(amount=amount, recipient=recipient)):
+            return
         
         await send_message(chat_id, "🔒 **Security Check**\nEnter **4-digit PIN**:")
 
-async def execute_charge(chat_id, user, amount, recipient, session):
+async def execute_charge(chat_id, user, amount, recipient, session, legs=None):
+    """
+    Debits the user once. With `legs` (a split bill) the charged row is a parent
+    (no recipient_phone of its own) and each leg gets a child Transaction that
+    is paid out after the debit.
+    """
+    # Saved before calling Paystack: if the call times out after Paystack accepted
+    # it, the charge.success webhook (or the reconciler) still finds this row.
+    ref = new_reference("txn")
+    new_txn = Transaction(telegram_chat_id=chat_id, sender_phone=user.phone_number, recipient_phone=recipient or "", amount=amount, status="PENDING_DEBIT", paystack_reference=ref)
+    session.add(new_txn)
+    for leg in legs or []:
+        session.add(Transaction(telegram_chat_id=chat_id, sender_phone=user.phone_number, recipient_phone=leg.recipient, amount=leg.amount, status="INIT", parent_id=new_txn.id))
+    await session.commit()
+
     await send_message(chat_id, f"⏳ Prompt sent to {user.phone_number}...")
-    response = await initiate_charge(user.phone_number, amount)
-    
+    response = await initiate_charge(user.phone_number, amount, reference=ref)
+
     if response.get("status"):
-        ref = response["data"]["reference"]
-        p_status = response["data"].get("status")
-        txn_status = "WAITING_FOR_OTP" if p_status == "send_otp" else "PENDING_DEBIT"
-        msg = "🔐 **OTP Required!**" if p_status == "send_otp" else "✅ **Prompt Sent.** Approve on phone."
-        new_txn = Transaction(telegram_chat_id=chat_id, sender_phone=user.phone_number, recipient_phone=recipient, amount=amount, status=txn_status, paystack_reference=ref)
-        session.add(new_txn)
-        session.commit()
-        await send_message(chat_id, msg)
+        if response["data"].get("status") == "send_otp":
+            # Only from PENDING_DEBIT: a webhook may already have moved the row on
+            await transition(session, new_txn.id, "WAITING_FOR_OTP", expected=("PENDING_DEBIT",))
+            await session.commit()
+            await send_message(chat_id, "🔐 **OTP Required!**")
+        else:
+            await send_message(chat_id, "✅ **Prompt Sent.** Approve on phone.")
+    elif response.get("transient") and not response.get("unsent"):
+        # No answer: Paystack may have sent the prompt. The reconciler settles the row either way.
+        await send_message(chat_id, "⏳ We could not confirm the prompt. If it reaches your phone, approve it and we'll complete the transfer.")
     else:
+        await transition(session, new_txn.id, "DEBIT_FAILED", expected=("PENDING_DEBIT",))
+        await session.commit()
         await send_message(chat_id, f"❌ Charge Failed: {response.get('message')}")
 
 async def handle_otp_entry(chat_id, otp_code, txn, session):
     await send_message(chat_id, "🔄 Verifying OTP...")
     resp = await submit_otp(txn.paystack_reference, otp_code)
     if resp.get("status"):
-        txn.status = "DEBIT_SUCCESS"
-        session.add(txn)
-        session.commit()
+        # Only from WAITING_FOR_OTP: a webhook may already have moved the row on
+        await transition(session, txn.id, "DEBIT_SUCCESS", expected=("WAITING_FOR_OTP",))
+        await session.commit()
         await send_message(chat_id, "✅ Verified! Processing...")
     else:
-        await send_message(chat_id, f"❌ Wrong OTP.")
+        await send_message(chat_id, "❌ Wrong OTP.")
+
+# --- WEBHOOK (ACK FAST, DISBURSE IN BACKGROUND) ---
 
-# --- WEBHOOK (WITH AUTO-REFUND & ASYNC) ---
+PAYSTACK_EVENTS = {}
+paystack_event_stats = {}
+
+def paystack_event(*names: str):
+    """
+    Registers an async handler(data, session) for Paystack webhook event types.
+    """
+    def register(fn):
+        for name in names:
+            PAYSTACK_EVENTS[name] = fn
+        return fn
+    return register
 
 @app.post("/webhook")
-async def paystack_webhook(request: Request, session: Session = Depends(get_session)):
+async def paystack_webhook(request: Request, session: AsyncSession = Depends(get_session)):
     body = await request.body()
     signature = request.headers.get("x-paystack-signature")
     if not signature: return {"status": "denied"}
     if hmac.new(PAYSTACK_SECRET.encode('utf-8'), body, hashlib.sha512).hexdigest() != signature: return {"status": "denied"}
 
-    event_data = await request.json()
-    if event_data.get("event") == "charge.success":
-        data = event_data.get("data", {})
-        ref = data.get("reference")
-        txn = session.exec(select(Transaction).where(Transaction.paystack_reference == ref)).first()
-        
-        if txn and txn.status not in ["DISBURSING", "COMPLETE", "REFUNDED"]:
-            txn.status = "DEBIT_SUCCESS"
+    event_data = json.loads(body)
+    event = event_data.get("event")
+    handler = PAYSTACK_EVENTS.get(event)
+    key = event if handler else "ignored"
+    paystack_event_stats[key] = paystack_event_stats.get(key, 0) + 1
+    if handler:
+        await handler(event_data.get("data") or {}, session)
+    return {"status": "received"}
+
+async def find_transfer_txn(session, data: dict):
+    """
+    The Transaction a transfer.* event is about. Our transfer reference is
+    trf_<transaction id> (a primary-key hit); otherwise Paystack's transfer_code.
+    """
+    ref = data.get("reference") or ""
+    if ref.startswith("trf_"):
+        try:
+            txn = await session.get(Transaction, uuid.UUID(ref[len("trf_"):]))
+        except ValueError:
+            txn = None
+        if txn:
+            return txn
+    code = data.get("transfer_code")
+    if not code:
+        return None
+    return (await session.exec(select(Transaction).where(Transaction.transfer_code == code))).first()
+
+async def find_refunded_txn(session, data: dict):
+    ref = data.get("transaction_reference") or (data.get("transaction") or {}).get("reference")
+    if not ref:
+        return None
+    return (await session.exec(select(Transaction).where(Transaction.paystack_reference == ref))).first()
+
+# Each handler moves the row with a compare-and-set transition, so of several
+# concurrent deliveries of one event (or workers/processes) exactly one acts on it.
+
+@paystack_event("charge.success")
+async def on_charge_success(data, session):
+    ref = data.get("reference")
+    txn = (await session.exec(select(Transaction).where(Transaction.paystack_reference == ref))).first()
+    if not txn or not await transition(session, txn.id, "PENDING_DISBURSE"):
+        return
+
+    # The status change, the job and the notice commit together;
+    # the worker pool does the slow Paystack/receipt work.
+    enqueue(session, "disburse", {"transaction_id": str(txn.id), "event": "charge.success"}, delay=DISBURSE_DELAY)
+    legs = (await session.exec(select(func.count()).where(Transaction.parent_id == txn.id))).one()
+    queue_message(session, txn.telegram_chat_id,
+                  f"✅ **Received!** Sending to {legs} recipients..." if legs else "✅ **Received!** Sending to recipient...")
+    await session.commit()
+    notify_jobs()
+
+@paystack_event("transfer.success")
+async def on_transfer_success(data, session):
+    txn = await find_transfer_txn(session, data)
+    # Not ours, already final, or not yet recorded by the disburse job (the reconciler catches that)
+    if not txn or not await transition(session, txn.id, "COMPLETE", expected=("DISBURSING",)):
+        return
+    if txn.parent_id:
+        await complete_split_parents(session, [txn.parent_id])
+    await session.commit()
+
+@paystack_event("transfer.failed", "transfer.reversed")
+async def on_transfer_failed(data, session):
+    """
+    Paystack gave up on (or clawed back) a transfer it had accepted: refund the sender.
+    """
+    txn = await find_transfer_txn(session, data)
+    if not txn or not await transition(session, txn.id, "TRANSFER_FAILED", expected=("DISBURSING", "COMPLETE")):
+        return
+    enqueue(session, "refund", {"transaction_id": str(txn.id), "event": data.get("status") or "transfer.failed"})
+    await session.commit()
+    notify_jobs()
+
+@paystack_event("refund.processed")
+async def on_refund_processed(data, session):
+    # A refund whose API call looked like a failure went through after all
+    txn = await find_refunded_txn(session, data)
+    if not txn or not await transition(session, txn.id, "REFUNDED", expected=("REFUND_FAILED",)):
+        return
+    queue_message(session, txn.telegram_chat_id, f"✅ **Refund Successful.** GHS {txn.amount:.2f} is back in your wallet.")
+    await session.commit()
+
+def refunded_legs(legs: list, amount):
+    """
+    The REFUNDED legs a refund of `amount` pesewas paid back: one leg of that
+    amount, or every one of them when it is their total. Empty when neither fits.
+    """
+    refunded = [leg for leg in legs if leg.status == "REFUNDED"]
+    if amount is None:
+        return []
+    for leg in refunded:
+        if to_pesewas(leg.amount) == amount:
+            return [leg]
+    if refunded and sum(to_pesewas(leg.amount) for leg in refunded) == amount:
+        return refunded
+    return []
+
+@paystack_event("refund.failed")
+async def on_refund_failed(data, session):
+    txn = await find_refunded_txn(session, data)
+    if not txn or not await transition(session, txn.id, "REFUND_FAILED", expected=("REFUNDED", "PARTIAL_REFUND")):
+        return
+    # Split bills: only the legs this refund paid back, matched on the refunded amount
+    legs = (await session.exec(
+        select(Transaction).where(Transaction.parent_id == txn.id).order_by(Transaction.updated_at, Transaction.id)
+    )).all()
+    failed = refunded_legs(legs, data.get("amount"))
+    if failed:
+        await transition_many(session, [leg.id for leg in failed], "REFUNDED", "REFUND_FAILED")
+    elif any(leg.status == "REFUNDED" for leg in legs):
+        logger.warning(f"Refund failure of {data.get('amount')} on {txn.paystack_reference} matches no refunded leg")
+    queue_message(session, txn.telegram_chat_id, "❌ **Refund Failed.** Please contact support.")
+    await session.commit()
+    logger.error(f"Paystack refund failed for {txn.paystack_reference}: {data.get('status')}")
+
+# --- BACKGROUND JOBS ---
+# Jobs lock the Transaction row for their whole run (lock_transaction), move it
+# with set_status(), and queue notifications in the same commit. disburse_split
+# commits its payouts before refunding and locks the rows again for the refund.
+
+@job_handler("disburse")
+async def disburse_transaction(job, session):
+    """
+    Background job: Phase 2 (Credit) with auto-refund.
+    Retried by the job queue if it raises.
+    """
+    payload = load_payload(job)
+    txn = await lock_transaction(session, uuid.UUID(payload["transaction_id"]))
+    if not txn or txn.status != "PENDING_DISBURSE":
+        return  # Already handled (duplicate event or earlier attempt finished)
+
+    legs = await lock_legs(session, txn.id)
+    if legs:
+        return await disburse_split(job, session, txn, legs)
+
+    chat_id = txn.telegram_chat_id
+    transfer_ref = f"trf_{txn.id}"
+
+    # A previous attempt may have died (or timed out) after Paystack accepted the transfer.
+    if job.attempts > 1:
+        existing = await verify_transfer(transfer_ref)
+        if existing.get("transient"):
+            raise RuntimeError(f"Transfer {transfer_ref} not verified: {existing.get('message')}")
+        if existing.get("status"):
+            set_status(txn, "DISBURSING")
+            txn.transfer_code = existing["data"].get("transfer_code")
             session.add(txn)
-            session.commit()
-            
-            if txn.telegram_chat_id: 
-                await send_message(txn.telegram_chat_id, f"✅ **Received!** Sending to recipient...")
-            
-            await asyncio.sleep(2)
-            
-            # Async Create Recipient
-            recip = await create_transfer_recipient("Verified User", txn.recipient_phone)
-            
-            if recip.get("status"):
-                txn.transfer_code = recip['data']['recipient_code']
-                
-                # Async Initiate Transfer
-                trans = await initiate_transfer(txn.amount, txn.transfer_code)
-                
-                if trans.get("status"):
-                    txn.status = "DISBURSING"
-                    if txn.telegram_chat_id:
-                        f = generate_receipt(txn.sender_phone, txn.recipient_phone, txn.amount, txn.paystack_reference)
-                        await send_photo(txn.telegram_chat_id, f, caption="✅ **Transfer Complete!**")
-                        try: os.remove(f)
-                        except: pass
-                else:
-                    # TRANSFER FAILED -> REFUND
-                    error_msg = trans.get('message', 'Unknown error')
-                    txn.status = "TRANSFER_FAILED"
-                    if txn.telegram_chat_id:
-                        await send_message(txn.telegram_chat_id, f"⚠️ Transfer Failed: {error_msg}\n🔄 Initiating Refund...")
-                    
-                    # Async Auto-Reversal
-                    refund = await refund_charge(txn.paystack_reference)
-                    if refund.get("status"):
-                        txn.status = "REFUNDED"
-                        if txn.telegram_chat_id: await send_message(txn.telegram_chat_id, "✅ **Refund Successful.** Check your wallet.")
-                    else:
-                        txn.status = "REFUND_FAILED"
-                        if txn.telegram_chat_id: await send_message(txn.telegram_chat_id, "❌ **Refund Failed.** Please contact support.")
+            await session.commit()
+            return
+        # Otherwise Paystack has no transfer with this reference: safe to send it
+
+    # Reuse the stored Paystack recipient for this number (creates one on a miss)
+    recipient_code = await get_recipient_code(session, txn.recipient_phone)
+    
+    if recipient_code:
+        # Async Initiate Transfer (reference makes retries idempotent)
+        trans = await initiate_transfer(txn.amount, recipient_code, reference=transfer_ref)
+
+        if not trans.get("status") and is_stale_recipient_error(trans):
+            # Stored code was rejected -> create a fresh recipient and try once more
+            recipient_code = await get_recipient_code(session, txn.recipient_phone, refresh=True)
+            if recipient_code:
+                trans = await initiate_transfer(txn.amount, recipient_code, reference=transfer_ref)
+
+        if trans.get("transient"):
+            # No definite answer: Paystack may have queued it. The retry verifies before re-sending.
+            raise RuntimeError(f"Transfer {transfer_ref} not confirmed: {trans.get('message')}")
+
+        if trans.get("status"):
+            set_status(txn, "DISBURSING")
+            # Paystack's TRF_ code: what transfer.* webhooks are matched on
+            txn.transfer_code = trans["data"].get("transfer_code")
+            queue_receipt(session, chat_id, txn.sender_phone, txn.recipient_phone, txn.amount, txn.paystack_reference,
+                          caption="✅ **Transfer Complete!**")
+        else:
+            # TRANSFER FAILED -> REFUND
+            set_status(txn, "TRANSFER_FAILED")
+            queue_message(session, chat_id, f"⚠️ Transfer Failed: {trans.get('message', 'Unknown error')}\n🔄 Initiating Refund...")
+            await refund_in_full(session, txn)
+    else:
+        # RECIPIENT FAIL -> REFUND
+        set_status(txn, "RECIPIENT_FAIL")
+        queue_message(session, chat_id, "⚠️ System Error (Recipient).\n🔄 Initiating Refund...")
+        await refund_in_full(session, txn)
+
+    session.add(txn)
+    await session.commit()
+
+async def refund_in_full(session, txn):
+    # Async Auto-Reversal
+    refund = await refund_charge(txn.paystack_reference)
+    if refund.get("transient"):
+        raise RuntimeError(f"Refund not confirmed: {refund.get('message')}")
+    if refund.get("status"):
+        set_status(txn, "REFUNDED")
+        queue_message(session, txn.telegram_chat_id, "✅ **Refund Successful.** Check your wallet.")
+    else:
+        set_status(txn, "REFUND_FAILED")
+        queue_message(session, txn.telegram_chat_id, "❌ **Refund Failed.** Please contact support.")
 
+@job_handler("refund")
+async def refund_transaction(job, session):
+    """
+    Background job: refunds a transfer Paystack failed or reversed after accepting it.
+    A split leg is refunded as a partial refund of its parent's charge.
+    """
+    txn_id = uuid.UUID(load_payload(job)["transaction_id"])
+    txn = await session.get(Transaction, txn_id)
+    if not txn:
+        return
+    # Parent before leg, the same lock order as disburse_split
+    parent = await lock_transaction(session, txn.parent_id) if txn.parent_id else None
+    txn = await lock_transaction(session, txn_id)
+    if txn.status != "TRANSFER_FAILED":
+        return
+
+    if parent:
+        refund = await refund_charge(parent.paystack_reference, amount_ghs=txn.amount)
+    else:
+        refund = await refund_charge(txn.paystack_reference)
+    if refund.get("transient"):
+        raise RuntimeError(f"Refund not confirmed: {refund.get('message')}")
+
+    chat_id = txn.telegram_chat_id
+    queue_message(session, chat_id, f"⚠️ Transfer of GHS {txn.amount:.2f} to {txn.recipient_phone} failed.\n🔄 Initiating Refund...")
+    if refund.get("status"):
+        set_status(txn, "REFUNDED")
+        if parent:
+            await settle_split_refund(session, parent, txn)
+        queue_message(session, chat_id, "✅ **Refund Successful.** Check your wallet.")
+    else:
+        set_status(txn, "REFUND_FAILED")
+        queue_message(session, chat_id, "❌ **Refund Failed.** Please contact support.")
+
+    session.add(txn)
+    await session.commit()
+
+async def settle_split_refund(session, parent, refunded_leg):
+    """
+    After a leg's refund: the parent is PARTIAL_REFUND, or REFUNDED once every leg has been refunded.
+    The caller holds the parent's lock, so sibling refund jobs run one at a time.
+    """
+    others = (await session.exec(
+        select(Transaction.status).where(Transaction.parent_id == parent.id, Transaction.id != refunded_leg.id)
+    )).all()
+    targets = ["PARTIAL_REFUND"]
+    if all(status == "REFUNDED" for status in others):
+        targets.append("REFUNDED")
+    for target in targets:
+        if can_transition(parent.status, target):
+            set_status(parent, target)
+    session.add(parent)
+
+async def disburse_split(job, session, parent, legs):
+    """
+    Pays out a split bill: one bulk transfer for every leg, then a partial
+    refund of whatever could not be sent.
+    """
+    chat_id = parent.telegram_chat_id
+    pending = [leg for leg in legs if leg.status == "INIT"]
+
+    if job.attempts > 1:
+        # Legs a previous attempt already handed to Paystack must not be sent twice
+        checks = await asyncio.gather(*(verify_transfer(f"trf_{leg.id}") for leg in pending))
+        if any(existing.get("transient") for existing in checks):
+            raise RuntimeError("Split transfers not verified; retrying before sending any")
+        for leg, existing in zip(pending, checks):
+            if existing.get("status"):
+                set_status(leg, "DISBURSING")
+                leg.transfer_code = existing["data"].get("transfer_code")
+        pending = [leg for leg in pending if leg.status == "INIT"]
+
+    # Outcomes are collected here and each leg's status is written once at the end
+    queued, no_recipient = {}, set()
+
+    async def send_bulk(batch, refresh=False):
+        """
+        One bulk transfer for `batch`; fills `queued` (leg id -> transfer code). Returns Paystack's errors.
+        """
+        transfers = []
+        for leg in batch:
+            code = await get_recipient_code(session, leg.recipient_phone, refresh=refresh)
+            if code:
+                transfers.append((leg.amount, code, f"trf_{leg.id}"))
             else:
-                # RECIPIENT FAIL -> REFUND
-                txn.status = "RECIPIENT_FAIL"
-                if txn.telegram_chat_id:
-                    await send_message(txn.telegram_chat_id, "⚠️ System Error (Recipient).\n🔄 Initiating Refund...")
-                
-                # Async Auto-Reversal
-                refund = await refund_charge(txn.paystack_reference)
-                if refund.get("status"):
-                    txn.status = "REFUNDED"
-                    if txn.telegram_chat_id: await send_message(txn.telegram_chat_id, "✅ **Refund Successful.**")
-                else:
-                    txn.status = "REFUND_FAILED"
-                    if txn.telegram_chat_id: await send_message(txn.telegram_chat_id, "❌ **Refund Failed.** Please contact support.")
+                no_recipient.add(leg.id)
+        if not transfers:
+            return []
+        result = await initiate_bulk_transfer(transfers)
+        if any(error.get("transient") for error in result["errors"]):
+            # Paystack may have queued that batch: the retry verifies every leg before re-sending
+            raise RuntimeError(f"Bulk transfer not confirmed: {result['errors'][0].get('message')}")
+        codes = {item.get("reference"): item.get("transfer_code") for item in result["data"]}
+        for leg in batch:
+            if f"trf_{leg.id}" in codes:
+                queued[leg.id] = codes[f"trf_{leg.id}"]
+        return result["errors"]
 
-            session.add(txn)
-            session.commit()
-            
-    return {"status": "received"}
\ No newline at end of file
+    errors = await send_bulk(pending)
+    if any(is_stale_recipient_error(e) for e in errors):
+        # Stored codes were rejected -> fresh recipients for the failed legs, one more try
+        await send_bulk([leg for leg in pending if leg.id not in queued and leg.id not in no_recipient], refresh=True)
+
+    for leg in pending:
+        if leg.id in queued:
+            set_status(leg, "DISBURSING")
+            leg.transfer_code = queued[leg.id]
+        else:
+            set_status(leg, "RECIPIENT_FAIL" if leg.id in no_recipient else "TRANSFER_FAILED")
+
+    sent = [leg for leg in legs if leg.status == "DISBURSING"]
+    failed = [leg for leg in legs if leg.status in ("TRANSFER_FAILED", "RECIPIENT_FAIL")]
+
+    if failed and pending:
+        # Record the payouts before refunding: a retry after a refund that timed out
+        # finds no INIT legs and goes straight back to the refund
+        for leg in legs:
+            session.add(leg)
+        await session.commit()
+        parent = await lock_transaction(session, parent.id)
+        legs = await lock_legs(session, parent.id)
+        sent = [leg for leg in legs if leg.status == "DISBURSING"]
+        failed = [leg for leg in legs if leg.status in ("TRANSFER_FAILED", "RECIPIENT_FAIL")]
+
+    if failed:
+        queue_message(session, chat_id, f"⚠️ {len(failed)} of {len(legs)} transfers failed.\n🔄 Refunding their share...")
+        refund = await refund_charge(parent.paystack_reference, amount_ghs=sum(leg.amount for leg in failed) if sent else None)
+        if refund.get("transient"):
+            raise RuntimeError(f"Refund not confirmed: {refund.get('message')}")
+        outcome = "REFUNDED" if refund.get("status") else "REFUND_FAILED"
+        for leg in failed:
+            set_status(leg, outcome)
+        if outcome == "REFUNDED":
+            set_status(parent, "PARTIAL_REFUND" if sent else "REFUNDED")
+            queue_message(session, chat_id, "✅ **Refund Successful.** Check your wallet.")
+        else:
+            set_status(parent, "REFUND_FAILED")
+            queue_message(session, chat_id, "❌ **Refund Failed.** Please contact support.")
+    else:
+        set_status(parent, "DISBURSING")
+
+    if sent:
+        summary = "\n".join(
+            f"{'✅' if leg.status == 'DISBURSING' else '❌'} {leg.recipient_phone}: GHS {leg.amount:.2f}" for leg in legs
+        )
+        queue_receipt(session, chat_id, parent.sender_phone, f"{len(sent)} recipients", sum(leg.amount for leg in sent),
+                      parent.paystack_reference, caption=f"✅ **Split Complete!**\n{summary}")
+
+    for row in [parent, *legs]:
+        session.add(row)
+    await session.commit()
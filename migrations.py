@@ -0,0 +1,336 @@
+"""
+Schema migrations.
+
+Each migration runs once per database and is recorded in `schema_migration`.
+Add new ones to the end of MIGRATIONS; never edit one that has shipped.
+Migrations describe their tables and columns themselves (see FROZEN TABLES)
+rather than reading models.py, so they do the same thing on every database.
+
+    python migrations.py              # apply pending migrations
+    python migrations.py status       # list applied / pending
+    python migrations.py reset --yes  # DEV ONLY: drop every table, then migrate
+
+Postgres indexes are built with CREATE INDEX CONCURRENTLY (no write lock on
+the table), so those migrations run outside a transaction. A Postgres
+advisory lock keeps two app instances from migrating at the same time.
+"""
+import sys
+import asyncio
+from datetime import datetime
+from sqlalchemy import (
+    Table, Column, String, DateTime, Integer, BigInteger, Float, Uuid, MetaData, ForeignKey, UniqueConstraint, Index,
+    select, insert, text, inspect,
+)
+from sqlmodel import SQLModel
+from sqlmodel.sql.sqltypes import AutoString
+
+from database import engine
+import models  # registers the tables on SQLModel.metadata
+
+_LOCK_KEY = 7_410_202_401  # arbitrary, shared by every instance
+
+_meta = MetaData()
+schema_migration = Table(
+    "schema_migration", _meta,
+    Column("version", String, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# Statuses a transaction can sit in while we are still waiting on the user or Paystack
+ACTIVE_STATUSES = ("INIT", "WAITING_FOR_OTP", "PENDING_DEBIT", "DEBIT_SUCCESS", "PENDING_DISBURSE", "DISBURSING")
+# Statuses the reconciler re-checks against Paystack (frozen copy of reconcile_utils.RECONCILE_STATUSES)
+RECONCILE_STATUSES = ("WAITING_FOR_OTP", "PENDING_DEBIT", "DEBIT_SUCCESS", "DISBURSING")
+
+class Migration:
+    def __init__(self, version: str, description: str, apply, transactional: bool = True):
+        self.version = version
+        self.description = description
+        self.apply = apply                  # apply(sync_connection)
+        self.transactional = transactional
+
+# --- HELPERS (all idempotent, so they are safe on a database the baseline just created) ---
+
+def _is_postgres(conn) -> bool:
+    return conn.dialect.name == "postgresql"
+
+def create_index(conn, name: str, table: str, columns, unique: bool = False, where: str = None):
+    """
+    CREATE [UNIQUE] INDEX IF NOT EXISTS; CONCURRENTLY on Postgres
+    (the migration must be transactional=False).
+    """
+    quote = conn.dialect.identifier_preparer.quote
+    concurrently = ""
+    if _is_postgres(conn):
+        concurrently = "CONCURRENTLY "
+        # A failed concurrent build leaves an INVALID index behind; IF NOT EXISTS would keep it.
+        invalid = conn.execute(text(
+            "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"
+        ), {"name": name}).first()
+        if invalid:
+            conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {quote(name)}")
+    sql = (
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX {concurrently}IF NOT EXISTS {quote(name)} "
+        f"ON {quote(table)} ({', '.join(quote(c) for c in columns)})"
+    )
+    if where:
+        sql += f" WHERE {where}"
+    conn.exec_driver_sql(sql)
+
+def add_column(conn, column):
+    """
+    ALTER TABLE ... ADD COLUMN for a model column (with its REFERENCES, if any),
+    unless it is already there.
+    """
+    table = column.table.name
+    existing = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column.name in existing:
+        return
+    quote = conn.dialect.identifier_preparer.quote
+    sql = f"ALTER TABLE {quote(table)} ADD COLUMN {quote(column.name)} {column.type.compile(dialect=conn.dialect)}"
+    for fk in column.foreign_keys:
+        sql += f" REFERENCES {quote(fk.column.table.name)} ({quote(fk.column.name)})"
+    conn.exec_driver_sql(sql)
+
+def drop_index(conn, name: str):
+    quote = conn.dialect.identifier_preparer.quote
+    concurrently = "CONCURRENTLY " if _is_postgres(conn) else ""
+    conn.exec_driver_sql(f"DROP INDEX {concurrently}IF EXISTS {quote(name)}")
+
+def _in_list(values) -> str:
+    return ", ".join(f"'{v}'" for v in values)
+
+# --- FROZEN TABLES ---
+# The tables as these migrations first created them. Never derived from
+# models.py: a later model change must not change what an old migration does.
+
+_frozen = MetaData()
+
+Table(
+    "user", _frozen,
+    Column("telegram_id", AutoString, primary_key=True),
+    Column("phone_number", AutoString, nullable=False),
+    Column("pin_hash", AutoString),
+    Column("state", AutoString, nullable=False),
+    Column("temp_data", AutoString),
+    Column("referred_by", AutoString),
+    Column("created_at", DateTime, nullable=False),
+)
+Table(
+    "beneficiary", _frozen,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", AutoString, ForeignKey("user.telegram_id"), nullable=False),
+    Column("name", AutoString, nullable=False),
+    Column("phone_number", AutoString, nullable=False),
+)
+Table(
+    "transaction", _frozen,
+    Column("id", Uuid, primary_key=True),
+    Column("telegram_chat_id", AutoString),
+    Column("sender_phone", AutoString, nullable=False),
+    Column("recipient_phone", AutoString, nullable=False),
+    Column("amount", Float, nullable=False),
+    Column("status", AutoString, nullable=False),
+    Column("paystack_reference", AutoString),
+    Column("transfer_code", AutoString),
+    Column("created_at", DateTime, nullable=False),
+    Column("updated_at", DateTime, nullable=False),
+)
+Table(
+    "transfer_recipient", _frozen,
+    Column("id", Integer, primary_key=True),
+    Column("phone_number", AutoString, nullable=False),
+    Column("bank_code", AutoString, nullable=False),
+    Column("recipient_code", AutoString, nullable=False),
+    Column("created_at", DateTime, nullable=False),
+    Column("updated_at", DateTime, nullable=False),
+    UniqueConstraint("phone_number", "bank_code"),
+)
+Table(
+    "job", _frozen,
+    Column("id", Integer, primary_key=True),
+    Column("kind", AutoString, nullable=False),
+    Column("payload", AutoString, nullable=False),
+    Column("status", AutoString, nullable=False),
+    Column("attempts", Integer, nullable=False),
+    Column("max_attempts", Integer, nullable=False),
+    Column("run_at", DateTime, nullable=False),
+    Column("locked_until", DateTime),
+    Column("last_error", AutoString),
+    Column("created_at", DateTime, nullable=False),
+    Column("updated_at", DateTime, nullable=False),
+)
+Table(
+    "processed_update", _frozen,
+    Column("update_id", BigInteger, primary_key=True, autoincrement=False),
+    Column("created_at", DateTime, nullable=False),
+    Index("ix_processed_update_created_at", "created_at"),
+)
+_BASELINE_TABLES = ("user", "beneficiary", "transaction", "transfer_recipient", "job", "processed_update")
+
+# Columns and tables added by later migrations
+_user_0003 = Table("user", MetaData(), Column("state_expires_at", DateTime))
+_transaction_0004 = Table(
+    "transaction", MetaData(),
+    Column("id", Uuid, primary_key=True),
+    Column("parent_id", Uuid, ForeignKey("transaction.id")),
+)
+_outbox_message = Table(
+    "outbox_message", MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("chat_id", AutoString, nullable=False),
+    Column("kind", AutoString, nullable=False),
+    Column("payload", AutoString, nullable=False),
+    Column("status", AutoString, nullable=False),
+    Column("attempts", Integer, nullable=False),
+    Column("run_at", DateTime, nullable=False),
+    Column("locked_until", DateTime),
+    Column("last_error", AutoString),
+    Column("created_at", DateTime, nullable=False),
+    Column("sent_at", DateTime),
+)
+
+# --- MIGRATIONS ---
+
+def _baseline(conn):
+    # Creates whatever tables are missing (no-op for tables an older create_all already made)
+    _frozen.create_all(conn, tables=[_frozen.tables[name] for name in _BASELINE_TABLES], checkfirst=True)
+
+def _hot_path_indexes(conn):
+    # Pending-OTP lookup on every text message; only the few active rows are indexed
+    create_index(conn, "ix_transaction_active_sender", "transaction", ["sender_phone", "status"],
+                 where=f"status IN ({_in_list(ACTIVE_STATUSES)})")
+    # /history: newest first per sender
+    create_index(conn, "ix_transaction_sender_created", "transaction", ["sender_phone", "created_at"])
+    # Paystack webhooks look transactions up by reference / transfer code
+    create_index(conn, "ux_transaction_paystack_reference", "transaction", ["paystack_reference"], unique=True)
+    create_index(conn, "ix_transaction_transfer_code", "transaction", ["transfer_code"],
+                 where="transfer_code IS NOT NULL")
+    # Contact lookup when a message names a saved beneficiary
+    create_index(conn, "ix_beneficiary_user_name", "beneficiary", ["user_id", "name"])
+    # Job claim: due PENDING jobs ordered by run_at
+    create_index(conn, "ix_job_status_run_at", "job", ["status", "run_at"])
+
+def _conversation_state_ttl(conn):
+    add_column(conn, _user_0003.c.state_expires_at)
+
+def _split_bill_legs(conn):
+    add_column(conn, _transaction_0004.c.parent_id)
+    create_index(conn, "ix_transaction_parent", "transaction", ["parent_id"], where="parent_id IS NOT NULL")
+
+def _reconcile_index(conn):
+    # Reconciler: keyset scan of stuck rows per status, oldest first
+    create_index(conn, "ix_transaction_status_updated", "transaction", ["status", "updated_at", "id"],
+                 where=f"status IN ({_in_list(RECONCILE_STATUSES)})")
+
+def _outbox(conn):
+    _outbox_message.create(conn, checkfirst=True)
+    # Relay claim: oldest open row per chat; SENT/DEAD rows drop out of the index
+    create_index(conn, "ix_outbox_message_open", "outbox_message", ["chat_id", "id"],
+                 where="status IN ('PENDING', 'SENDING')")
+    create_index(conn, "ix_outbox_message_created", "outbox_message", ["created_at"])
+
+def _history_keyset_index(conn):
+    # /history and /statement: keyset pages on (created_at, id) per sender, top-level rows only
+    create_index(conn, "ix_transaction_sender_history", "transaction", ["sender_phone", "created_at", "id"],
+                 where="parent_id IS NULL")
+    drop_index(conn, "ix_transaction_sender_created")  # superseded
+
+MIGRATIONS = [
+    Migration("0001", "baseline tables", _baseline),
+    Migration("0002", "hot-path indexes", _hot_path_indexes, transactional=False),
+    Migration("0003", "user.state_expires_at", _conversation_state_ttl),
+    Migration("0004", "transaction.parent_id", _split_bill_legs, transactional=False),
+    Migration("0005", "reconciler scan index", _reconcile_index, transactional=False),
+    Migration("0006", "outbox_message table", _outbox, transactional=False),
+    Migration("0007", "history keyset index", _history_keyset_index, transactional=False),
+]
+
+# --- RUNNER ---
+
+def _lock(conn):
+    if _is_postgres(conn):
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": _LOCK_KEY})
+
+def _unlock(conn):
+    if _is_postgres(conn):
+        conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _LOCK_KEY})
+
+def _applied(conn) -> dict:
+    _meta.create_all(conn, checkfirst=True)
+    rows = conn.execute(select(schema_migration.c.version, schema_migration.c.applied_at)).all()
+    return {version: applied_at for version, applied_at in rows}
+
+def _record(conn, migration: Migration):
+    conn.execute(insert(schema_migration).values(
+        version=migration.version, description=migration.description, applied_at=datetime.utcnow()
+    ))
+
+async def upgrade() -> list:
+    """
+    Applies pending migrations in order. Returns the versions applied.
+    """
+    done = []
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.run_sync(_lock)
+        try:
+            applied = await conn.run_sync(_applied)
+            for migration in MIGRATIONS:
+                if migration.version in applied:
+                    continue
+                if migration.transactional:
+                    async with engine.begin() as tx:
+                        await tx.run_sync(migration.apply)
+                        await tx.run_sync(_record, migration)
+                else:
+                    await conn.run_sync(migration.apply)
+                    await conn.run_sync(_record, migration)
+                print(f"🧱 Applied migration {migration.version}: {migration.description}")
+                done.append(migration.version)
+        finally:
+            await conn.run_sync(_unlock)
+    return done
+
+async def status():
+    async with engine.connect() as conn:
+        applied = await conn.run_sync(_applied)
+        await conn.commit()
+    for migration in MIGRATIONS:
+        when = applied.get(migration.version)
+        mark = f"applied {when:%Y-%m-%d %H:%M}" if when else "PENDING"
+        print(f"{migration.version}  {migration.description:<24} {mark}")
+
+async def reset():
+    """
+    DEV ONLY: drops every table we know about, then migrates from scratch.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.drop_all)
+        await conn.run_sync(_meta.drop_all)
+    print("✅ Old tables dropped.")
+    await upgrade()
+
+async def _main(argv):
+    command = argv[1] if len(argv) > 1 else "upgrade"
+    try:
+        if command == "upgrade":
+            applied = await upgrade()
+            print("🚀 Database is up to date." if not applied else f"🚀 Applied {len(applied)} migration(s).")
+        elif command == "status":
+            await status()
+        elif command == "reset":
+            if "--yes" not in argv:
+                print("❌ This deletes ALL data. Run `python migrations.py reset --yes` to confirm.")
+                return 1
+            await reset()
+        else:
+            print(__doc__)
+            return 1
+    finally:
+        await engine.dispose()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv)))
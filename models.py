@@ -1,5 +1,6 @@
 from typing import Optional
 from sqlmodel import SQLModel, Field, Relationship
+from sqlalchemy import UniqueConstraint, Column, BigInteger
 from datetime import datetime
 import uuid
 
@@ -8,7 +9,8 @@ class User(SQLModel, table=True):
     phone_number: str
     pin_hash: Optional[str] = None
     state: str = Field(default="IDLE")
-    temp_data: Optional[str] = None
+    temp_data: Optional[str] = None             # JSON payload for the state (see state_utils.py)
+    state_expires_at: Optional[datetime] = None  # prompt TTL; an expired state reads as IDLE (PIN prompts: PIN_EXPIRED)
     referred_by: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -27,5 +29,66 @@ class Transaction(SQLModel, table=True):
     status: str = Field(default="INIT")
     paystack_reference: Optional[str] = None 
     transfer_code: Optional[str] = None      
+    # Split bills: one charged parent row, one child row per payout leg
+    parent_id: Optional[uuid.UUID] = Field(default=None, foreign_key="transaction.id")
     created_at: datetime = Field(default_factory=datetime.utcnow)
-    updated_at: datetime = Field(default_factory=datetime.utcnow)
\ No newline at end of file
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+class TransferRecipient(SQLModel, table=True):
+    """
+    Paystack transfer recipient we already created for a number, so repeat
+    payouts skip POST /transferrecipient (see recipient_utils.py).
+    """
+    __tablename__ = "transfer_recipient"
+    __table_args__ = (UniqueConstraint("phone_number", "bank_code"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    phone_number: str           # normalized, e.g. 0551234567
+    bank_code: str              # e.g. MTN
+    recipient_code: str         # e.g. RCP_xxxx
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class Job(SQLModel, table=True):
+    """
+    Durable background job (see job_queue.py).
+    status: PENDING -> RUNNING -> DONE, or back to PENDING for a retry, or DEAD.
+    """
+    id: Optional[int] = Field(default=None, primary_key=True)
+    kind: str                                   # e.g. "disburse"
+    payload: str = Field(default="{}")          # JSON
+    status: str = Field(default="PENDING")
+    attempts: int = Field(default=0)
+    max_attempts: int = Field(default=5)
+    run_at: datetime = Field(default_factory=datetime.utcnow)
+    locked_until: Optional[datetime] = None     # visibility timeout while RUNNING
+    last_error: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class ProcessedUpdate(SQLModel, table=True):
+    """
+    Telegram update_ids we have already accepted (see dedup_utils.py).
+    Rows older than UPDATE_DEDUP_RETENTION are pruned.
+    """
+    __tablename__ = "processed_update"
+    update_id: int = Field(sa_column=Column(BigInteger, primary_key=True, autoincrement=False))
+    created_at: datetime = Field(default_factory=datetime.utcnow, index=True)
+
+class OutboxMessage(SQLModel, table=True):
+    """
+    A user notification written in the same DB transaction as the status change
+    it reports, then delivered by the outbox relay (see outbox_utils.py).
+    status: PENDING -> SENDING -> SENT, or back to PENDING for a retry, or DEAD.
+    """
+    __tablename__ = "outbox_message"
+    id: Optional[int] = Field(default=None, primary_key=True)
+    chat_id: str
+    kind: str = Field(default="message")        # "message" or "receipt"
+    payload: str = Field(default="{}")          # JSON
+    status: str = Field(default="PENDING")
+    attempts: int = Field(default=0)
+    run_at: datetime = Field(default_factory=datetime.utcnow)
+    locked_until: Optional[datetime] = None
+    last_error: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    sent_at: Optional[datetime] = None
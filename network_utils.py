@@ -0,0 +1,160 @@
+import os
+import json
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+NETWORKS_FILE = os.getenv("NETWORKS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "networks.json"))
+NETWORK_DEFAULT = os.getenv("NETWORK_DEFAULT", "MTN")
+# How often (seconds) we stat() networks.json for changes
+NETWORK_RELOAD_INTERVAL = float(os.getenv("NETWORK_RELOAD_INTERVAL", "5"))
+
+# Characters people put between digit groups: '055-123-4567', '(055) 123 4567', '055.123.4567'
+_SEPARATORS = str.maketrans("", "", " \t-.()")
+
+def normalize_phone(phone: str) -> str:
+    """
+    Canonical local form: '+233 55 123 4567', '233551234567', '551234567'
+    and '0551234567' all become '0551234567'.
+    """
+    p = phone.strip()
+    if not p.isdigit():
+        p = p.translate(_SEPARATORS)
+        if p.startswith("+"):
+            p = p[1:]
+    if p.startswith("233") and len(p) == 12:
+        return "0" + p[3:]
+    if len(p) == 9 and p.isdigit():
+        return "0" + p
+    return p
+
+# Separators lookups skip in place; anything else ('(', '.') is normalised first
+_SKIPPED = " \t-"
+
+def _prefix_slot(phone: str) -> int:
+    """
+    The '0XY' table slot (XY) read straight off the number: spaces, dashes and
+    a leading '+' are skipped, no new string is built. Returns -1 for other
+    characters or shapes we don't recognise.
+    """
+    if phone.isdigit():
+        # The stored form: index the digits directly
+        n = len(phone)
+        if n == 12 and phone.startswith("233"):
+            i = 3
+        elif phone.startswith("0"):
+            i = 1
+        elif n == 9:
+            i = 0
+        else:
+            return -1
+        if n < i + 2 or not (phone[i] <= "9" and phone[i + 1] <= "9"):
+            return -1
+        return (ord(phone[i]) - 48) * 10 + ord(phone[i + 1]) - 48
+
+    n = d0 = d1 = d2 = d3 = d4 = 0
+    for ch in phone:
+        if "0" <= ch <= "9":
+            v = ord(ch) - 48
+            if n == 0:
+                d0 = v
+            elif n == 1:
+                d1 = v
+            elif n == 2:
+                d2 = v
+            elif n == 3:
+                d3 = v
+            elif n == 4:
+                d4 = v
+            n += 1
+        elif ch not in _SKIPPED and not (ch == "+" and n == 0):
+            return -1
+    if n == 12 and d0 == 2 and d1 == 3 and d2 == 3:
+        return d3 * 10 + d4   # 233 XY...
+    if n >= 3 and d0 == 0:
+        return d1 * 10 + d2   # 0XY...
+    if n == 9:
+        return d0 * 10 + d1   # XY... without the trunk 0
+    return -1
+
+class PrefixIndex:
+    """
+    Compiled view of networks.json.
+    Standard 3-digit '0XY' prefixes go in a 100-slot table indexed by XY,
+    so a lookup is two ord() calls and one list read. Any longer prefixes
+    (e.g. '05512') live in a dict checked longest-first; only those need
+    the number normalised.
+    """
+    def __init__(self, config: dict):
+        self.table = [None] * 100
+        self.long_prefixes = {}
+        for code, prefixes in config.items():
+            for prefix in prefixes:
+                if len(prefix) == 3 and prefix[0] == "0" and prefix.isdigit():
+                    self.table[int(prefix[1:])] = code
+                else:
+                    self.long_prefixes[normalize_phone(prefix)] = code
+        self.long_lengths = sorted({len(p) for p in self.long_prefixes}, reverse=True)
+
+    def lookup(self, phone: str):
+        if self.long_lengths:
+            local = normalize_phone(phone)
+            for length in self.long_lengths:
+                code = self.long_prefixes.get(local[:length])
+                if code:
+                    return code
+
+        slot = _prefix_slot(phone)
+        if slot < 0:
+            # Rarer punctuation: normalise and read it again
+            slot = _prefix_slot(normalize_phone(phone))
+        return self.table[slot] if slot >= 0 else None
+
+class NetworkResolver:
+    """
+    Maps a phone number to its Paystack bank code, reloading networks.json
+    when its mtime changes. A reload builds a new PrefixIndex and swaps it in
+    with one assignment, so lookups never see a half-built index.
+    """
+    def __init__(self, path: str = NETWORKS_FILE, default: str = NETWORK_DEFAULT):
+        self.path = path
+        self.default = default
+        self.index = PrefixIndex({})
+        self._mtime = None
+        self._next_check = 0.0
+        self.reload()
+
+    def reload(self) -> bool:
+        try:
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path, "r") as f:
+                config = json.load(f)
+            self.index = PrefixIndex(config)
+            self._mtime = mtime
+            return True
+        except Exception as e:
+            # Keep serving the last good index
+            print(f"⚠️ Error loading {self.path}: {e}")
+            return False
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + NETWORK_RELOAD_INTERVAL
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.reload()
+
+    def bank_code(self, phone: str) -> str:
+        self._maybe_reload()
+        return self.index.lookup(phone) or self.default
+
+network_resolver = NetworkResolver()
+
+def get_bank_code(phone: str) -> str:
+    return network_resolver.bank_code(phone)
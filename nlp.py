@@ -1,14 +1,24 @@
 import os
 import json
 import re
+import time
+import asyncio
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+from cache_utils import TTLCache
+
 load_dotenv()
 
 # --- CONFIGURATION ---
 API_KEY = os.getenv("GOOGLE_API_KEY")
 USE_AI = False
+# Offline results at or above this confidence never reach Gemini
+NLP_CONFIDENCE_THRESHOLD = float(os.getenv("NLP_CONFIDENCE_THRESHOLD", "0.8"))
+# Hard deadline for the Gemini fallback (seconds)
+NLP_AI_TIMEOUT = float(os.getenv("NLP_AI_TIMEOUT", "3"))
+NLP_CACHE_TTL = float(os.getenv("NLP_CACHE_TTL", "600"))
+NLP_CACHE_SIZE = int(os.getenv("NLP_CACHE_SIZE", "5000"))
 
 if API_KEY:
     try:
@@ -44,21 +54,65 @@ Examples:
    -> {"intent": "SEND_MONEY", "amount": 50.0, "currency": "GHS", "recipient": "Mom"}
 """
 
-def parse_message(text: str, history: list = []):
+# normalized text -> parse result (only for messages parsed without history)
+parse_cache = TTLCache(maxsize=NLP_CACHE_SIZE, ttl=NLP_CACHE_TTL)
+nlp_stats = {"offline": 0, "ai_calls": 0, "ai_timeouts": 0, "ai_errors": 0, "ai_latency_ms_total": 0.0}
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+def is_digits_only(text: str) -> bool:
+    return "".join(text.split()).isdigit()
+
+async def parse_message(text: str, history: list = None):
     """
     Parses user text. Now accepts 'history' (list of strings) for context.
     Example history: ["User: Send 50", "Bot: To whom?"]
+
+    Offline first: if the regex parser is confident we return straight away.
+    Gemini only sees low-confidence inputs, with a hard NLP_AI_TIMEOUT, and
+    falls back to the offline result on timeout or error.
     """
-    if USE_AI:
-        try:
-            return parse_message_ai(text, history)
-        except Exception as e:
-            print(f"AI Error: {e}, using offline mode.")
-            return parse_message_offline(text)
-    else:
-        return parse_message_offline(text)
-
-def parse_message_ai(text: str, history: list):
+    offline = parse_message_offline(text)
+    # Bare digits may be a PIN or OTP: never sent to Gemini
+    if not USE_AI or is_digits_only(text) or offline_confidence(offline) >= NLP_CONFIDENCE_THRESHOLD:
+        nlp_stats["offline"] += 1
+        return offline
+
+    if history:
+        return await _parse_with_ai(text, history, offline)
+
+    return await parse_cache.get_or_load(
+        normalize_text(text),
+        lambda: _parse_with_ai(text, None, offline),
+        ttl_for=lambda result: None if result is offline else NLP_CACHE_TTL,
+    )
+
+async def _parse_with_ai(text: str, history: list, offline: dict):
+    nlp_stats["ai_calls"] += 1
+    started = time.perf_counter()
+    try:
+        return await asyncio.wait_for(parse_message_ai(text, history), timeout=NLP_AI_TIMEOUT)
+    except asyncio.TimeoutError:
+        nlp_stats["ai_timeouts"] += 1
+        print(f"AI Timeout after {NLP_AI_TIMEOUT}s, using offline mode.")
+        return offline
+    except Exception as e:
+        nlp_stats["ai_errors"] += 1
+        print(f"AI Error: {e}, using offline mode.")
+        return offline
+    finally:
+        nlp_stats["ai_latency_ms_total"] += (time.perf_counter() - started) * 1000
+
+def get_nlp_stats() -> dict:
+    calls = nlp_stats["ai_calls"]
+    return {
+        **{k: v for k, v in nlp_stats.items() if k != "ai_latency_ms_total"},
+        "ai_avg_latency_ms": round(nlp_stats["ai_latency_ms_total"] / calls, 1) if calls else 0.0,
+        "cache": parse_cache.stats(),
+    }
+
+async def parse_message_ai(text: str, history: list):
     # Format history for the prompt
     context_str = "\n".join(history[-3:]) if history else "None"
     
@@ -68,19 +122,57 @@ def parse_message_ai(text: str, history: list):
         f"Current Input: {text}"
     )
     
-    response = model.generate_content(full_prompt)
+    response = await model.generate_content_async(full_prompt)
     clean_text = response.text.replace("```json", "").replace("```", "").strip()
     try:
         return json.loads(clean_text)
     except:
         return {"intent": "UNKNOWN", "amount": None, "currency": "GHS", "recipient": None}
 
+# --- OFFLINE PARSER ---
+# Everything is compiled once at import. Text is tokenized into words once,
+# and keywords are matched by set membership on whole words (so "fa" no
+# longer fires inside "fast"). Numbers come from one scan that starts on a
+# literal character class, and each numeric chunk is classified as a phone
+# or an amount in place, so there is no text.replace() step.
+
+_WORD_RE = re.compile(r"[a-z][a-z']*")
+_NUMERIC_RE = re.compile(r"[$£€₵+\d][\d,.]*")
+# Anchored right after an amount: "2k", "50 cedis", "10usd"
+_SUFFIX_RE = re.compile(r" *([kmb](?![a-z]))? *((?:usd|ghs|ghc|gh₵|cedis|cedi|dollars|dollar|bucks)\b)?")
+_MAX_AMOUNT_DIGITS = 8
+
+_MULTIPLIERS = {"k": 1_000, "m": 1_000_000, "b": 1_000_000_000}
+_SYMBOL_CURRENCY = {"$": "USD", "£": "GBP", "€": "EUR", "₵": "GHS"}
+_WORD_CURRENCY = {"usd": "USD", "dollars": "USD", "dollar": "USD", "bucks": "USD"}
+
+SEND_KEYWORDS = frozenset(["send", "pay", "transfer", "give", "dash", "fa", "tua", "koma", "have", "take", "for"])
+SPLIT_KEYWORDS = frozenset(["split", "divide", "share"])
+# Word right before a recipient name ("to Kofi", "give Ama", Twi "ma Kofi")
+RECIPIENT_MARKERS = frozenset(["to", "give", "for", "pay", "ma", "koma", "dash"])
+# Words a name never is; skipped when looking for the recipient
+_NOT_NAMES = frozenset([
+    "my", "me", "the", "a", "an", "him", "her", "them", "us", "am", "i", "you",
+    "abeg", "please", "pls", "chale", "now", "some", "money", "cash", "momo",
+    "cedis", "cedi", "ghs", "ghc", "usd", "dollars", "dollar",
+    "and", "between", "among", "with", "each",
+]) | SEND_KEYWORDS | SPLIT_KEYWORDS | RECIPIENT_MARKERS
+# Words that start the list of people in a split ("split 100 between Kofi and Ama")
+_SPLIT_LIST_MARKERS = frozenset(["between", "among", "amongst", "with"])
+_LIST_JOINERS = frozenset(["and", "n", "&"])
+
+def _normalize_ghana_phone(raw: str) -> str:
+    if raw.startswith("233"):
+        return "0" + raw[3:]
+    return raw
+
 def parse_message_offline(text: str):
     """
-    Robust offline parser. Now detects basic currency.
+    Robust offline parser. Detects intent, amount, currency and recipient
+    (a list of recipients for SPLIT_BILL) in English, Pidgin and Twi.
     """
     text = text.lower().strip()
-    
+
     response = {
         "intent": "UNKNOWN",
         "amount": None,
@@ -89,58 +181,108 @@ def parse_message_offline(text: str):
         "raw_text": text
     }
 
-    # 1. EXTRACT RECIPIENT
-    # A. Check for Phone Number (055...)
-    phone_match = re.search(r'\b(0\d{9})\b', text)
-    if phone_match:
-        response["recipient"] = phone_match.group(1)
-        text = text.replace(response["recipient"], "")
-    
-    # B. Check for Name (if no phone found)
-    elif not response["recipient"]:
-        name_match = re.search(r'(?:to|give|for|pay)\s+([a-zA-Z]+)', text)
-        if name_match:
-            response["recipient"] = name_match.group(1)
-
-    # 2. EXTRACT AMOUNT & CURRENCY
-    # Matches: $50, 50usd, 50ghs, 50 cedis
-    amount_match = re.search(r'([$£€])?\s*(\d+(\.\d+)?)\s*([kmb])?\s*(usd|ghs|cedis|dollars)?', text)
-    
-    if amount_match:
-        prefix_sym = amount_match.group(1)
-        val = float(amount_match.group(2))
-        suffix_kmb = amount_match.group(4)
-        suffix_cur = amount_match.group(5)
-        
-        # Handle Multipliers
-        if suffix_kmb == 'k': val *= 1_000
-        elif suffix_kmb == 'm': val *= 1_000_000
-        elif suffix_kmb == 'b': val *= 1_000_000_000
-        
-        # Handle Currency
-        if prefix_sym == '$' or suffix_cur in ['usd', 'dollars']:
-            response["currency"] = "USD"
-        elif prefix_sym == '£':
-            response["currency"] = "GBP"
-        elif prefix_sym == '€':
-            response["currency"] = "EUR"
-        else:
-            response["currency"] = "GHS"
-            
-        if val > 0:
-            response["amount"] = val
-
-    # 3. DETERMINE INTENT
-    keywords = ["send", "pay", "transfer", "give", "dash", "fa", "tua", "koma", "have", "take", "for"]
-    split_keywords = ["split", "divide", "share"]
-
-    if any(w in text for w in split_keywords):
+    # 1. TOKENIZE + EXTRACT
+    words = _WORD_RE.findall(text)
+    word_set = set(words)
+    has_split = not SPLIT_KEYWORDS.isdisjoint(word_set)
+    has_send = not SEND_KEYWORDS.isdisjoint(word_set)
+
+    phones = []
+    sym = None
+    for m in _NUMERIC_RE.finditer(text):
+        tok = m.group().rstrip(".,")
+        if tok[0] in _SYMBOL_CURRENCY:
+            sym, tok = tok[0], tok[1:]
+            if not tok:
+                continue  # "$ 50": symbol applies to the next number
+        digits = tok[1:] if tok[0] == "+" else tok
+        if not digits.isdigit() and not digits.replace(",", "").replace(".", "", 1).isdigit():
+            sym = None
+            continue
+
+        if digits.isdigit() and ((len(digits) == 10 and digits[0] == "0") or (len(digits) == 12 and digits.startswith("233"))):
+            phones.append(_normalize_ghana_phone(digits))
+        elif response["amount"] is None and tok[0] != "+" and len(digits.split(".")[0].replace(",", "")) <= _MAX_AMOUNT_DIGITS:
+            val = float(digits.replace(",", ""))
+            mult, cur = _SUFFIX_RE.match(text, m.end()).groups()
+            if mult:
+                val *= _MULTIPLIERS[mult]
+            if sym:
+                response["currency"] = _SYMBOL_CURRENCY[sym]
+            elif cur in _WORD_CURRENCY:
+                response["currency"] = _WORD_CURRENCY[cur]
+            if val > 0:
+                response["amount"] = val
+        sym = None
+
+    # 2. INTENT
+    if has_split:
         response["intent"] = "SPLIT_BILL"
-    elif any(w in text for w in keywords):
+    elif has_send:
         response["intent"] = "SEND_MONEY"
-    
+
+    # 3. RECIPIENT(S)
+    if response["intent"] == "SPLIT_BILL":
+        people = phones
+        listing = False
+        for w in words:
+            if w in _SPLIT_LIST_MARKERS:
+                listing = True
+            elif listing and w not in _NOT_NAMES and w not in _LIST_JOINERS:
+                people.append(w)
+        response["recipient"] = people or None
+    elif phones:
+        response["recipient"] = phones[0]
+    elif not RECIPIENT_MARKERS.isdisjoint(word_set):
+        for i, w in enumerate(words):
+            if w in RECIPIENT_MARKERS:
+                for nxt in words[i + 1:i + 3]:
+                    if nxt not in _NOT_NAMES:
+                        response["recipient"] = nxt
+                        break
+                if response["recipient"]:
+                    break
+
     # Smart Fallback
     if response["amount"] and response["recipient"] and response["intent"] == "UNKNOWN":
         response["intent"] = "SEND_MONEY"
+    elif response["intent"] == "UNKNOWN":
+        response["recipient"] = None
+
+    return response
+
+def parse_messages_offline(texts: list) -> list:
+    """
+    Batch version of parse_message_offline.
+    """
+    return [parse_message_offline(t) for t in texts]
+
+# Words that suggest a payment even when the parser found nothing usable
+_MONEY_HINTS = frozenset([
+    "cedi", "cedis", "ghs", "ghc", "usd", "dollars", "dollar", "momo", "money", "cash",
+    "ten", "twenty", "thirty", "forty", "fifty", "hundred", "thousand",
+]) | SPLIT_KEYWORDS
+_HAS_DIGIT_RE = re.compile(r"\d")
+
+def offline_confidence(result: dict) -> float:
+    """
+    How sure we are that the offline parse is right (0..1).
+    Complete parses and plain small talk are unambiguous; anything with a
+    money signal but missing pieces is worth asking the LLM about.
+    """
+    intent = result["intent"]
+    amount = result["amount"]
+    recipient = result["recipient"]
+
+    if intent == "SEND_MONEY":
+        if amount and recipient:
+            return 1.0 if recipient.isdigit() else 0.9
+        return 0.4
+    if intent == "SPLIT_BILL":
+        return 0.9 if amount and recipient and len(recipient) >= 2 else 0.4
 
-    return response
\ No newline at end of file
+    # UNKNOWN: confident only if there is no hint of money at all
+    text = result.get("raw_text", "")
+    if _HAS_DIGIT_RE.search(text) or not _MONEY_HINTS.isdisjoint(_WORD_RE.findall(text)):
+        return 0.3
+    return 0.9
@@ -0,0 +1,221 @@
+import os
+import json
+import asyncio
+from datetime import datetime, timedelta
+from sqlmodel import select
+from sqlalchemy import update, delete, exists, or_, and_, event
+from sqlalchemy.orm import Session, aliased
+from dotenv import load_dotenv
+
+from database import async_session
+from models import OutboxMessage
+from job_queue import retry_delay
+from telegram_utils import send_message, send_photo
+from receipt_utils import render_receipt_async
+
+load_dotenv()
+
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "50"))                      # chats served per round
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))     # idle poll (seconds)
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "60"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETENTION = float(os.getenv("OUTBOX_RETENTION", "604800"))        # keep SENT/DEAD rows a week
+OUTBOX_PRUNE_EVERY = int(os.getenv("OUTBOX_PRUNE_EVERY", "1000"))
+
+OPEN_STATUSES = ("PENDING", "SENDING")
+
+# --- WRITING (inside the caller's DB transaction) ---
+
+def queue_message(session, chat_id, text: str):
+    """
+    Adds a text notification to `session`; it is sent after the caller commits.
+    """
+    if not chat_id:
+        return
+    session.add(OutboxMessage(chat_id=str(chat_id), payload=json.dumps({"text": text})))
+    session.info["outbox"] = True
+
+def queue_receipt(session, chat_id, sender: str, recipient: str, amount: float, reference: str, caption: str = ""):
+    """
+    Adds a receipt photo; it is rendered when delivered, so the row stays small.
+    """
+    if not chat_id:
+        return
+    session.add(OutboxMessage(chat_id=str(chat_id), kind="receipt", payload=json.dumps({
+        "sender": sender, "recipient": recipient, "amount": amount, "reference": reference, "caption": caption,
+    })))
+    session.info["outbox"] = True
+
+@event.listens_for(Session, "after_commit")
+def _wake_relay(session):
+    if session.info.pop("outbox", False):
+        outbox_relay.wake()
+
+@event.listens_for(Session, "after_rollback")
+def _forget_queued(session):
+    session.info.pop("outbox", None)
+
+# --- DELIVERY ---
+
+class OutboxRelay:
+    """
+    Delivers outbox rows to Telegram, at least once and in order per chat.
+
+    Each round claims the oldest open row of up to OUTBOX_BATCH chats (a row
+    waits while an earlier one for its chat is still open) with
+    SELECT ... FOR UPDATE SKIP LOCKED plus a lease, so several processes can
+    run a relay. A failed row is retried with backoff, then marked DEAD.
+    """
+    def __init__(self):
+        self._task = None
+        self._wake = None
+        self._since_prune = 0
+        self.stats_counters = {"sent": 0, "retried": 0, "dead": 0, "errors": 0, "pruned": 0}
+        self._lag_total = 0.0
+        self._lag_max = 0.0
+
+    def wake(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def start(self):
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                if await self.deliver_batch():
+                    continue
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats_counters["errors"] += 1
+                print(f"⚠️ Outbox relay error: {e}")
+                await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+    async def claim(self, session) -> list:
+        now = datetime.utcnow()
+        earlier = aliased(OutboxMessage)
+        due = or_(
+            and_(OutboxMessage.status == "PENDING", OutboxMessage.run_at <= now),
+            and_(OutboxMessage.status == "SENDING", OutboxMessage.locked_until < now),  # lease expired
+        )
+        blocked = exists().where(
+            earlier.chat_id == OutboxMessage.chat_id,
+            earlier.id < OutboxMessage.id,
+            earlier.status.in_(OPEN_STATUSES),
+        )
+        ids = (await session.exec(
+            select(OutboxMessage.id).where(due, ~blocked)
+            .order_by(OutboxMessage.id).limit(OUTBOX_BATCH)
+            .with_for_update(skip_locked=True)
+        )).all()
+        if not ids:
+            await session.commit()
+            return []
+        await session.execute(
+            update(OutboxMessage)
+            .where(OutboxMessage.id.in_(ids))
+            .values(status="SENDING", attempts=OutboxMessage.attempts + 1,
+                    locked_until=now + timedelta(seconds=OUTBOX_LEASE))
+        )
+        await session.commit()
+        return (await session.exec(select(OutboxMessage).where(OutboxMessage.id.in_(ids)))).all()
+
+    async def deliver_batch(self) -> int:
+        """
+        One round: claim, send, record. Returns the number of rows claimed.
+        """
+        async with async_session() as session:
+            claimed = await self.claim(session)
+            if not claimed:
+                return 0
+            results = await asyncio.gather(*(self._deliver(msg) for msg in claimed), return_exceptions=True)
+
+            now = datetime.utcnow()
+            sent = []
+            for msg, result in zip(claimed, results):
+                error, permanent = (result, False) if isinstance(result, Exception) else result
+                if error is None:
+                    sent.append(msg.id)
+                    lag = (now - msg.created_at).total_seconds() * 1000
+                    self._lag_total += lag
+                    self._lag_max = max(self._lag_max, lag)
+                    continue
+                if permanent or msg.attempts >= OUTBOX_MAX_ATTEMPTS:
+                    values = {"status": "DEAD"}
+                    self.stats_counters["dead"] += 1
+                    print(f"❌ Outbox message {msg.id} to {msg.chat_id} dead: {error}")
+                else:
+                    values = {"status": "PENDING", "run_at": now + timedelta(seconds=retry_delay(msg.attempts))}
+                    self.stats_counters["retried"] += 1
+                await session.execute(
+                    update(OutboxMessage).where(OutboxMessage.id == msg.id)
+                    .values(locked_until=None, last_error=str(error)[:500], **values)
+                )
+            if sent:
+                await session.execute(
+                    update(OutboxMessage).where(OutboxMessage.id.in_(sent))
+                    .values(status="SENT", sent_at=now, locked_until=None, last_error=None)
+                )
+            await session.commit()
+
+        self.stats_counters["sent"] += len(sent)
+        self._since_prune += len(claimed)
+        if self._since_prune >= OUTBOX_PRUNE_EVERY:
+            self._since_prune = 0
+            await self.prune()
+        return len(claimed)
+
+    async def _deliver(self, msg: OutboxMessage):
+        """
+        Sends one row. Returns (error, permanent); error is None on success.
+        """
+        payload = json.loads(msg.payload)
+        if msg.kind == "receipt":
+            image = await render_receipt_async(payload["sender"], payload["recipient"], payload["amount"], payload["reference"])
+            resp = await send_photo(msg.chat_id, image, caption=payload.get("caption", ""),
+                                    filename=f"receipt_{payload['reference']}.png")
+        else:
+            resp = await send_message(msg.chat_id, payload["text"])
+        if resp is None:
+            return "Not sent (queue full or network error)", False
+        if resp.get("ok"):
+            return None, False
+        # 400/403: the chat is gone or blocked the bot; retrying will not help
+        return resp.get("description", "Telegram error"), resp.get("error_code") in (400, 403)
+
+    async def prune(self):
+        cutoff = datetime.utcnow() - timedelta(seconds=OUTBOX_RETENTION)
+        try:
+            async with async_session() as session:
+                result = await session.execute(
+                    delete(OutboxMessage).where(OutboxMessage.status.in_(("SENT", "DEAD")), OutboxMessage.created_at < cutoff)
+                )
+                await session.commit()
+                self.stats_counters["pruned"] += result.rowcount or 0
+        except Exception as e:
+            print(f"⚠️ Outbox prune failed: {e}")
+
+    def stats(self) -> dict:
+        sent = self.stats_counters["sent"]
+        return {
+            **self.stats_counters,
+            "avg_lag_ms": round(self._lag_total / sent, 1) if sent else 0.0,
+            "max_lag_ms": round(self._lag_max, 1),
+        }
+
+outbox_relay = OutboxRelay()
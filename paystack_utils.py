@@ -1,67 +1,255 @@
 import os
+import time
 import uuid
+import random
+import asyncio
 import httpx
-import json
+from decimal import Decimal, ROUND_HALF_UP
 from dotenv import load_dotenv
 
+from cache_utils import TTLCache
+from network_utils import get_bank_code, normalize_phone
+
 
 load_dotenv()
 
 PAYSTACK_SECRET = os.getenv("PAYSTACK_SECRET_KEY")
 BASE_URL = "https://api.paystack.co"
 
-HEADERS = {
-    "Authorization": f"Bearer {PAYSTACK_SECRET}",
-    "Content-Type": "application/json"
+# --- CLIENT TUNING ---
+PAYSTACK_MAX_CONNECTIONS = int(os.getenv("PAYSTACK_MAX_CONNECTIONS", "50"))
+PAYSTACK_MAX_KEEPALIVE = int(os.getenv("PAYSTACK_MAX_KEEPALIVE", "10"))
+PAYSTACK_CONNECT_TIMEOUT = float(os.getenv("PAYSTACK_CONNECT_TIMEOUT", "3"))
+PAYSTACK_MAX_RETRIES = int(os.getenv("PAYSTACK_MAX_RETRIES", "2"))
+PAYSTACK_BACKOFF_BASE = float(os.getenv("PAYSTACK_BACKOFF_BASE", "0.2"))
+PAYSTACK_BREAKER_THRESHOLD = int(os.getenv("PAYSTACK_BREAKER_THRESHOLD", "5"))
+PAYSTACK_BREAKER_RESET = float(os.getenv("PAYSTACK_BREAKER_RESET", "30"))
+
+# Read-timeout budget (seconds) per endpoint. Override with PAYSTACK_TIMEOUT_<NAME>.
+ENDPOINT_TIMEOUTS = {
+    "resolve": 5.0,
+    "verify": 8.0,
+    "charge": 20.0,
+    "submit_otp": 15.0,
+    "recipient": 10.0,
+    "transfer": 15.0,
+    "bulk_transfer": 30.0,
+    "refund": 15.0,
 }
+for _name in ENDPOINT_TIMEOUTS:
+    _override = os.getenv(f"PAYSTACK_TIMEOUT_{_name.upper()}")
+    if _override:
+        ENDPOINT_TIMEOUTS[_name] = float(_override)
 
-NETWORK_CONFIG = {}
+# Name-resolution cache: (phone, bank_code) -> resolve result
+RESOLVE_CACHE_TTL = float(os.getenv("RESOLVE_CACHE_TTL", "3600"))
+RESOLVE_CACHE_NEGATIVE_TTL = float(os.getenv("RESOLVE_CACHE_NEGATIVE_TTL", "60"))
+RESOLVE_CACHE_SIZE = int(os.getenv("RESOLVE_CACHE_SIZE", "10000"))
 
-def load_network_config():
+# Paystack accepts at most 100 transfers per bulk request
+PAYSTACK_BULK_MAX = int(os.getenv("PAYSTACK_BULK_MAX", "100"))
+
+def max_call_time(endpoint: str) -> float:
     """
-    Loads network prefixes from networks.json into memory.
+    Worst case for one call: every attempt timing out, plus the backoff between them.
     """
-    global NETWORK_CONFIG
-    try:
-        with open("networks.json", "r") as f:
-            NETWORK_CONFIG = json.load(f)
-    except Exception as e:
-        print(f"⚠️ Error loading networks.json: {e}")
-        
-    load_network_config()
+    attempts = PAYSTACK_MAX_RETRIES + 1
+    backoff = sum(PAYSTACK_BACKOFF_BASE * (2 ** attempt) for attempt in range(PAYSTACK_MAX_RETRIES))
+    return attempts * (PAYSTACK_CONNECT_TIMEOUT + ENDPOINT_TIMEOUTS[endpoint]) + backoff
 
 def get_paystack_bank_code(phone: str) -> str:
     """
     Maps phone prefixes to Paystack's Bank Codes using networks.json.
     """
-    p = phone.strip().replace("+233", "0")
+    return get_bank_code(phone)
+
+class CircuitOpenError(Exception):
+    """
+    Raised when the breaker is open and we refuse to call Paystack.
+    """
+
+class PaystackUnreachable(httpx.TransportError):
+    """
+    Raised when no attempt reached Paystack (connect errors only).
+    """
+
+class CircuitBreaker:
+    """
+    Trips after `threshold` consecutive failures and fails fast for `reset_after`
+    seconds. After that trial calls are let through (half-open); one more
+    failure re-opens it, one success closes it.
+    """
+    def __init__(self, threshold: int = PAYSTACK_BREAKER_THRESHOLD, reset_after: float = PAYSTACK_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "CLOSED"
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return "HALF_OPEN"
+        return "OPEN"
+
+    def before_call(self):
+        if self.state == "OPEN":
+            raise CircuitOpenError("Paystack is temporarily unavailable.")
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold or self.state == "HALF_OPEN":
+            self.opened_at = time.monotonic()
+
+class PaystackClient:
+    """
+    Pooled Paystack API client.
+    - One keep-alive connection pool for every call.
+    - Per-endpoint read timeouts (ENDPOINT_TIMEOUTS).
+    - Idempotent GETs are retried with jittered exponential backoff.
+    - Mutating POSTs carry a unique reference and are only retried when the
+      request never reached Paystack (connect errors).
+    - A circuit breaker fails fast while Paystack is degraded.
+    """
+    def __init__(self, secret_key: str = PAYSTACK_SECRET, base_url: str = BASE_URL):
+        self.base_url = base_url
+        self.headers = {
+            "Authorization": f"Bearer {secret_key}",
+            "Content-Type": "application/json"
+        }
+        self.breaker = CircuitBreaker()
+        self._client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=self.headers,
+                limits=httpx.Limits(
+                    max_connections=PAYSTACK_MAX_CONNECTIONS,
+                    max_keepalive_connections=PAYSTACK_MAX_KEEPALIVE,
+                ),
+                timeout=httpx.Timeout(max(ENDPOINT_TIMEOUTS.values()), connect=PAYSTACK_CONNECT_TIMEOUT),
+            )
+        return self._client
+
+    async def start(self):
+        self._get_client()
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _backoff(self, attempt: int):
+        # Full jitter: sleep somewhere in [0, base * 2^attempt]
+        await asyncio.sleep(random.uniform(0, PAYSTACK_BACKOFF_BASE * (2 ** attempt)))
+
+    async def request(self, method: str, path: str, endpoint: str, idempotent: bool, **kwargs) -> dict:
+        """
+        Sends one API call and returns Paystack's JSON body.
+        Raises CircuitOpenError or httpx errors; the public helpers turn those
+        into {"status": False, "message": ...}.
+        """
+        self.breaker.before_call()
+        timeout = httpx.Timeout(ENDPOINT_TIMEOUTS[endpoint], connect=PAYSTACK_CONNECT_TIMEOUT)
+        attempt = 0
+
+        while True:
+            try:
+                resp = await self._get_client().request(method, path, timeout=timeout, **kwargs)
+                if resp.status_code >= 500:
+                    raise httpx.HTTPStatusError("Paystack server error", request=resp.request, response=resp)
+                self.breaker.record_success()
+                return resp.json()
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+                # Never reached Paystack -> safe to retry even for POSTs.
+                retryable = True
+                error_cls = "connect"
+            except (httpx.TimeoutException, httpx.HTTPStatusError, httpx.TransportError):
+                retryable = idempotent
+                error_cls = "upstream"
+
+            self.breaker.record_failure()
+            if not retryable or attempt >= PAYSTACK_MAX_RETRIES or self.breaker.state == "OPEN":
+                # A POST is only retried after connect errors, so "connect" here means nothing was sent
+                error = PaystackUnreachable if error_cls == "connect" else httpx.TransportError
+                raise error(f"Paystack {endpoint} failed ({error_cls}) after {attempt + 1} attempt(s)")
+            await self._backoff(attempt)
+            attempt += 1
+
+    async def call(self, method: str, path: str, endpoint: str, idempotent: bool = False, **kwargs) -> dict:
+        try:
+            return await self.request(method, path, endpoint, idempotent, **kwargs)
+        except (CircuitOpenError, PaystackUnreachable) as e:
+            # Paystack never saw the request, so it cannot have acted on it
+            return {"status": False, "message": str(e), "transient": True, "unsent": True}
+        except Exception as e:
+            # transient: never reached a definite answer (timeout, 5xx); Paystack may have acted on it
+            return {"status": False, "message": str(e), "transient": True}
+
+paystack = PaystackClient()
+resolve_cache = TTLCache(maxsize=RESOLVE_CACHE_SIZE, ttl=RESOLVE_CACHE_TTL)
+
+async def start_client():
+    await paystack.start()
+
+async def close_client():
+    await paystack.close()
+
+def new_reference(prefix: str) -> str:
+    """
+    Unique reference Paystack uses to de-duplicate mutating calls.
+    """
+    return f"{prefix}_{uuid.uuid4()}"
+
+def to_pesewas(amount_ghs: float) -> int:
+    """
+    GHS -> pesewas, rounded half up. Charges, transfers, refunds and split
+    shares all go through this, so they always agree (19.99 -> 1999, not 1998).
+    """
+    return int(Decimal(str(amount_ghs)).scaleb(2).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def _resolve_ttl(result: dict):
+    # Names are stable -> long TTL. "Not found" is cached briefly. Transient errors are not cached.
+    if result.get("status"):
+        return RESOLVE_CACHE_TTL
+    if result.get("transient"):
+        return None
+    return RESOLVE_CACHE_NEGATIVE_TTL
+
+async def _resolve_uncached(phone: str, bank_code: str):
+    params = {"account_number": phone, "bank_code": bank_code}
     
-    # Iterate through the loaded config
-    for code, prefixes in NETWORK_CONFIG.items():
-        if any(p.startswith(prefix) for prefix in prefixes):
-            return code
-        
-    return "MTN"
+    resp = await paystack.call("GET", "/bank/resolve", "resolve", idempotent=True, params=params)
+    if resp.get("status"):
+        return {"status": True, "account_name": resp["data"]["account_name"]}
+    return {
+        "status": False,
+        "message": resp.get("message") or "Could not verify name.",
+        "transient": resp.get("transient", False),
+    }
 
 async def resolve_mobile_money(phone: str):
+    """
+    Async: Looks up the registered name on a mobile-money number.
+    Cached per (phone, bank_code); concurrent lookups share one API call.
+    """
+    phone = normalize_phone(phone)
     bank_code = get_paystack_bank_code(phone)
-    url = f"{BASE_URL}/bank/resolve"
-    params = {"account_number": phone, "bank_code": bank_code}
-    
-    try:
-        async with httpx.AsyncClient() as client:
-            req = await client.get(url, params=params, headers=HEADERS)
-        resp = req.json()
-        
-        if resp.get("status"):
-            return {"status": True, "account_name": resp["data"]["account_name"]}
-        else:
-            return {"status": False, "message": "Could not verify name."}
-    except Exception as e:
-        return {"status": False, "message": str(e)}
+    return await resolve_cache.get_or_load(
+        (phone, bank_code),
+        lambda: _resolve_uncached(phone, bank_code),
+        ttl_for=_resolve_ttl,
+    )
 
-async def initiate_charge(user_phone: str, amount_ghs: float, email: str = "user@sikaswift.com"):
-    amount_kobo = int(amount_ghs * 100) 
+async def initiate_charge(user_phone: str, amount_ghs: float, email: str = "user@sikaswift.com", reference: str = None):
+    amount_kobo = to_pesewas(amount_ghs)
     network = get_paystack_bank_code(user_phone).lower()
 
     payload = {
@@ -69,25 +257,13 @@ async def initiate_charge(user_phone: str, amount_ghs: float, email: str = "user
         "amount": amount_kobo,
         "currency": "GHS",
         "mobile_money": {"phone": user_phone, "provider": network},
-        "reference": f"txn_{uuid.uuid4()}"
+        "reference": reference or new_reference("txn")
     }
-    
-    try:
-        async with httpx.AsyncClient() as client:
-            req = await client.post(f"{BASE_URL}/charge", json=payload, headers=HEADERS)
-        return req.json()
-    except Exception as e:
-        return {"status": False, "message": str(e)}
+    return await paystack.call("POST", "/charge", "charge", json=payload)
 
 async def submit_otp(reference: str, otp_code: str):
-    url = f"{BASE_URL}/charge/submit_otp"
     payload = {"otp": otp_code, "reference": reference}
-    try:
-        async with httpx.AsyncClient() as client:
-            req = await client.post(url, json=payload, headers=HEADERS)
-        return req.json()
-    except Exception as e:
-        return {"status": False, "message": str(e)}
+    return await paystack.call("POST", "/charge/submit_otp", "submit_otp", json=payload)
 
 async def create_transfer_recipient(name: str, phone: str):
     bank_code = get_paystack_bank_code(phone)
@@ -98,38 +274,65 @@ async def create_transfer_recipient(name: str, phone: str):
         "bank_code": bank_code, 
         "currency": "GHS"
     }
-    try:
-        async with httpx.AsyncClient() as client:
-            req = await client.post(f"{BASE_URL}/transferrecipient", json=payload, headers=HEADERS)
-        return req.json()
-    except Exception as e:
-        return {"status": False}
-
-async def initiate_transfer(amount_ghs: float, recipient_code: str):
-    amount_kobo = int(amount_ghs * 100)
+    # Paystack de-duplicates recipients on (account_number, bank_code), so retrying is safe.
+    return await paystack.call("POST", "/transferrecipient", "recipient", idempotent=True, json=payload)
+
+async def initiate_transfer(amount_ghs: float, recipient_code: str, reference: str = None):
+    amount_kobo = to_pesewas(amount_ghs)
     payload = {
         "source": "balance", 
         "amount": amount_kobo,
         "recipient": recipient_code,
-        "reason": "SikaSwift Transfer"
+        "reason": "SikaSwift Transfer",
+        "reference": reference or new_reference("trf")
     }
-    try:
-        async with httpx.AsyncClient() as client:
-            req = await client.post(f"{BASE_URL}/transfer", json=payload, headers=HEADERS)
-        return req.json()
-    except Exception as e:
-        return {"status": False, "message": str(e)}
+    return await paystack.call("POST", "/transfer", "transfer", json=payload)
+
+async def initiate_bulk_transfer(transfers: list, reason: str = "SikaSwift Split"):
+    """
+    Async: Queues many transfers with POST /transfer/bulk, PAYSTACK_BULK_MAX per call.
+    `transfers` is a list of (amount_ghs, recipient_code, reference).
+    Returns {"status": ..., "data": [one item per accepted transfer], "errors": [failed batch responses]}.
+    """
+    batches = [transfers[i:i + PAYSTACK_BULK_MAX] for i in range(0, len(transfers), PAYSTACK_BULK_MAX)]
+
+    async def send(batch):
+        payload = {
+            "currency": "GHS",
+            "source": "balance",
+            "transfers": [
+                {"amount": to_pesewas(amount_ghs), "recipient": code, "reference": ref, "reason": reason}
+                for amount_ghs, code, ref in batch
+            ],
+        }
+        return await paystack.call("POST", "/transfer/bulk", "bulk_transfer", json=payload)
+
+    responses = await asyncio.gather(*(send(b) for b in batches))
+    data, errors = [], []
+    for resp in responses:
+        if resp.get("status"):
+            data.extend(resp.get("data") or [])
+        else:
+            errors.append(resp)
+    return {"status": bool(data), "data": data, "errors": errors}
 
-async def refund_charge(reference: str):
+async def refund_charge(reference: str, amount_ghs: float = None):
     """
-    Async: Refunds a transaction back to the user.
+    Async: Refunds a transaction back to the user (partially if amount_ghs is given).
     """
-    url = f"{BASE_URL}/refund"
     payload = {"transaction": reference}
-    
-    try:
-        async with httpx.AsyncClient() as client:
-            req = await client.post(url, json=payload, headers=HEADERS)
-        return req.json()
-    except Exception as e:
-        return {"status": False, "message": str(e)}
\ No newline at end of file
+    if amount_ghs is not None:
+        payload["amount"] = to_pesewas(amount_ghs)
+    return await paystack.call("POST", "/refund", "refund", json=payload)
+
+async def verify_transaction(reference: str):
+    """
+    Async: Looks up the final state of a charge.
+    """
+    return await paystack.call("GET", f"/transaction/verify/{reference}", "verify", idempotent=True)
+
+async def verify_transfer(reference: str):
+    """
+    Async: Looks up the final state of a transfer by our reference.
+    """
+    return await paystack.call("GET", f"/transfer/verify/{reference}", "verify", idempotent=True)
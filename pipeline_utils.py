@@ -0,0 +1,129 @@
+import os
+import time
+import zlib
+import asyncio
+from collections import deque
+from dotenv import load_dotenv
+
+load_dotenv()
+
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "500"))        # per worker
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv("UPDATE_ENQUEUE_TIMEOUT", "2"))
+
+def update_chat_id(update: dict):
+    """
+    The chat an incoming Telegram update belongs to (None if it has none).
+    """
+    if "message" in update:
+        return str(update["message"]["chat"]["id"])
+    if "callback_query" in update:
+        msg = update["callback_query"].get("message") or {}
+        if "chat" in msg:
+            return str(msg["chat"]["id"])
+        return str(update["callback_query"]["from"]["id"])
+    return None
+
+class UpdatePipeline:
+    """
+    Hashes each update's chat_id onto one of N workers, each with its own
+    bounded FIFO queue. The same chat always lands on the same worker, so its
+    updates run strictly in order (no races on User.state), while different
+    chats run in parallel on the other workers.
+
+    submit() waits up to UPDATE_ENQUEUE_TIMEOUT for room and returns False if
+    the worker is still saturated, so the webhook can push back on Telegram.
+    """
+    def __init__(self, handler, workers: int = UPDATE_WORKERS, max_queue: int = UPDATE_QUEUE_MAX):
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queues = []
+        self._enqueued = []   # per worker: enqueue times of queued updates (FIFO)
+        self._tasks = []
+        self.stats_counters = {"accepted": 0, "rejected": 0, "processed": 0, "errors": 0}
+        self._wait_ms_total = 0.0
+        self._run_ms_total = 0.0
+        self._max_wait_ms = 0.0
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queues = [asyncio.Queue(maxsize=self.max_queue) for _ in range(self.workers)]
+        self._enqueued = [deque() for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._run(i)) for i in range(self.workers)]
+
+    async def stop(self, drain_timeout: float = 10):
+        """
+        Lets queued updates finish (up to drain_timeout), then stops the workers.
+        """
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ Update pipeline stopped with {self.depth()} update(s) still queued.")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def shard(self, chat_id) -> int:
+        if chat_id is None:
+            return 0
+        return zlib.crc32(chat_id.encode()) % self.workers
+
+    async def submit(self, update: dict) -> bool:
+        self.start()
+        shard = self.shard(update_chat_id(update))
+        queue = self._queues[shard]
+        enqueued_at = time.monotonic()
+        self._enqueued[shard].append(enqueued_at)
+        try:
+            await asyncio.wait_for(queue.put((enqueued_at, update)), timeout=UPDATE_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._enqueued[shard].remove(enqueued_at)
+            self.stats_counters["rejected"] += 1
+            return False
+        self.stats_counters["accepted"] += 1
+        return True
+
+    async def _run(self, shard: int):
+        queue = self._queues[shard]
+        while True:
+            enqueued_at, update = await queue.get()
+            if self._enqueued[shard]:
+                self._enqueued[shard].popleft()
+            started = time.monotonic()
+            wait_ms = (started - enqueued_at) * 1000
+            self._wait_ms_total += wait_ms
+            self._max_wait_ms = max(self._max_wait_ms, wait_ms)
+            try:
+                await self.handler(update)
+                self.stats_counters["processed"] += 1
+            except Exception as e:
+                self.stats_counters["errors"] += 1
+                print(f"⚠️ Update {update.get('update_id')} failed: {e}")
+            finally:
+                self._run_ms_total += (time.monotonic() - started) * 1000
+                queue.task_done()
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self) -> dict:
+        done = self.stats_counters["processed"] + self.stats_counters["errors"]
+        depths = [q.qsize() for q in self._queues]
+        now = time.monotonic()
+        oldest = max((now - times[0] for times in self._enqueued if times), default=0.0)
+        return {
+            "workers": self.workers,
+            "depth": sum(depths),
+            "max_worker_depth": max(depths) if depths else 0,
+            "capacity": self.workers * self.max_queue,
+            "oldest_wait_s": round(oldest, 3),
+            **self.stats_counters,
+            "avg_queue_wait_ms": round(self._wait_ms_total / done, 1) if done else 0.0,
+            "max_queue_wait_ms": round(self._max_wait_ms, 1),
+            "avg_handle_ms": round(self._run_ms_total / done, 1) if done else 0.0,
+        }
@@ -0,0 +1,136 @@
+"""
+Long-polling runner: an alternative to the /telegram-webhook endpoint for
+self-hosted or bursty deployments.
+
+    python polling.py
+
+Fetches up to POLL_LIMIT updates per getUpdates call and runs them through
+the same router as the webhook. Chats in a batch run concurrently, each
+chat's updates in order. The batch is filtered against processed_update
+with one SELECT, and once every handler has finished, the update_ids that
+ran are recorded with one multi-row INSERT. Only then is the offset
+advanced. After a crash Telegram re-delivers the batch and it runs again
+(at least once).
+"""
+import os
+import signal
+import asyncio
+from sqlmodel import select
+from dotenv import load_dotenv
+
+from main import app, lifespan, handle_update
+from database import async_session
+from models import User
+from dedup_utils import update_dedup
+from state_utils import state_store
+from pipeline_utils import update_chat_id
+from telegram_utils import get_updates, delete_webhook
+
+load_dotenv()
+
+POLL_LIMIT = int(os.getenv("POLL_LIMIT", "100"))              # Telegram's max
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))           # long-poll seconds
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "16"))   # chats processed at once
+POLL_ERROR_BACKOFF = float(os.getenv("POLL_ERROR_BACKOFF", "3"))
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+poll_stats = {"batches": 0, "updates": 0, "duplicates": 0, "errors": 0}
+
+async def _run_chat(updates: list, user, slots: asyncio.Semaphore) -> list:
+    """
+    One session for all of a chat's updates in this batch. The preloaded User
+    is merged in, so the handlers' session.get() is answered from the identity map.
+    Returns the update_ids whose handler finished.
+    """
+    handled = []
+    async with slots:
+        async with async_session() as session:
+            if user is not None:
+                await session.merge(user, load=False)
+            for update in updates:
+                try:
+                    await handle_update(update, session)
+                except Exception as e:
+                    poll_stats["errors"] += 1
+                    print(f"⚠️ Update {update.get('update_id')} failed: {e}")
+                    await session.rollback()
+                    continue
+                handled.append(update["update_id"])
+    return handled
+
+async def process_batch(updates: list, slots: asyncio.Semaphore):
+    fresh = await update_dedup.unseen([u["update_id"] for u in updates])
+    poll_stats["duplicates"] += len(updates) - len(fresh)
+
+    by_chat = {}
+    for update in updates:
+        if update["update_id"] in fresh:
+            by_chat.setdefault(update_chat_id(update), []).append(update)
+    if not by_chat:
+        return
+
+    # One query for every User in the batch instead of one per update
+    chat_ids = [c for c in by_chat if c is not None]
+    users = {}
+    if chat_ids:
+        async with async_session() as session:
+            rows = (await session.exec(select(User).where(User.telegram_id.in_(chat_ids)))).all()
+        for user in rows:
+            users[user.telegram_id] = user
+            await state_store.prime(user)
+
+    handled = await asyncio.gather(*(
+        _run_chat(chat_updates, users.get(chat_id), slots)
+        for chat_id, chat_updates in by_chat.items()
+    ))
+    await update_dedup.claim_many([update_id for chat in handled for update_id in chat])
+
+async def run(stop: asyncio.Event):
+    result = await delete_webhook()
+    if not result.get("ok"):
+        print(f"⚠️ deleteWebhook failed: {result.get('description')}")
+
+    slots = asyncio.Semaphore(POLL_CONCURRENCY)
+    offset = None
+    print("📡 Polling Telegram for updates...")
+    stopping = asyncio.create_task(stop.wait())
+    while not stop.is_set():
+        # Only the long poll itself is interruptible; a batch in progress always finishes
+        poll = asyncio.create_task(get_updates(offset, limit=POLL_LIMIT, timeout=POLL_TIMEOUT, allowed_updates=ALLOWED_UPDATES))
+        await asyncio.wait([poll, stopping], return_when=asyncio.FIRST_COMPLETED)
+        if not poll.done():
+            poll.cancel()  # updates in a cancelled poll are unconfirmed, so Telegram keeps them
+            await asyncio.gather(poll, return_exceptions=True)
+            break
+        updates = poll.result()
+        if updates is None:
+            await asyncio.sleep(POLL_ERROR_BACKOFF)
+            continue
+        if not updates:
+            continue
+
+        await process_batch(updates, slots)
+        poll_stats["batches"] += 1
+        poll_stats["updates"] += len(updates)
+        # Confirmed to Telegram by the next getUpdates call
+        offset = max(u["update_id"] for u in updates) + 1
+
+    stopping.cancel()
+    if offset is not None:
+        await get_updates(offset, limit=1, timeout=0)  # confirm the last batch before exiting
+    print(f"🛑 Polling stopped: {poll_stats}")
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows: Ctrl+C raises KeyboardInterrupt instead
+
+    async with lifespan(app):
+        await run(stop)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,16 +1,33 @@
+import os
+import asyncio
+import hashlib
 import qrcode
+from io import BytesIO
 from PIL import Image
+from dotenv import load_dotenv
 
-def generate_payment_qr(phone_number: str) -> str:
+from cache_utils import TTLCache
+from telegram_utils import send_photo
+
+load_dotenv()
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOGO_PATH = os.path.join(BASE_DIR, "assets", "logo.png")
+# Replace 'SikaSwiftBot' with your actual bot username (or set BOT_USERNAME)
+BOT_USERNAME = os.getenv("BOT_USERNAME", "SikaSwiftBot")
+QR_CACHE_SIZE = int(os.getenv("QR_CACHE_SIZE", "1000"))
+# Optional directory to persist rendered QR codes and their Telegram file_ids
+QR_CACHE_DIR = os.getenv("QR_CACHE_DIR")
+
+def generate_payment_qr(phone_number: str, bot_username: str = BOT_USERNAME) -> bytes:
     """
-    Generates a QR code that, when scanned, opens SikaSwift 
-    and initiates a payment to this phone number.
+    Generates a QR code that, when scanned, opens SikaSwift
+    and initiates a payment to this phone number. Returns PNG bytes.
     """
-    # 1. The Deep Link (Replace 'SikaSwiftBot' with your actual bot username)
+    # 1. The Deep Link
     # The format is: https://t.me/YOUR_BOT_USERNAME?start=PAYLOAD
-    bot_username = "SikaSwiftBot" 
     deep_link = f"https://t.me/{bot_username}?start=pay_{phone_number}"
-    
+
     # 2. Generate QR
     qr = qrcode.QRCode(
         version=1,
@@ -20,23 +37,120 @@ def generate_payment_qr(phone_number: str) -> str:
     )
     qr.add_data(deep_link)
     qr.make(fit=True)
-    
+
     img = qr.make_image(fill_color="black", back_color="white").convert('RGB')
-    
+
     # 3. Add Logo (Optional - reuses your receipt logo)
     try:
-        logo = Image.open("assets/logo.png")
+        logo = Image.open(LOGO_PATH).convert("RGBA")
         # Resize logo
         logo_size = 50
         logo = logo.resize((logo_size, logo_size))
-        
+
         # Calculate position (Center)
         pos = ((img.size[0] - logo_size) // 2, (img.size[1] - logo_size) // 2)
         img.paste(logo, pos, logo)
     except:
         pass # Skip if no logo found
 
-    # 4. Save
-    filename = f"qr_{phone_number}.png"
-    img.save(filename)
-    return filename
\ No newline at end of file
+    # 4. Encode
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+class QRCache:
+    """
+    The QR image depends only on (bot username, phone), so we render it once.
+    - PNG bytes live in an LRU (and optionally on disk under QR_CACHE_DIR).
+    - After the first upload we keep Telegram's file_id, so repeat /myqr
+      requests send the file_id and skip rendering and uploading entirely.
+    """
+    def __init__(self, maxsize: int = QR_CACHE_SIZE, cache_dir: str = QR_CACHE_DIR):
+        self.images = TTLCache(maxsize=maxsize, ttl=float("inf"))
+        self.file_ids = TTLCache(maxsize=maxsize * 10, ttl=float("inf"))
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, phone_number: str) -> str:
+        return hashlib.sha256(f"{BOT_USERNAME}:{phone_number}".encode()).hexdigest()[:32]
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.cache_dir, f"qr_{key}.{ext}")
+
+    def get_file_id(self, key: str):
+        file_id = self.file_ids.get(key)
+        if file_id is None and self.cache_dir:
+            try:
+                with open(self._path(key, "fileid")) as f:
+                    file_id = f.read().strip() or None
+            except OSError:
+                return None
+            if file_id:
+                self.file_ids.set(key, file_id)
+        return file_id
+
+    def set_file_id(self, key: str, file_id: str):
+        self.file_ids.set(key, file_id)
+        if self.cache_dir:
+            try:
+                with open(self._path(key, "fileid"), "w") as f:
+                    f.write(file_id)
+            except OSError as e:
+                print(f"⚠️ Could not persist QR file_id: {e}")
+
+    def forget_file_id(self, key: str):
+        self.file_ids.delete(key)
+        if self.cache_dir:
+            try: os.remove(self._path(key, "fileid"))
+            except OSError: pass
+
+    async def get_image(self, key: str, phone_number: str) -> bytes:
+        async def load():
+            if self.cache_dir:
+                try:
+                    with open(self._path(key, "png"), "rb") as f:
+                        return f.read()
+                except OSError:
+                    pass
+            # qrcode + PIL are CPU work -> keep them off the event loop
+            png = await asyncio.to_thread(generate_payment_qr, phone_number)
+            if self.cache_dir:
+                try:
+                    with open(self._path(key, "png"), "wb") as f:
+                        f.write(png)
+                except OSError as e:
+                    print(f"⚠️ Could not persist QR image: {e}")
+            return png
+        return await self.images.get_or_load(key, load)
+
+    def stats(self) -> dict:
+        return {"images": self.images.stats(), "file_ids": self.file_ids.stats()}
+
+qr_cache = QRCache()
+
+def _largest_file_id(response) -> str:
+    try:
+        return response["result"]["photo"][-1]["file_id"]
+    except (TypeError, KeyError, IndexError):
+        return None
+
+async def send_payment_qr(chat_id: str, phone_number: str, caption: str = ""):
+    """
+    Async: Sends the user's payment QR, reusing Telegram's file_id when we have one.
+    """
+    key = qr_cache.key(phone_number)
+
+    file_id = qr_cache.get_file_id(key)
+    if file_id:
+        response = await send_photo(chat_id, file_id, caption=caption)
+        if response and response.get("ok"):
+            return response
+        qr_cache.forget_file_id(key)  # Stale id (e.g. bot token changed): upload again
+
+    png = await qr_cache.get_image(key, phone_number)
+    response = await send_photo(chat_id, png, caption=caption, filename=f"qr_{phone_number}.png")
+    file_id = _largest_file_id(response)
+    if file_id:
+        qr_cache.set_file_id(key, file_id)
+    return response
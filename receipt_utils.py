@@ -1,77 +1,122 @@
 from PIL import Image, ImageDraw, ImageFont
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import threading
 import datetime
+import asyncio
 import os
 
-def generate_receipt(sender: str, recipient: str, amount: float, ref: str) -> str:
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOGO_PATH = os.path.join(BASE_DIR, "assets", "logo.png")
+RECEIPT_FONT = os.getenv("RECEIPT_FONT", "Arial.ttf")
+RECEIPT_WORKERS = int(os.getenv("RECEIPT_WORKERS", "2"))
+# zlib level for the PNG (1 = fastest, 9 = smallest). Receipts are flat colour, so low levels compress fine.
+RECEIPT_PNG_COMPRESS = int(os.getenv("RECEIPT_PNG_COMPRESS", "3"))
+
+WIDTH, HEIGHT = 600, 800
+LABELS = ["Sender", "Recipient", "Reference", "Date", "Time"]
+Y_START, SPACING = 350, 80
+
+_executor = None
+_template = None
+_fonts = None
+_init_lock = threading.Lock()
+
+def _load_fonts():
+    # Try/Except for cross-platform compatibility
+    try:
+        return {
+            "header": ImageFont.truetype(RECEIPT_FONT, 45),
+            "sub": ImageFont.truetype(RECEIPT_FONT, 25),
+            "bold": ImageFont.truetype(RECEIPT_FONT, 30),
+        }
+    except Exception:
+        default = ImageFont.load_default()
+        return {"header": default, "sub": default, "bold": default}
+
+def _build_template(fonts) -> Image.Image:
     """
-    Generates a branded PNG receipt with a logo.
+    Draws everything that is the same on every receipt: header, logo,
+    badge, row labels, dividers and footer.
     """
-    # 1. Canvas Setup
-    width, height = 600, 800
-    img = Image.new('RGB', (width, height), color='white')
+    img = Image.new('RGB', (WIDTH, HEIGHT), color='white')
     draw = ImageDraw.Draw(img)
-    
-    # 2. Load Fonts (Try/Except for cross-platform compatibility)
-    try:
-        font_header = ImageFont.truetype("Arial.ttf", 45)
-        font_sub = ImageFont.truetype("Arial.ttf", 25)
-        font_bold = ImageFont.truetype("Arial.ttf", 30)
-    except:
-        font_header = ImageFont.load_default()
-        font_sub = ImageFont.load_default()
-        font_bold = ImageFont.load_default()
-
-    # 3. DRAW THE HEADER (Green Bar)
-    draw.rectangle([(0, 0), (width, 120)], fill="#00C853") 
-    
-    # --- LOGO LOGIC START ---
+
+    # HEADER (Green Bar)
+    draw.rectangle([(0, 0), (WIDTH, 120)], fill="#00C853")
     try:
-        # Load logo
-        logo = Image.open("assets/logo.png")
-        
-        # Resize logo to be small (e.g., 80x80)
-        logo = logo.resize((80, 80))
-        
-        # Paste it (coordinates x=40, y=20)
+        logo = Image.open(LOGO_PATH).convert("RGBA").resize((80, 80))
         # The third argument 'logo' is the "mask" which keeps transparency working!
         img.paste(logo, (40, 20), logo)
-        
-        # Draw Text next to logo
-        draw.text((140, 35), "SikaSwift", fill="white", font=font_header)
+        draw.text((140, 35), "SikaSwift", fill="white", font=fonts["header"])
     except Exception as e:
         print(f"Logo not found: {e}")
-        # Fallback if no logo
-        draw.text((40, 35), "SikaSwift", fill="white", font=font_header)
-    # --- LOGO LOGIC END ---
-
-    # 4. DRAW TRANSACTION STATUS
-    draw.text((200, 180), f"GHS {amount:.2f}", fill="black", font=font_header)
-    draw.rectangle([(230, 240), (370, 280)], fill="#E8F5E9", outline="#00C853") # Success Badge
-    draw.text((255, 245), "SUCCESS", fill="#00C853", font=font_sub)
-
-    # 5. DRAW DETAILS TABLE
-    y_start = 350
-    spacing = 80
-    
-    details = [
-        ("Sender", sender),
-        ("Recipient", recipient),
-        ("Reference", ref),
-        ("Date", datetime.datetime.now().strftime("%Y-%m-%d")),
-        ("Time", datetime.datetime.now().strftime("%H:%M:%S")),
-    ]
-
-    for label, value in details:
-        draw.text((50, y_start), label, fill="gray", font=font_sub)
-        draw.text((300, y_start), value, fill="black", font=font_bold)
-        # Draw a thin divider line
-        draw.line([(50, y_start + 40), (550, y_start + 40)], fill="#f0f0f0", width=1)
-        y_start += spacing
-
-    # 6. FOOTER
-    draw.text((180, 750), "Thank you for using SikaSwift ⚡", fill="gray", font=font_sub)
-
-    # 7. SAVE
-    filename = f"receipt_{ref}.png"
-    img.save(filename)
-    return filename
\ No newline at end of file
+        draw.text((40, 35), "SikaSwift", fill="white", font=fonts["header"])
+
+    # STATUS BADGE
+    draw.rectangle([(230, 240), (370, 280)], fill="#E8F5E9", outline="#00C853")
+    draw.text((255, 245), "SUCCESS", fill="#00C853", font=fonts["sub"])
+
+    # DETAILS TABLE (labels + dividers)
+    y = Y_START
+    for label in LABELS:
+        draw.text((50, y), label, fill="gray", font=fonts["sub"])
+        draw.line([(50, y + 40), (550, y + 40)], fill="#f0f0f0", width=1)
+        y += SPACING
+
+    # FOOTER
+    draw.text((180, 750), "Thank you for using SikaSwift ⚡", fill="gray", font=fonts["sub"])
+    return img
+
+def _ensure_template():
+    global _template, _fonts
+    if _template is None:
+        with _init_lock:
+            if _template is None:
+                _fonts = _load_fonts()
+                _template = _build_template(_fonts)
+    return _template, _fonts
+
+def generate_receipt(sender: str, recipient: str, amount: float, ref: str) -> bytes:
+    """
+    Renders a branded PNG receipt and returns the encoded bytes.
+    Only the per-transaction fields are drawn; the rest comes from the template.
+    """
+    template, fonts = _ensure_template()
+    img = template.copy()
+    draw = ImageDraw.Draw(img)
+
+    draw.text((200, 180), f"GHS {amount:.2f}", fill="black", font=fonts["header"])
+
+    now = datetime.datetime.now()
+    values = [sender, recipient, ref, now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S")]
+    y = Y_START
+    for value in values:
+        draw.text((300, y), value, fill="black", font=fonts["bold"])
+        y += SPACING
+
+    buf = BytesIO()
+    img.save(buf, format="PNG", compress_level=RECEIPT_PNG_COMPRESS)
+    return buf.getvalue()
+
+async def render_receipt_async(sender: str, recipient: str, amount: float, ref: str) -> bytes:
+    """
+    Async: generate_receipt on a worker thread so PIL never blocks the event loop.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=RECEIPT_WORKERS, thread_name_prefix="receipt")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, generate_receipt, sender, recipient, amount, ref)
+
+def warm_up():
+    """
+    Loads fonts/logo and draws the template ahead of the first payout.
+    """
+    _ensure_template()
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,81 @@
+import os
+from datetime import datetime
+from sqlmodel import select
+from sqlalchemy.exc import IntegrityError
+from dotenv import load_dotenv
+
+from cache_utils import TTLCache
+from database import async_session
+from models import TransferRecipient
+from network_utils import normalize_phone
+from paystack_utils import create_transfer_recipient, get_paystack_bank_code
+
+load_dotenv()
+
+RECIPIENT_CACHE_TTL = float(os.getenv("RECIPIENT_CACHE_TTL", "86400"))
+RECIPIENT_CACHE_SIZE = int(os.getenv("RECIPIENT_CACHE_SIZE", "50000"))
+
+# (phone, bank_code) -> recipient_code, in front of the transfer_recipient table
+recipient_cache = TTLCache(maxsize=RECIPIENT_CACHE_SIZE, ttl=RECIPIENT_CACHE_TTL)
+
+async def get_recipient_code(session, phone: str, name: str = "Verified User", refresh: bool = False):
+    """
+    Returns a Paystack recipient_code for this number.
+    Lookup order: memory -> DB -> POST /transferrecipient (then stored).
+    refresh=True skips the stored code (use after Paystack rejects it).
+    Returns None if Paystack rejected the number; raises RuntimeError if it
+    did not answer, so a disburse job retries instead of refunding.
+    """
+    phone = normalize_phone(phone)
+    bank_code = get_paystack_bank_code(phone)
+    key = (phone, bank_code)
+
+    if not refresh:
+        code = recipient_cache.get(key)
+        if code:
+            return code
+
+        row = (await session.exec(
+            select(TransferRecipient).where(TransferRecipient.phone_number == phone, TransferRecipient.bank_code == bank_code)
+        )).first()
+        if row:
+            recipient_cache.set(key, row.recipient_code)
+            return row.recipient_code
+
+    recip = await create_transfer_recipient(name, phone)
+    if recip.get("transient"):
+        raise RuntimeError(f"Recipient for {phone} not created: {recip.get('message')}")
+    if not recip.get("status"):
+        return None
+    code = recip["data"]["recipient_code"]
+
+    await save_recipient_code(phone, bank_code, code)
+    recipient_cache.set(key, code)
+    return code
+
+async def save_recipient_code(phone: str, bank_code: str, code: str):
+    """
+    Upserts the mapping in its own short transaction, so it never commits
+    (and releases the row locks of) a disburse job's session.
+    """
+    async with async_session() as session:
+        row = (await session.exec(
+            select(TransferRecipient).where(TransferRecipient.phone_number == phone, TransferRecipient.bank_code == bank_code)
+        )).first()
+        if row:
+            row.recipient_code = code
+            row.updated_at = datetime.utcnow()
+        else:
+            row = TransferRecipient(phone_number=phone, bank_code=bank_code, recipient_code=code)
+        session.add(row)
+        try:
+            await session.commit()
+        except IntegrityError:
+            pass  # Another worker stored the same number first; theirs is just as good.
+
+def is_stale_recipient_error(response: dict) -> bool:
+    """
+    True if a failed /transfer looks like Paystack rejected the recipient itself.
+    """
+    message = (response.get("message") or "").lower()
+    return "recipient" in message and not response.get("transient")
@@ -0,0 +1,242 @@
+import os
+import time
+import asyncio
+from datetime import datetime, timedelta
+from sqlmodel import select
+from sqlalchemy import exists, tuple_
+from sqlalchemy.orm import aliased
+from dotenv import load_dotenv
+
+from database import async_session
+from models import Transaction
+from job_queue import enqueue, notify as notify_jobs
+from paystack_utils import verify_transaction, verify_transfer
+from scheduler_utils import TokenBucket
+from txn_state_utils import transition_many, complete_split_parents
+
+load_dotenv()
+
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "300"))       # seconds between scans; 0 disables
+RECONCILE_PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", "100"))
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", "4"))     # verify calls in flight
+RECONCILE_RATE = float(os.getenv("RECONCILE_RATE", "5"))                 # verify calls per second
+RECONCILE_MAX_PER_RUN = int(os.getenv("RECONCILE_MAX_PER_RUN", "2000"))  # verify calls per scan
+# A row is only "stuck" once it has sat in its status this long (the webhook normally beats us)
+RECONCILE_DEBIT_AFTER = float(os.getenv("RECONCILE_DEBIT_AFTER", "600"))
+RECONCILE_TRANSFER_AFTER = float(os.getenv("RECONCILE_TRANSFER_AFTER", "900"))
+# Charges Paystack still reports as pending after this long are given up on
+RECONCILE_ABANDON_AFTER = float(os.getenv("RECONCILE_ABANDON_AFTER", "86400"))
+
+DEBIT_STATUSES = ("WAITING_FOR_OTP", "PENDING_DEBIT", "DEBIT_SUCCESS")
+TRANSFER_STATUSES = ("DISBURSING",)
+RECONCILE_STATUSES = DEBIT_STATUSES + TRANSFER_STATUSES
+
+CHARGE_FAILED = ("failed", "abandoned", "reversed")
+TRANSFER_FAILED = ("failed", "reversed", "rejected", "blocked", "abandoned")
+
+class Reconciler:
+    """
+    Periodic safety net for lost Paystack webhooks.
+    - Finds transactions stuck in a debit or transfer status, oldest first, by
+      keyset pages on (status, updated_at, id) so no scan holds many rows.
+    - Asks Paystack for the real outcome with bounded concurrency and a
+      token-bucket rate budget shared by the whole scan.
+    - Applies each page's transitions as a few bulk compare-and-set UPDATEs,
+      so a webhook that lands in between always wins.
+    """
+    def __init__(self, interval: float = RECONCILE_INTERVAL):
+        self.interval = interval
+        self.bucket = TokenBucket(rate=RECONCILE_RATE, capacity=max(1.0, RECONCILE_RATE))
+        self._slots = None
+        self._task = None
+        self._stop = None
+        self.drift = {}
+        self.stats_counters = {
+            "runs": 0, "scanned": 0, "verified": 0, "verify_errors": 0,
+            "unresolved": 0, "lost_races": 0, "errors": 0,
+        }
+        self.last_run = {}
+
+    async def start(self):
+        if self.interval <= 0:
+            return
+        self._stop = asyncio.Event()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stop.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _loop(self):
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats_counters["errors"] += 1
+                print(f"⚠️ Reconciler error: {e}")
+
+    # --- scan ---
+
+    async def run_once(self) -> dict:
+        """
+        One full scan. Returns the transitions applied, e.g. {"PENDING_DEBIT->PENDING_DISBURSE": 3}.
+        """
+        started = time.perf_counter()
+        self._slots = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+        budget = RECONCILE_MAX_PER_RUN
+        applied = {}
+
+        for status in RECONCILE_STATUSES:
+            stale_after = RECONCILE_TRANSFER_AFTER if status in TRANSFER_STATUSES else RECONCILE_DEBIT_AFTER
+            async for page in self._pages(status, stale_after, budget):
+                budget -= len(page)
+                results = await asyncio.gather(*(self._verify(status, row) for row in page))
+                for transition, count in (await self._apply(status, page, results)).items():
+                    applied[transition] = applied.get(transition, 0) + count
+            if budget <= 0:
+                break
+
+        rolled_up = await self._complete_split_parents()
+        if rolled_up:
+            applied["DISBURSING->COMPLETE (split)"] = rolled_up
+
+        for transition, count in applied.items():
+            self.drift[transition] = self.drift.get(transition, 0) + count
+        self.stats_counters["runs"] += 1
+        self.last_run = {
+            "at": datetime.utcnow().isoformat(),
+            "ms": round((time.perf_counter() - started) * 1000, 1),
+            "checked": RECONCILE_MAX_PER_RUN - budget,
+            "drift": applied,
+        }
+        if applied:
+            print(f"🔁 Reconciled: {applied}")
+        return applied
+
+    async def _pages(self, status: str, stale_after: float, budget: int):
+        """
+        Yields pages of stale rows in `status`, oldest first, until the budget runs out.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=stale_after)
+        leg = aliased(Transaction)
+        last = None
+        while budget > 0:
+            statement = select(
+                Transaction.id, Transaction.paystack_reference, Transaction.created_at, Transaction.updated_at,
+            ).where(Transaction.status == status, Transaction.updated_at < cutoff)
+            if status in TRANSFER_STATUSES:
+                # A split parent has no transfer of its own; it completes when its legs do
+                statement = statement.where(~exists().where(leg.parent_id == Transaction.id))
+            if last is not None:
+                statement = statement.where(tuple_(Transaction.updated_at, Transaction.id) > last)
+            statement = statement.order_by(Transaction.updated_at, Transaction.id).limit(min(RECONCILE_PAGE_SIZE, budget))
+
+            async with async_session() as session:
+                page = (await session.exec(statement)).all()
+            if not page:
+                return
+            self.stats_counters["scanned"] += len(page)
+            budget -= len(page)
+            yield page
+            if len(page) < RECONCILE_PAGE_SIZE:
+                return
+            last = (page[-1].updated_at, page[-1].id)
+
+    async def _verify(self, status: str, row) -> dict:
+        if status not in TRANSFER_STATUSES and not row.paystack_reference:
+            return {"status": False, "message": "No Paystack reference"}
+        async with self._slots:
+            wait = self.bucket.wait_time()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self.bucket.wait_time()
+            self.bucket.take()
+            if status in TRANSFER_STATUSES:
+                resp = await verify_transfer(f"trf_{row.id}")
+            else:
+                resp = await verify_transaction(row.paystack_reference)
+        self.stats_counters["verified"] += 1
+        if resp.get("transient"):
+            self.stats_counters["verify_errors"] += 1
+        return resp
+
+    # --- apply ---
+
+    def _target(self, status: str, row, resp: dict):
+        """
+        The status Paystack's answer moves `row` to, or None to leave it alone.
+        """
+        if resp.get("transient"):
+            return None
+        remote = (resp.get("data") or {}).get("status") if resp.get("status") else None
+        if status in TRANSFER_STATUSES:
+            if remote == "success":
+                return "COMPLETE"
+            if remote in TRANSFER_FAILED:
+                return "TRANSFER_FAILED"
+            return None
+        if remote == "success":
+            return "PENDING_DISBURSE"
+        if remote in CHARGE_FAILED:
+            return "DEBIT_FAILED"
+        # Still pending at Paystack, or a reference Paystack never saw
+        if row.created_at < datetime.utcnow() - timedelta(seconds=RECONCILE_ABANDON_AFTER):
+            return "ABANDONED"
+        return None
+
+    async def _apply(self, status: str, page: list, results: list) -> dict:
+        targets = {}
+        for row, resp in zip(page, results):
+            target = self._target(status, row, resp)
+            if target is None:
+                self.stats_counters["unresolved"] += 1
+            else:
+                targets.setdefault(target, []).append(row.id)
+        if not targets:
+            return {}
+
+        applied = {}
+        async with async_session() as session:
+            for target, ids in targets.items():
+                # Compare-and-set on the old status: rows a webhook moved meanwhile are skipped
+                moved = await transition_many(session, ids, status, target)
+                self.stats_counters["lost_races"] += len(ids) - len(moved)
+                for txn_id in moved:
+                    if target == "PENDING_DISBURSE":
+                        enqueue(session, "disburse", {"transaction_id": str(txn_id), "event": "reconcile"})
+                    elif target == "TRANSFER_FAILED":
+                        enqueue(session, "refund", {"transaction_id": str(txn_id), "event": "reconcile"})
+                if moved:
+                    applied[f"{status}->{target}"] = len(moved)
+            await session.commit()
+        if "PENDING_DISBURSE" in targets or "TRANSFER_FAILED" in targets:
+            notify_jobs()
+        return applied
+
+    async def _complete_split_parents(self) -> int:
+        async with async_session() as session:
+            done = await complete_split_parents(session)
+            await session.commit()
+            return done
+
+    def stats(self) -> dict:
+        return {
+            **self.stats_counters,
+            "drift": dict(self.drift),
+            "rate_per_s": RECONCILE_RATE,
+            "interval_s": self.interval,
+            "last_run": self.last_run,
+        }
+
+reconciler = Reconciler()
@@ -0,0 +1,225 @@
+import time
+import functools
+
+class Route:
+    __slots__ = ("name", "handler", "load_user", "auth")
+
+    def __init__(self, name: str, handler, load_user: bool = False, auth: bool = False):
+        self.name = name
+        self.handler = handler
+        self.load_user = load_user or auth
+        self.auth = auth
+
+class UpdateContext:
+    """
+    Everything a handler needs about one Telegram update.
+    The User row and conversation state are only fetched when a route or
+    handler asks for them.
+    """
+    def __init__(self, data: dict, session, user_loader, state_loader):
+        self.data = data
+        self.session = session
+        self.callback = data.get("callback_query")
+        if self.callback:
+            self.msg = self.callback.get("message") or {}
+        else:
+            self.msg = data.get("message") or {}
+        chat = self.msg.get("chat")
+        self.chat_id = str(chat["id"]) if chat else None
+        self.message_id = self.msg.get("message_id")
+        self.text = (self.msg.get("text") or "").strip() if not self.callback else ""
+        self.command = None
+        self.args = ""
+        self.route = None
+        self.user = None
+        self.state = None
+        self._user_loader = user_loader
+        self._user_loaded = False
+        self._state_loader = state_loader
+        self._state_loaded = False
+
+    async def get_user(self):
+        if not self._user_loaded:
+            self.user = await self._user_loader(self.session, self.chat_id)
+            self._user_loaded = True
+        return self.user
+
+    async def get_state(self):
+        """
+        The chat's conversation state (anything with a `.name`), or None for unknown chats.
+        """
+        if not self._state_loaded:
+            self.state = await self._state_loader(self.session, self.chat_id)
+            self._state_loaded = True
+        return self.state
+
+class Router:
+    """
+    Table-driven dispatch for Telegram updates. Resolution order for a message:
+      1. "/start <prefix>..." deep links  (prefix table, e.g. "pay_")
+      2. "/command ..."                   (command table)
+      3. the chat's conversation state     (state table)
+      4. the text fallback
+    Contacts and callback queries have one route each. Every lookup is a dict
+    hit; handlers run inside the middleware chain as handler(ctx).
+    """
+    def __init__(self, user_loader, state_loader):
+        self.user_loader = user_loader
+        self.state_loader = state_loader
+        self.commands = {}
+        self.states = {}
+        self.deep_links = {}
+        self.contact_route = None
+        self.callback_route = None
+        self.text_route = None
+        self.middleware = []
+
+    # --- registration ---
+
+    def use(self, middleware):
+        """
+        Adds middleware(ctx, call_next); the first one added runs outermost.
+        """
+        self.middleware.append(middleware)
+        return middleware
+
+    def command(self, name: str, load_user: bool = False, auth: bool = False):
+        def decorator(fn):
+            self.commands[name] = Route(name, fn, load_user, auth)
+            return fn
+        return decorator
+
+    def state(self, name: str, load_user: bool = False):
+        def decorator(fn):
+            self.states[name] = Route(f"state:{name}", fn, load_user)
+            return fn
+        return decorator
+
+    def deep_link(self, prefix: str, load_user: bool = False, auth: bool = False):
+        """
+        Handles "/start <prefix><payload>"; ctx.args is set to the payload.
+        Prefixes must end with "_".
+        """
+        def decorator(fn):
+            self.deep_links[prefix] = Route(f"start:{prefix}", fn, load_user, auth)
+            return fn
+        return decorator
+
+    def contact(self, load_user: bool = True):
+        def decorator(fn):
+            self.contact_route = Route("contact", fn, load_user)
+            return fn
+        return decorator
+
+    def callback(self, load_user: bool = False):
+        def decorator(fn):
+            self.callback_route = Route("callback", fn, load_user)
+            return fn
+        return decorator
+
+    def text(self, load_user: bool = True):
+        def decorator(fn):
+            self.text_route = Route("text", fn, load_user)
+            return fn
+        return decorator
+
+    # --- dispatch ---
+
+    async def resolve(self, ctx: UpdateContext):
+        if ctx.callback:
+            return self.callback_route
+        if ctx.chat_id is None:
+            return None
+        if "contact" in ctx.msg:
+            return self.contact_route
+        if not ctx.text:
+            return None
+
+        if ctx.text.startswith("/"):
+            command, _, args = ctx.text.partition(" ")
+            ctx.command, ctx.args = command, args.strip()
+            if command == "/start" and ctx.args:
+                prefix, sep, payload = ctx.args.partition("_")
+                route = self.deep_links.get(prefix + sep)
+                if route:
+                    ctx.args = payload
+                    return route
+            route = self.commands.get(command)
+            if route:
+                return route
+
+        state = await ctx.get_state()
+        if state is not None:
+            route = self.states.get(state.name)
+            if route:
+                return route
+        return self.text_route
+
+    async def dispatch(self, data: dict, session):
+        ctx = UpdateContext(data, session, self.user_loader, self.state_loader)
+        ctx.route = await self.resolve(ctx)
+        if ctx.route is None:
+            return
+
+        call = functools.partial(ctx.route.handler, ctx)
+        for middleware in reversed(self.middleware):
+            call = functools.partial(middleware, ctx, call)
+        await call()
+
+# --- STANDARD MIDDLEWARE ---
+
+class RouteTimer:
+    """
+    Middleware that records count / errors / latency per route name.
+    """
+    def __init__(self):
+        self.routes = {}
+
+    async def __call__(self, ctx: UpdateContext, call_next):
+        started = time.perf_counter()
+        failed = False
+        try:
+            await call_next()
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            stats = self.routes.get(ctx.route.name)
+            if stats is None:
+                stats = self.routes[ctx.route.name] = {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}
+            stats["count"] += 1
+            stats["errors"] += failed
+            stats["total_ms"] += elapsed
+            stats["max_ms"] = max(stats["max_ms"], elapsed)
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "count": s["count"],
+                "errors": s["errors"],
+                "avg_ms": round(s["total_ms"] / s["count"], 1) if s["count"] else 0.0,
+                "max_ms": round(s["max_ms"], 1),
+            }
+            for name, s in self.routes.items()
+        }
+
+async def load_user(ctx: UpdateContext, call_next):
+    """
+    Middleware: fetches the User row for routes declared with load_user/auth.
+    """
+    if ctx.route.load_user:
+        await ctx.get_user()
+    await call_next()
+
+def require_user(on_missing):
+    """
+    Middleware factory: routes declared with auth=True only run for registered
+    users; everyone else gets on_missing(ctx).
+    """
+    async def middleware(ctx: UpdateContext, call_next):
+        if ctx.route.auth and await ctx.get_user() is None:
+            await on_missing(ctx)
+            return
+        await call_next()
+    return middleware
@@ -0,0 +1,280 @@
+import time
+import heapq
+import asyncio
+import itertools
+
+# --- PRIORITIES (lower runs first) ---
+CRITICAL = 0   # PIN deletion, callback answers
+HIGH = 1       # keyboard edits, prompts the user is waiting on
+NORMAL = 2     # regular messages, photos
+LOW = 3        # typing indicators
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens/sec, holding at most `capacity`.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float = None) -> float:
+        """
+        Seconds until one token is available (0 if available now).
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float = None):
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= 1
+
+class RetryAfter(Exception):
+    """
+    Raised by a send function when the API answered 429.
+    """
+    def __init__(self, retry_after: float, response=None):
+        super().__init__(f"Rate limited, retry after {retry_after}s")
+        self.retry_after = retry_after
+        self.response = response
+
+class _Item:
+    __slots__ = ("priority", "seq", "key", "limited", "args", "future", "enqueued_at", "attempts")
+
+    def __init__(self, priority, seq, key, limited, args, future):
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.limited = limited
+        self.args = args
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class OutboundScheduler:
+    """
+    Priority queue in front of a rate-limited API.
+
+    - One global token bucket for every call, plus a per-key bucket (chat_id)
+      for calls marked `limited` (messages/photos).
+    - Each key has its own priority heap and at most one call in flight, so
+      a chat's messages go out in order while different chats run in parallel.
+    - `send(*args)` raising RetryAfter pushes the item back and blocks that
+      key (or everything, for calls not marked `limited`) for `retry_after` seconds.
+    - When the queue is full, NORMAL/LOW items are dropped (counted) and
+      CRITICAL/HIGH are still accepted.
+    """
+    def __init__(self, send, global_rate: float, key_rate: float, key_burst: float,
+                 max_queue: int = 10_000, concurrency: int = 32, max_retries: int = 3):
+        self.send = send
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.key_rate = key_rate
+        self.key_burst = key_burst
+        self.max_queue = max_queue
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+
+        self._queues = {}          # key -> heap of _Item
+        self._buckets = {}         # key -> TokenBucket
+        self._blocked = {}         # key -> monotonic time the key may send again
+        self._in_flight = set()    # keys with a call in progress
+        self._ready = []           # heap of (priority, seq, key)
+        self._waiting = []         # heap of (ready_at, key)
+        self._paused_until = 0.0
+        self._seq = itertools.count()
+        self._depth = 0
+        self._wake = None
+        self._task = None
+        self._slots = None
+        self._sending = set()
+        self.stats_counters = {"queued": 0, "sent": 0, "dropped": 0, "rate_limited": 0, "retries": 0, "errors": 0}
+
+    # --- lifecycle ---
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        for heap in self._queues.values():
+            for item in heap:
+                if not item.future.done():
+                    item.future.cancel()
+        self._queues.clear()
+        self._ready.clear()
+        self._waiting.clear()
+        self._in_flight.clear()
+        self._depth = 0
+
+    # --- producer side ---
+
+    def submit(self, key, *args, priority: int = NORMAL, limited: bool = True) -> asyncio.Future:
+        """
+        Queues send(*args). Returns a future with send()'s result
+        (None if the item was dropped).
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        if self._depth >= self.max_queue and priority >= NORMAL:
+            self.stats_counters["dropped"] += 1
+            future.set_result(None)
+            return future
+
+        item = _Item(priority, next(self._seq), key, limited, args, future)
+        heapq.heappush(self._queues.setdefault(key, []), item)
+        self._depth += 1
+        self.stats_counters["queued"] += 1
+        self._schedule(key)
+        self._wake.set()
+        return future
+
+    def _schedule(self, key):
+        heap = self._queues.get(key)
+        if not heap or key in self._in_flight:
+            return
+        head = heap[0]
+        heapq.heappush(self._ready, (head.priority, head.seq, key))
+
+    # --- dispatcher ---
+
+    def _key_bucket(self, key) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.key_rate, self.key_burst)
+        return bucket
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+
+            while self._waiting and self._waiting[0][0] <= now:
+                _, key = heapq.heappop(self._waiting)
+                self._schedule(key)
+
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            if not self._ready:
+                timeout = self._waiting[0][0] - now if self._waiting else None
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            priority, seq, key = heapq.heappop(self._ready)
+            heap = self._queues.get(key)
+            if not heap or key in self._in_flight or (heap[0].priority, heap[0].seq) != (priority, seq):
+                continue  # stale entry
+            item = heap[0]
+
+            blocked_until = self._blocked.get(key, 0.0)
+            if blocked_until > now:
+                heapq.heappush(self._waiting, (blocked_until, key))
+                continue
+            if item.limited:
+                wait = self._key_bucket(key).wait_time(now)
+                if wait > 0:
+                    heapq.heappush(self._waiting, (now + wait, key))
+                    continue
+            wait = self.global_bucket.wait_time(now)
+            if wait > 0:
+                heapq.heappush(self._ready, (priority, seq, key))
+                await asyncio.sleep(wait)
+                continue
+
+            heapq.heappop(heap)
+            self._depth -= 1
+            if not heap:
+                del self._queues[key]
+            self.global_bucket.take(now)
+            if item.limited:
+                self._key_bucket(key).take(now)
+            self._in_flight.add(key)
+
+            await self._slots.acquire()
+            task = asyncio.create_task(self._send(item))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, item: _Item):
+        try:
+            result = await self.send(*item.args)
+            self.stats_counters["sent"] += 1
+            if not item.future.done():
+                item.future.set_result(result)
+        except RetryAfter as e:
+            self.stats_counters["rate_limited"] += 1
+            item.attempts += 1
+            resume = time.monotonic() + e.retry_after
+            if not item.limited:
+                self._paused_until = max(self._paused_until, resume)
+            else:
+                self._blocked[item.key] = resume
+            if item.attempts > self.max_retries:
+                self.stats_counters["dropped"] += 1
+                if not item.future.done():
+                    item.future.set_result(e.response)
+            else:
+                self.stats_counters["retries"] += 1
+                heapq.heappush(self._queues.setdefault(item.key, []), item)
+                self._depth += 1
+        except Exception as e:
+            self.stats_counters["errors"] += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+        finally:
+            self._slots.release()
+            self._in_flight.discard(item.key)
+            if self._blocked.get(item.key, 0.0) <= time.monotonic():
+                self._blocked.pop(item.key, None)
+            self._schedule(item.key)
+            if self._wake is not None:
+                self._wake.set()
+            self._trim_buckets()
+
+    def _trim_buckets(self):
+        # Idle per-chat buckets are full again after key_burst/key_rate seconds; drop them.
+        if len(self._buckets) > 50_000:
+            idle = [k for k in self._buckets if k not in self._queues and k not in self._in_flight]
+            for k in idle:
+                del self._buckets[k]
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        by_priority = {CRITICAL: 0, HIGH: 0, NORMAL: 0, LOW: 0}
+        oldest = 0.0
+        for heap in self._queues.values():
+            for item in heap:
+                by_priority[item.priority] = by_priority.get(item.priority, 0) + 1
+                oldest = max(oldest, now - item.enqueued_at)
+        return {
+            "depth": self._depth,
+            "depth_by_priority": {"critical": by_priority[CRITICAL], "high": by_priority[HIGH], "normal": by_priority[NORMAL], "low": by_priority[LOW]},
+            "in_flight": len(self._in_flight),
+            "oldest_wait_s": round(oldest, 3),
+            "paused_for_s": round(max(0.0, self._paused_until - now), 3),
+            **self.stats_counters,
+        }
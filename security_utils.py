@@ -1,4 +1,42 @@
+import os
+import time
+import asyncio
 import bcrypt
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- CONFIGURATION ---
+# bcrypt work factor for new hashes. Existing hashes at a lower cost are
+# upgraded the next time the user enters the right PIN (see needs_rehash).
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# bcrypt releases the GIL, so a small thread pool gives real parallelism.
+PIN_HASH_WORKERS = int(os.getenv("PIN_HASH_WORKERS", "4"))
+# Max bcrypt jobs running or queued at once, and how long to wait for a slot.
+PIN_MAX_CONCURRENT = int(os.getenv("PIN_MAX_CONCURRENT", "8"))
+PIN_ADMISSION_TIMEOUT = float(os.getenv("PIN_ADMISSION_TIMEOUT", "5"))
+# Per-user attempt budget: N attempts per sliding window (seconds).
+PIN_MAX_ATTEMPTS = int(os.getenv("PIN_MAX_ATTEMPTS", "5"))
+PIN_ATTEMPT_WINDOW = float(os.getenv("PIN_ATTEMPT_WINDOW", "300"))
+
+class PinBusyError(Exception):
+    """
+    Raised when too much bcrypt work is already in flight.
+    """
+
+class PinRateLimitError(Exception):
+    """
+    Raised when a user exceeds PIN_MAX_ATTEMPTS within PIN_ATTEMPT_WINDOW.
+    """
+    def __init__(self, retry_after: float):
+        super().__init__(f"Too many PIN attempts. Retry in {int(retry_after)}s.")
+        self.retry_after = retry_after
+
+_executor = None
+_slots = None
+_attempts = {}  # user_key -> deque of attempt timestamps
 
 def hash_pin(pin: str) -> str:
     """
@@ -6,7 +44,7 @@ def hash_pin(pin: str) -> str:
     """
     # bcrypt requires bytes, not strings
     pin_bytes = pin.encode('utf-8')
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(pin_bytes, salt)
     return hashed.decode('utf-8') # Return as string for database
 
@@ -16,8 +54,83 @@ def verify_pin(plain_pin: str, hashed_pin: str) -> bool:
     """
     if not hashed_pin:
         return False
-    
+
     pin_bytes = plain_pin.encode('utf-8')
     hashed_bytes = hashed_pin.encode('utf-8')
-    
-    return bcrypt.checkpw(pin_bytes, hashed_bytes)
\ No newline at end of file
+
+    return bcrypt.checkpw(pin_bytes, hashed_bytes)
+
+def needs_rehash(hashed_pin: str) -> bool:
+    """
+    True if the stored hash was made with a lower cost than BCRYPT_ROUNDS.
+    Hash format: $2b$<cost>$<salt+hash>
+    """
+    try:
+        return int(hashed_pin.split("$")[2]) < BCRYPT_ROUNDS
+    except (AttributeError, IndexError, ValueError):
+        return False
+
+def check_attempt_rate(user_key: str):
+    """
+    Records one PIN attempt for this user, or raises PinRateLimitError.
+    """
+    now = time.monotonic()
+    if len(_attempts) > 10_000:
+        # Drop users whose whole window has expired so the map stays bounded.
+        for key in [k for k, w in _attempts.items() if not w or now - w[-1] > PIN_ATTEMPT_WINDOW]:
+            del _attempts[key]
+    window = _attempts.setdefault(user_key, deque())
+    while window and now - window[0] > PIN_ATTEMPT_WINDOW:
+        window.popleft()
+    if len(window) >= PIN_MAX_ATTEMPTS:
+        raise PinRateLimitError(PIN_ATTEMPT_WINDOW - (now - window[0]))
+    window.append(now)
+
+def reset_attempts(user_key: str):
+    """
+    Clears the attempt history after a successful verification.
+    """
+    _attempts.pop(user_key, None)
+
+async def _run_bcrypt(fn, *args):
+    global _executor, _slots
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=PIN_HASH_WORKERS, thread_name_prefix="bcrypt")
+    if _slots is None:
+        _slots = asyncio.Semaphore(PIN_MAX_CONCURRENT)
+    try:
+        await asyncio.wait_for(_slots.acquire(), timeout=PIN_ADMISSION_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise PinBusyError("PIN service is busy. Try again shortly.")
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, fn, *args)
+    finally:
+        _slots.release()
+
+async def hash_pin_async(pin: str) -> str:
+    """
+    Async: hash_pin on the bcrypt pool, so the event loop keeps serving chats.
+    """
+    return await _run_bcrypt(hash_pin, pin)
+
+async def verify_pin_async(plain_pin: str, hashed_pin: str, user_key: str = None) -> bool:
+    """
+    Async: verify_pin on the bcrypt pool. When user_key is given the attempt
+    counts against that user's rate limit (raises PinRateLimitError).
+    """
+    if user_key is not None:
+        check_attempt_rate(user_key)
+    ok = await _run_bcrypt(verify_pin, plain_pin, hashed_pin)
+    if ok and user_key is not None:
+        reset_attempts(user_key)
+    return ok
+
+def shutdown():
+    """
+    Stops the bcrypt pool on app shutdown.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
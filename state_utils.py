@@ -0,0 +1,253 @@
+import os
+import json
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Optional, List
+from sqlmodel import SQLModel
+from sqlalchemy import update
+from dotenv import load_dotenv
+
+from cache_utils import TTLCache
+from models import User
+
+load_dotenv()
+
+IDLE = "IDLE"
+# What an expired PIN prompt reads as, so a late PIN reply is still caught (and deleted)
+PIN_EXPIRED = "PIN_EXPIRED"
+
+# How long an unanswered prompt stays valid before the chat falls back to IDLE
+STATE_TTL = float(os.getenv("STATE_TTL", "900"))
+STATE_PIN_TTL = float(os.getenv("STATE_PIN_TTL", "300"))
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "50000"))
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "3600"))
+# App processes (uvicorn/gunicorn read the same variable). With more than one the in-process cache is off.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# --- TYPED PAYLOADS (stored as JSON in User.temp_data) ---
+
+class PaymentDraft(SQLModel):
+    """
+    AWAITING_PIN_AUTH: the payment the user is confirming.
+    """
+    amount: float
+    recipient: str
+
+class RecipientDraft(SQLModel):
+    """
+    AWAITING_EDIT_AMOUNT / AWAITING_QR_AMOUNT: who we are waiting to get an amount for.
+    """
+    recipient: str
+
+class SplitLeg(SQLModel):
+    recipient: str
+    name: str
+    amount: float
+
+class SplitDraft(SQLModel):
+    """
+    AWAITING_SPLIT_CONFIRM / AWAITING_SPLIT_PIN: one charge for `total`, paid out as `legs`.
+    """
+    total: float
+    legs: List[SplitLeg]
+
+STATE_PAYLOADS = {
+    "AWAITING_PIN_AUTH": PaymentDraft,
+    "AWAITING_EDIT_AMOUNT": RecipientDraft,
+    "AWAITING_QR_AMOUNT": RecipientDraft,
+    "AWAITING_SPLIT_CONFIRM": SplitDraft,
+    "AWAITING_SPLIT_PIN": SplitDraft,
+}
+
+PIN_STATES = ("AWAITING_PIN_AUTH", "AWAITING_SPLIT_PIN", "AWAITING_NEW_PIN")
+STATE_TTLS = {name: STATE_PIN_TTL for name in PIN_STATES}
+
+def encode_payload(payload) -> Optional[str]:
+    return payload.model_dump_json() if payload is not None else None
+
+def decode_payload(state: str, raw: Optional[str]):
+    """
+    Parses temp_data for this state. Also reads the old formats
+    ("amount|recipient" and a bare phone number) written before payloads were typed.
+    """
+    model = STATE_PAYLOADS.get(state)
+    if model is None or not raw:
+        return None
+    try:
+        return model.model_validate(json.loads(raw))
+    except (ValueError, TypeError):
+        pass
+    try:
+        if model is PaymentDraft:
+            amount, recipient = raw.split("|")
+            return PaymentDraft(amount=float(amount), recipient=recipient)
+        if model is RecipientDraft:
+            return RecipientDraft(recipient=raw)
+        return None
+    except ValueError:
+        return None
+
+class ConversationState:
+    __slots__ = ("name", "payload", "expires_at")
+
+    def __init__(self, name: str = IDLE, payload=None, expires_at: Optional[datetime] = None):
+        self.name = name
+        self.payload = payload
+        self.expires_at = expires_at
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at is not None and self.expires_at <= datetime.utcnow()
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "name": self.name,
+            "payload": encode_payload(self.payload),
+            "expires_at": self.expires_at.isoformat() if self.expires_at else None,
+        })
+
+    @classmethod
+    def from_json(cls, raw: str) -> "ConversationState":
+        data = json.loads(raw)
+        expires_at = datetime.fromisoformat(data["expires_at"]) if data.get("expires_at") else None
+        return cls(data["name"], decode_payload(data["name"], data.get("payload")), expires_at)
+
+    @classmethod
+    def from_user(cls, user: User) -> "ConversationState":
+        return cls(user.state or IDLE, decode_payload(user.state, user.temp_data), user.state_expires_at)
+
+# --- BACKENDS ---
+
+class StateBackend(ABC):
+    """
+    Where ConversationStore keeps hot state. A shared implementation (e.g. Redis,
+    storing ConversationState.to_json()) lets several app processes share one view.
+    """
+    @abstractmethod
+    async def get(self, chat_id: str) -> Optional[ConversationState]:
+        ...
+
+    @abstractmethod
+    async def set(self, chat_id: str, state: ConversationState):
+        ...
+
+    @abstractmethod
+    async def delete(self, chat_id: str):
+        ...
+
+    def stats(self) -> dict:
+        return {}
+
+class MemoryStateBackend(StateBackend):
+    """
+    In-process LRU. Correct for a single process (the update pipeline keeps a
+    chat on one worker); use a shared backend when running several processes.
+    """
+    def __init__(self, maxsize: int = STATE_CACHE_SIZE, ttl: float = STATE_CACHE_TTL):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, chat_id):
+        return self.cache.get(chat_id)
+
+    async def set(self, chat_id, state):
+        self.cache.set(chat_id, state)
+
+    async def delete(self, chat_id):
+        self.cache.delete(chat_id)
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+class NoStateBackend(StateBackend):
+    """
+    Caches nothing: every read loads the User row. Used with several app
+    processes, where a per-process cache would serve another process's stale state.
+    """
+    async def get(self, chat_id):
+        return None
+
+    async def set(self, chat_id, state):
+        pass
+
+    async def delete(self, chat_id):
+        pass
+
+    def stats(self) -> dict:
+        return {"disabled": True}
+
+def default_backend() -> StateBackend:
+    if WEB_CONCURRENCY > 1:
+        print(f"⚠️ WEB_CONCURRENCY={WEB_CONCURRENCY}: conversation state cache disabled, every read hits the DB.")
+        return NoStateBackend()
+    return MemoryStateBackend()
+
+# --- STORE ---
+
+class ConversationStore:
+    """
+    User.state / User.temp_data with a cache in front (none with WEB_CONCURRENCY > 1).
+    - Reads come from the backend; only a miss loads the User row.
+    - Writes go to the DB first (committing the caller's session), then the backend.
+    - Prompts expire after STATE_TTL (STATE_PIN_TTL for PIN prompts);
+      an expired state reads as IDLE, an expired PIN prompt as PIN_EXPIRED.
+    """
+    def __init__(self, backend: StateBackend = None):
+        self.backend = backend or default_backend()
+        self.stats_counters = {"reads": 0, "db_loads": 0, "writes": 0, "expired": 0}
+
+    async def get(self, session, chat_id: str) -> Optional[ConversationState]:
+        """
+        The chat's current state, or None if the chat has no User row.
+        """
+        self.stats_counters["reads"] += 1
+        state = await self.backend.get(chat_id)
+        if state is None:
+            self.stats_counters["db_loads"] += 1
+            user = await session.get(User, chat_id)
+            if user is None:
+                return None
+            state = ConversationState.from_user(user)
+            await self.backend.set(chat_id, state)
+        if state.expired:
+            self.stats_counters["expired"] += 1
+            return ConversationState(PIN_EXPIRED if state.name in PIN_STATES else IDLE)
+        return state
+
+    async def prime(self, user: User):
+        """
+        Seeds the backend from a User row the caller already loaded (batch preloading).
+        """
+        if await self.backend.get(user.telegram_id) is None:
+            await self.backend.set(user.telegram_id, ConversationState.from_user(user))
+
+    async def set(self, session, chat_id: str, name: str, payload=None) -> bool:
+        """
+        Moves the chat to `name` and commits the session. Returns False if the chat has no User row.
+        """
+        ttl = STATE_TTLS.get(name, STATE_TTL)
+        expires_at = datetime.utcnow() + timedelta(seconds=ttl) if name != IDLE else None
+        result = await session.execute(
+            update(User)
+            .where(User.telegram_id == chat_id)
+            .values(state=name, temp_data=encode_payload(payload), state_expires_at=expires_at)
+        )
+        await session.commit()
+        self.stats_counters["writes"] += 1
+        if not result.rowcount:
+            await self.backend.delete(chat_id)
+            return False
+        await self.backend.set(chat_id, ConversationState(name, payload, expires_at))
+        return True
+
+    async def clear(self, session, chat_id: str) -> bool:
+        return await self.set(session, chat_id, IDLE)
+
+    def stats(self) -> dict:
+        reads = self.stats_counters["reads"]
+        return {
+            **self.stats_counters,
+            "db_free_rate": round(1 - self.stats_counters["db_loads"] / reads, 4) if reads else 0.0,
+            "backend": self.backend.stats(),
+        }
+
+state_store = ConversationStore()
@@ -0,0 +1,166 @@
+import io
+import os
+import csv
+import tempfile
+from datetime import datetime
+from dotenv import load_dotenv
+
+from history_utils import STATUS_GROUPS, recipient_label
+
+load_dotenv()
+
+# Statements are written to a temp file (in memory up to this size, then disk)
+STATEMENT_SPOOL_MAX = int(os.getenv("STATEMENT_SPOOL_MAX", str(4 * 1024 * 1024)))
+# Telegram bots may upload documents up to 50 MB
+STATEMENT_MAX_BYTES = int(os.getenv("STATEMENT_MAX_BYTES", str(49 * 1024 * 1024)))
+
+HEADERS = ("Date (UTC)", "Recipient", "Amount (GHS)", "Status", "Reference")
+
+class StatementTooLarge(Exception):
+    pass
+
+class CsvStatement:
+    mime = "text/csv"
+
+    def __init__(self, fp, title: str):
+        self.fp = fp
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._writer.writerow(HEADERS)
+
+    def add(self, created_at, recipient, amount, status, reference):
+        self._writer.writerow((created_at.strftime("%Y-%m-%d %H:%M:%S"), recipient, f"{amount:.2f}", status, reference or ""))
+        if self._buffer.tell() > 64 * 1024:
+            self._flush()
+
+    def _flush(self):
+        self.fp.write(self._buffer.getvalue().encode("utf-8"))
+        self._buffer.seek(0)
+        self._buffer.truncate()
+
+    def close(self, summary: str):
+        self._flush()
+
+# --- PDF ---
+
+class _PdfWriter:
+    """
+    Just enough PDF for text pages (A4, built-in Helvetica), written page by
+    page: only the byte offset of each object is kept in memory.
+    """
+    WIDTH, HEIGHT = 595, 842
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.offsets = {}
+        self.page_ids = []
+        self._next_id = 5  # 1 catalog, 2 page tree, 3-4 fonts
+        self.fp.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self._object(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+        self._object(4, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>")
+
+    def _object(self, num: int, body: bytes):
+        self.offsets[num] = self.fp.tell()
+        self.fp.write(b"%d 0 obj\n" % num + body + b"\nendobj\n")
+
+    @staticmethod
+    def _text(value: str) -> bytes:
+        raw = value.encode("cp1252", errors="replace")
+        return raw.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+    def page(self, items: list):
+        """
+        items: (x, y, text, bold) with y measured from the top of the page.
+        """
+        ops = [b"BT"]
+        for x, y, text, bold in items:
+            font = b"/F2 9 Tf" if bold else b"/F1 9 Tf"
+            ops.append(b"%s 1 0 0 1 %d %d Tm (%s) Tj" % (font, x, self.HEIGHT - y, self._text(text)))
+        ops.append(b"ET")
+        content = b"\n".join(ops)
+        content_id, page_id = self._next_id, self._next_id + 1
+        self._next_id += 2
+        self._object(content_id, b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        self._object(page_id, (
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] "
+            b"/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents %d 0 R >>"
+        ) % (self.WIDTH, self.HEIGHT, content_id))
+        self.page_ids.append(page_id)
+
+    def close(self):
+        kids = b" ".join(b"%d 0 R" % p for p in self.page_ids)
+        self._object(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.page_ids)))
+        self._object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        xref_at = self.fp.tell()
+        size = self._next_id
+        self.fp.write(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+        for num in range(1, size):
+            self.fp.write(b"%010d 00000 n \n" % self.offsets[num])
+        self.fp.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref_at))
+
+class PdfStatement:
+    mime = "application/pdf"
+    COLUMNS = (40, 150, 260, 350, 460)   # x of each column
+    TOP, BOTTOM, LEADING = 60, 800, 14
+
+    def __init__(self, fp, title: str):
+        self.pdf = _PdfWriter(fp)
+        self.title = title
+        self._items = []
+        self._y = None
+        self._new_page()
+
+    def _new_page(self):
+        if self._items:
+            self._finish_page()
+        number = len(self.pdf.page_ids) + 1
+        self._items = [(40, self.TOP - 20, f"{self.title} - page {number}", True)]
+        self._items += [(x, self.TOP, header, True) for x, header in zip(self.COLUMNS, HEADERS)]
+        self._y = self.TOP + self.LEADING + 4
+
+    def _finish_page(self):
+        self.pdf.page(self._items)
+        self._items = []
+
+    def _line(self, cells, bold=False):
+        if self._y > self.BOTTOM:
+            self._new_page()
+        self._items += [(x, self._y, text, bold) for x, text in zip(self.COLUMNS, cells)]
+        self._y += self.LEADING
+
+    def add(self, created_at, recipient, amount, status, reference):
+        self._line((created_at.strftime("%d-%b-%Y %H:%M"), recipient, f"{amount:,.2f}", status, (reference or "")[:28]))
+
+    def close(self, summary: str):
+        self._y += self.LEADING
+        self._line((summary,), bold=True)
+        self._finish_page()
+        self.pdf.close()
+
+STATEMENT_FORMATS = {"csv": CsvStatement, "pdf": PdfStatement}
+
+async def build_statement(rows, fmt: str, title: str):
+    """
+    Writes the async iterable `rows` (history_utils.STATEMENT_COLUMNS tuples)
+    to a spooled temp file as CSV or PDF. Returns (file rewound to 0, row count).
+    Raises StatementTooLarge past STATEMENT_MAX_BYTES; the caller closes the file.
+    """
+    fp = tempfile.SpooledTemporaryFile(max_size=STATEMENT_SPOOL_MAX)
+    writer = STATEMENT_FORMATS[fmt](fp, title)
+    count, total = 0, 0.0
+    try:
+        async for created_at, recipient, amount, status, reference in rows:
+            writer.add(created_at, recipient_label(recipient), amount, status, reference)
+            count += 1
+            if status in STATUS_GROUPS["done"]:
+                total += amount
+            if count % 1000 == 0 and fp.tell() > STATEMENT_MAX_BYTES:
+                raise StatementTooLarge(f"Statement exceeds {STATEMENT_MAX_BYTES} bytes")
+        writer.close(f"{count} transactions, GHS {total:,.2f} sent. Generated {datetime.utcnow():%d-%b-%Y %H:%M} UTC.")
+        if fp.tell() > STATEMENT_MAX_BYTES:
+            raise StatementTooLarge(f"Statement exceeds {STATEMENT_MAX_BYTES} bytes")
+    except Exception:
+        fp.close()
+        raise
+    fp.seek(0)
+    return fp, count
@@ -2,21 +2,140 @@ import os
 import httpx
 from dotenv import load_dotenv
 
+from scheduler_utils import OutboundScheduler, RetryAfter, CRITICAL, HIGH, NORMAL, LOW
+
 load_dotenv()
 
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 BASE_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
 
-async def send_message(chat_id: str, text: str):
+# --- CONNECTION POOL ---
+# One long-lived client so every Bot API call reuses a warm TCP/TLS connection.
+TELEGRAM_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_MAX_CONNECTIONS", "100"))
+TELEGRAM_MAX_KEEPALIVE = int(os.getenv("TELEGRAM_MAX_KEEPALIVE", "20"))
+TELEGRAM_KEEPALIVE_EXPIRY = float(os.getenv("TELEGRAM_KEEPALIVE_EXPIRY", "30"))
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
+TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "15"))
+TELEGRAM_HTTP2 = os.getenv("TELEGRAM_HTTP2", "false").lower() == "true"
+
+_client = None
+
+def _build_client() -> httpx.AsyncClient:
+    http2 = TELEGRAM_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401  (httpx needs the 'h2' package for HTTP/2)
+        except ImportError:
+            print("⚠️ TELEGRAM_HTTP2 is set but 'h2' is not installed. Using HTTP/1.1.")
+            http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=TELEGRAM_MAX_CONNECTIONS,
+            max_keepalive_connections=TELEGRAM_MAX_KEEPALIVE,
+            keepalive_expiry=TELEGRAM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            TELEGRAM_READ_TIMEOUT,
+            connect=TELEGRAM_CONNECT_TIMEOUT,
+        ),
+    )
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Returns the shared Telegram client (created lazily if lifespan hasn't run yet).
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _build_client()
+    return _client
+
+async def start_client():
+    """
+    Opens the shared client and the outbound scheduler. Called from the FastAPI lifespan.
+    """
+    get_client()
+    outbound.start()
+
+async def close_client():
+    """
+    Stops the scheduler, then closes the shared client and its pooled connections.
+    """
+    global _client
+    await outbound.stop()
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+# --- OUTBOUND SCHEDULER ---
+# Telegram allows ~30 msg/s per bot and ~1 msg/s per chat. Every Bot API call
+# goes through one priority queue that enforces both and honours 429 retry_after.
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_QUEUE_MAX = int(os.getenv("TELEGRAM_QUEUE_MAX", "10000"))
+TELEGRAM_SEND_CONCURRENCY = int(os.getenv("TELEGRAM_SEND_CONCURRENCY", "32"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+
+async def _post(method: str, payload: dict = None, files: dict = None):
+    """
+    Performs one Bot API call. Raises RetryAfter on 429 so the scheduler can re-queue it.
+    """
+    url = f"{BASE_URL}/{method}"
+    if files:
+        for _, content, *_ in files.values():
+            if hasattr(content, "seek"):
+                content.seek(0)  # file objects are re-read if the call is retried
+        resp = await get_client().post(url, data=payload, files=files)
+    else:
+        resp = await get_client().post(url, json=payload)
+    body = resp.json()
+    if resp.status_code == 429:
+        retry_after = (body.get("parameters") or {}).get("retry_after", 1)
+        raise RetryAfter(float(retry_after), body)
+    return body
+
+outbound = OutboundScheduler(
+    _post,
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    key_rate=TELEGRAM_CHAT_RATE,
+    key_burst=TELEGRAM_CHAT_BURST,
+    max_queue=TELEGRAM_QUEUE_MAX,
+    concurrency=TELEGRAM_SEND_CONCURRENCY,
+    max_retries=TELEGRAM_MAX_RETRIES,
+)
+
+async def call_api(chat_id, method: str, payload: dict = None, files: dict = None,
+                   priority: int = NORMAL, limited: bool = True):
+    """
+    Queues a Bot API call and waits for Telegram's response (None if dropped).
+    `limited` calls count against the per-chat rate limit.
+    """
+    return await outbound.submit(chat_id, method, payload, files, priority=priority, limited=limited)
+
+def get_outbound_stats() -> dict:
+    return outbound.stats()
+
+async def send_chat_action(chat_id: str, action: str = "typing"):
+    """
+    Async: Shows the 'typing...' indicator. Fire-and-forget (pure UX), lowest priority.
+    """
+    try:
+        future = outbound.submit(chat_id, "sendChatAction", {"chat_id": chat_id, "action": action}, None, priority=LOW, limited=False)
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    except Exception:
+        pass
+
+async def send_message(chat_id: str, text: str, priority: int = NORMAL):
     """
     Async: Sends a standard text message.
     """
-    async with httpx.AsyncClient() as client:
-        await client.post(f"{BASE_URL}/sendMessage", json={
-            "chat_id": chat_id,
-            "text": text,
-            "reply_markup": {"remove_keyboard": True}
-        })
+    return await call_api(chat_id, "sendMessage", {
+        "chat_id": chat_id,
+        "text": text,
+        "reply_markup": {"remove_keyboard": True}
+    }, priority=priority)
 
 async def request_phone_number(chat_id: str):
     payload = {
@@ -29,8 +148,7 @@ async def request_phone_number(chat_id: str):
             "resize_keyboard": True
         }
     }
-    async with httpx.AsyncClient() as client:
-        await client.post(f"{BASE_URL}/sendMessage", json=payload)
+    return await call_api(chat_id, "sendMessage", payload, priority=HIGH)
 
 async def send_name_confirmation(chat_id: str, amount: float, phone: str, name: str):
     keyboard = {
@@ -50,45 +168,132 @@ async def send_name_confirmation(chat_id: str, amount: float, phone: str, name:
         f"Do you want to proceed?"
     )
     
-    async with httpx.AsyncClient() as client:
-        await client.post(f"{BASE_URL}/sendMessage", json={
-            "chat_id": chat_id,
-            "text": msg,
-            "parse_mode": "Markdown",
-            "reply_markup": keyboard
-        })
+    return await call_api(chat_id, "sendMessage", {
+        "chat_id": chat_id,
+        "text": msg,
+        "parse_mode": "Markdown",
+        "reply_markup": keyboard
+    }, priority=HIGH)
 
 async def delete_message(chat_id: str, message_id: int):
-    url = f"{BASE_URL}/deleteMessage"
     payload = {"chat_id": chat_id, "message_id": message_id}
     try:
-        async with httpx.AsyncClient() as client:
-            await client.post(url, json=payload)
+        # PIN messages: delete before anything else goes out
+        return await call_api(chat_id, "deleteMessage", payload, priority=CRITICAL, limited=False)
     except Exception as e:
         print(f"Error deleting message: {e}")
 
+async def send_split_confirmation(chat_id: str, total: float, legs: list):
+    """
+    Async: Lists every share of a split with one Pay / Cancel keyboard.
+    `legs` are (name, phone, amount) tuples.
+    """
+    keyboard = {
+        "inline_keyboard": [
+            [
+                {"text": f"✅ Pay {total:.2f} GHS", "callback_data": "split_ok"},
+                {"text": "❌ Cancel", "callback_data": "cancel"}
+            ]
+        ]
+    }
+
+    lines = "\n".join(f"👤 **{name}** (`{phone}`): **{amount:.2f} GHS**" for name, phone, amount in legs)
+    msg = (
+        f"🧾 **Split Bill**\n\n"
+        f"{lines}\n\n"
+        f"Total: **{total:.2f} GHS** (one charge)\n\n"
+        f"Do you want to proceed?"
+    )
+
+    return await call_api(chat_id, "sendMessage", {
+        "chat_id": chat_id,
+        "text": msg,
+        "parse_mode": "Markdown",
+        "reply_markup": keyboard
+    }, priority=HIGH)
+
+async def send_history_page(chat_id: str, text: str, keyboard: dict = None, message_id: int = None):
+    """
+    Async: Sends a /history page, or replaces the page in `message_id` (Older / Newer buttons).
+    """
+    payload = {"chat_id": chat_id, "text": text, "reply_markup": keyboard or {"inline_keyboard": []}}
+    if message_id is None:
+        return await call_api(chat_id, "sendMessage", payload)
+    return await call_api(chat_id, "editMessageText", {**payload, "message_id": message_id}, priority=HIGH)
+
 async def delete_message_buttons(chat_id: str, message_id: int):
-    async with httpx.AsyncClient() as client:
-        await client.post(f"{BASE_URL}/editMessageReplyMarkup", json={
-            "chat_id": chat_id,
-            "message_id": message_id,
-            "reply_markup": None 
-        })
+    return await call_api(chat_id, "editMessageReplyMarkup", {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "reply_markup": None 
+    }, priority=HIGH, limited=False)
 
 async def answer_callback(callback_id: str):
-    async with httpx.AsyncClient() as client:
-        await client.post(f"{BASE_URL}/answerCallbackQuery", json={"callback_query_id": callback_id})
+    # Not tied to a chat's message quota; keyed by the callback itself
+    return await call_api(f"cb:{callback_id}", "answerCallbackQuery", {"callback_query_id": callback_id},
+                          priority=CRITICAL, limited=False)
     
-async def send_photo(chat_id: str, photo_path: str, caption: str = ""):
-    url = f"{BASE_URL}/sendPhoto"
-    
-    # httpx handles files differently than requests
+async def send_photo(chat_id: str, photo, caption: str = "", filename: str = "photo.png"):
+    """
+    Async: Sends an image and returns Telegram's JSON response (None on failure).
+    `photo` can be PNG bytes (rendered in memory), a path to a file on disk,
+    or a Telegram file_id from an earlier upload.
+    """
     try:
-        async with httpx.AsyncClient() as client:
-            with open(photo_path, "rb") as f:
-                # We read the file into memory or stream it
-                files = {"photo": f}
-                data = {"chat_id": chat_id, "caption": caption}
-                await client.post(url, data=data, files=files)
+        data = {"chat_id": chat_id, "caption": caption}
+        if isinstance(photo, (bytes, bytearray)):
+            files = {"photo": (filename, bytes(photo), "image/png")}
+            return await call_api(chat_id, "sendPhoto", data, files)
+        elif os.path.isfile(photo):
+            with open(photo, "rb") as f:
+                files = {"photo": (os.path.basename(photo), f.read(), "image/png")}
+            return await call_api(chat_id, "sendPhoto", data, files)
+        else:
+            # Re-send an already uploaded photo: no upload at all
+            return await call_api(chat_id, "sendPhoto", {**data, "photo": photo})
     except Exception as e:
-        print(f"Failed to send photo: {e}")
\ No newline at end of file
+        print(f"Failed to send photo: {e}")
+        return None
+
+async def send_document(chat_id: str, document, filename: str, caption: str = "", mime: str = "application/octet-stream"):
+    """
+    Async: Uploads a file object (read when the request is sent, not loaded up front).
+    Returns Telegram's JSON response (None on failure).
+    """
+    try:
+        files = {"document": (filename, document, mime)}
+        return await call_api(chat_id, "sendDocument", {"chat_id": chat_id, "caption": caption}, files, priority=LOW)
+    except Exception as e:
+        print(f"Failed to send document: {e}")
+        return None
+
+# --- LONG POLLING (see polling.py) ---
+# Bypasses the outbound scheduler: getUpdates is not a message and must not queue behind them.
+
+async def get_updates(offset: int = None, limit: int = 100, timeout: int = 30, allowed_updates: list = None):
+    """
+    Async: One getUpdates long poll. Returns the list of updates (None on error).
+    Passing offset confirms every update below it to Telegram.
+    """
+    payload = {"limit": limit, "timeout": timeout}
+    if offset is not None:
+        payload["offset"] = offset
+    if allowed_updates is not None:
+        payload["allowed_updates"] = allowed_updates
+    try:
+        resp = await get_client().post(f"{BASE_URL}/getUpdates", json=payload, timeout=timeout + TELEGRAM_READ_TIMEOUT)
+        body = resp.json()
+    except Exception as e:
+        print(f"getUpdates failed: {e}")
+        return None
+    if not body.get("ok"):
+        print(f"getUpdates error: {body.get('description')}")
+        return None
+    return body.get("result", [])
+
+async def delete_webhook():
+    """
+    Async: getUpdates only works while no webhook is set.
+    """
+    resp = await get_client().post(f"{BASE_URL}/deleteWebhook", json={"drop_pending_updates": False})
+    return resp.json()
@@ -0,0 +1,73 @@
+import os
+import sys
+import asyncio
+
+import pytest
+
+# The app is a flat set of modules in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# database.py refuses to import without one; tests that need a DB use the `db` fixture
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+
+# Modules that import async_session by name and open their own sessions
+SESSION_MODULES = ("database", "job_queue", "outbox_utils", "reconcile_utils", "recipient_utils", "dedup_utils", "main", "polling")
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """
+    A fresh SQLite database per test, swapped in for the app's async_session.
+    """
+    pytest.importorskip("aiosqlite")
+    from sqlalchemy.pool import NullPool
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    from sqlmodel import SQLModel
+    from sqlmodel.ext.asyncio.session import AsyncSession
+    import models  # noqa: F401 (registers the tables)
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'app.sqlite'}", poolclass=NullPool)
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+
+    asyncio.run(create_tables())
+    sessions = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    for name in SESSION_MODULES:
+        module = sys.modules.get(name)
+        if module is not None and hasattr(module, "async_session"):
+            monkeypatch.setattr(module, "async_session", sessions)
+    yield sessions
+    asyncio.run(engine.dispose())
+
+class FakePaystack:
+    """
+    Stands in for PaystackClient.call(): answers by endpoint name and records every call.
+    An answer is a response dict, a list of them (one per call) or a function of
+    the JSON body (the path, for a GET without parameters).
+    """
+    def __init__(self):
+        self.answers = {}
+        self.calls = []
+
+    def called(self, endpoint: str) -> list:
+        return [body for name, body in self.calls if name == endpoint]
+
+    async def call(self, method: str, path: str, endpoint: str, idempotent: bool = False, **kwargs):
+        body = kwargs.get("json") or kwargs.get("params") or path
+        self.calls.append((endpoint, body))
+        answer = self.answers[endpoint]
+        if isinstance(answer, list):
+            answer = answer.pop(0) if len(answer) > 1 else answer[0]
+        return answer(body) if callable(answer) else answer
+
+@pytest.fixture
+def fake_paystack(monkeypatch):
+    import paystack_utils
+    from recipient_utils import recipient_cache
+
+    fake = FakePaystack()
+    monkeypatch.setattr(paystack_utils.paystack, "call", fake.call)
+    recipient_cache.clear()
+    yield fake
+    recipient_cache.clear()
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+from cache_utils import TTLCache
+
+def test_concurrent_loads_share_one_call():
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "value"
+
+    async def scenario():
+        cache = TTLCache(maxsize=10, ttl=60)
+        results = await asyncio.gather(*(cache.get_or_load("key", loader) for _ in range(5)))
+        return results, await cache.get_or_load("key", loader), cache
+
+    results, again, cache = asyncio.run(scenario())
+    assert results == ["value"] * 5
+    assert again == "value"
+    assert len(calls) == 1
+    assert cache.coalesced == 4
+
+def test_failed_load_is_not_cached():
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("upstream down")
+        return "value"
+
+    async def scenario():
+        cache = TTLCache(maxsize=10, ttl=60)
+        with pytest.raises(RuntimeError):
+            await cache.get_or_load("key", loader)
+        return await cache.get_or_load("key", loader)
+
+    assert asyncio.run(scenario()) == "value"
+    assert len(calls) == 2
+
+def test_ttl_for_none_skips_caching():
+    async def scenario():
+        cache = TTLCache(maxsize=10, ttl=60)
+        await cache.get_or_load("key", lambda: asyncio.sleep(0, result="transient"), ttl_for=lambda v: None)
+        return cache.get("key")
+
+    assert asyncio.run(scenario()) is None
@@ -0,0 +1,55 @@
+import asyncio
+
+import polling
+from dedup_utils import UpdateDeduplicator
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_claim_many_records_a_batch_once(db):
+    dedup = UpdateDeduplicator()
+    assert run(dedup.claim_many([1, 2, 3])) == {1, 2, 3}
+    # Another process (empty memory window) only gets the ids nobody recorded
+    assert run(UpdateDeduplicator().claim_many([3, 4])) == {4}
+    assert run(UpdateDeduplicator().unseen([1, 2, 4, 5])) == {5}
+
+def test_polled_batch_records_only_updates_that_ran(db, monkeypatch):
+    ran = []
+
+    async def handle_update(update, session):
+        if update["update_id"] == 11:
+            raise RuntimeError("handler failed")
+        ran.append(update["update_id"])
+
+    monkeypatch.setattr(polling, "handle_update", handle_update)
+    monkeypatch.setattr(polling, "update_dedup", UpdateDeduplicator())
+    batch = [{"update_id": i, "message": {"chat": {"id": 42}, "text": "hi"}} for i in (10, 11, 12)]
+
+    run(polling.process_batch(batch, asyncio.Semaphore(4)))
+    assert ran == [10, 12]
+    # Redelivered after a crash: only the failed update runs again
+    assert run(UpdateDeduplicator().unseen([10, 11, 12])) == {11}
+
+def test_webhook_update_is_claimed_by_the_worker_that_handles_it(db, monkeypatch):
+    import main
+
+    handled = []
+
+    async def handle_update(update, session):
+        handled.append(update["update_id"])
+
+    dedup = UpdateDeduplicator()
+    monkeypatch.setattr(main, "handle_update", handle_update)
+    monkeypatch.setattr(main, "update_dedup", dedup)
+    update = {"update_id": 7, "message": {"chat": {"id": 42}, "text": "hi"}}
+
+    async def scenario():
+        pipeline = main.UpdatePipeline(main.process_update, workers=2)
+        # Telegram sent it twice before our first ack; both copies get queued
+        assert await pipeline.submit(update)
+        assert await pipeline.submit(update)
+        await pipeline.stop()
+        return dedup.seen_recently(7)
+
+    assert run(scenario()) is True
+    assert handled == [7]
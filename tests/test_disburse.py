@@ -0,0 +1,264 @@
+import asyncio
+
+import pytest
+
+import main  # noqa: F401 (registers the disburse/refund job handlers)
+from job_queue import enqueue, job_pool
+from models import Transaction, TransferRecipient
+from paystack_utils import get_paystack_bank_code
+
+SENDER, RECIPIENT = "0551234567", "0241234567"
+
+RECIPIENT_OK = {"status": True, "data": {"recipient_code": "RCP_1"}}
+TRANSFER_OK = {"status": True, "data": {"transfer_code": "TRF_1"}}
+REFUND_OK = {"status": True, "data": {"status": "pending"}}
+REJECTED = {"status": False, "message": "Insufficient balance"}
+NOT_FOUND = {"status": False, "message": "Transfer not found"}
+# No definite answer (read timeout, 5xx): Paystack may have acted on the call
+TRANSIENT = {"status": False, "message": "Paystack transfer failed (upstream) after 1 attempt(s)", "transient": True}
+
+def charged(amount=50.0, status="PENDING_DISBURSE", **fields) -> Transaction:
+    values = {"telegram_chat_id": "42", "sender_phone": SENDER, "recipient_phone": RECIPIENT, "paystack_reference": "txn_test"}
+    return Transaction(amount=amount, status=status, **{**values, **fields})
+
+def leg(parent: Transaction, amount: float, status: str = "INIT", recipient: str = RECIPIENT) -> Transaction:
+    return charged(amount=amount, status=status, recipient_phone=recipient, paystack_reference=None, parent_id=parent.id)
+
+async def add(sessions, *rows):
+    async with sessions() as session:
+        for row in rows:
+            session.add(row)
+        await session.commit()
+
+async def run_job(sessions, kind: str, txn_id, attempts: int = 1):
+    """
+    Runs one claimed job through the worker pool's real execute path (commit, rollback, reschedule).
+    """
+    async with sessions() as session:
+        job = enqueue(session, kind, {"transaction_id": str(txn_id)})
+        job.status, job.attempts = "RUNNING", attempts
+        await session.commit()
+        await job_pool._execute(job, session)
+        return job
+
+async def load(sessions, txn_id) -> Transaction:
+    async with sessions() as session:
+        return await session.get(Transaction, txn_id)
+
+def run(coro):
+    return asyncio.run(coro)
+
+@pytest.fixture
+def paystack(fake_paystack):
+    fake_paystack.answers.update(recipient=RECIPIENT_OK, transfer=TRANSFER_OK, refund=REFUND_OK, verify=NOT_FOUND)
+    return fake_paystack
+
+# --- single transfer ---
+
+def test_accepted_transfer_is_disbursing(db, paystack):
+    txn = charged()
+    run(add(db, txn))
+    job = run(run_job(db, "disburse", txn.id))
+    row = run(load(db, txn.id))
+    assert job.status == "DONE"
+    assert (row.status, row.transfer_code) == ("DISBURSING", "TRF_1")
+    assert paystack.called("transfer")[0]["reference"] == f"trf_{txn.id}"
+    assert paystack.called("verify") == []
+
+def test_rejected_transfer_is_refunded(db, paystack):
+    paystack.answers["transfer"] = REJECTED
+    txn = charged()
+    run(add(db, txn))
+    job = run(run_job(db, "disburse", txn.id))
+    assert job.status == "DONE"
+    assert run(load(db, txn.id)).status == "REFUNDED"
+    assert paystack.called("refund") == [{"transaction": "txn_test"}]
+
+def test_rejected_transfer_with_rejected_refund_is_refund_failed(db, paystack):
+    paystack.answers.update(transfer=REJECTED, refund=REJECTED)
+    txn = charged()
+    run(add(db, txn))
+    run(run_job(db, "disburse", txn.id))
+    assert run(load(db, txn.id)).status == "REFUND_FAILED"
+
+def test_transient_transfer_is_retried_not_refunded(db, paystack):
+    paystack.answers["transfer"] = TRANSIENT
+    txn = charged()
+    run(add(db, txn))
+    job = run(run_job(db, "disburse", txn.id))
+    assert (job.status, job.attempts) == ("PENDING", 1)
+    assert "not confirmed" in job.last_error
+    assert run(load(db, txn.id)).status == "PENDING_DISBURSE"
+    assert paystack.called("refund") == []
+
+def test_transient_refund_is_retried_not_refund_failed(db, paystack):
+    paystack.answers.update(transfer=REJECTED, refund=TRANSIENT)
+    txn = charged()
+    run(add(db, txn))
+    job = run(run_job(db, "disburse", txn.id))
+    assert job.status == "PENDING"
+    assert run(load(db, txn.id)).status == "PENDING_DISBURSE"
+
+def test_transient_recipient_error_is_retried_not_refunded(db, paystack):
+    paystack.answers["recipient"] = TRANSIENT
+    txn = charged()
+    run(add(db, txn))
+    job = run(run_job(db, "disburse", txn.id))
+    assert job.status == "PENDING"
+    assert run(load(db, txn.id)).status == "PENDING_DISBURSE"
+    assert paystack.called("transfer") == paystack.called("refund") == []
+
+def test_retry_settles_a_transfer_paystack_already_took(db, paystack):
+    paystack.answers["verify"] = {"status": True, "data": {"transfer_code": "TRF_9", "status": "pending"}}
+    txn = charged()
+    run(add(db, txn))
+    job = run(run_job(db, "disburse", txn.id, attempts=2))
+    row = run(load(db, txn.id))
+    assert job.status == "DONE"
+    assert (row.status, row.transfer_code) == ("DISBURSING", "TRF_9")
+    assert paystack.called("transfer") == []
+
+def test_retry_does_not_resend_when_verify_is_transient(db, paystack):
+    paystack.answers["verify"] = TRANSIENT
+    txn = charged()
+    run(add(db, txn))
+    job = run(run_job(db, "disburse", txn.id, attempts=2))
+    assert job.status == "PENDING"
+    assert run(load(db, txn.id)).status == "PENDING_DISBURSE"
+    assert paystack.called("transfer") == paystack.called("refund") == []
+
+def test_retry_resends_when_paystack_has_no_transfer(db, paystack):
+    txn = charged()
+    run(add(db, txn))
+    job = run(run_job(db, "disburse", txn.id, attempts=2))
+    assert job.status == "DONE"
+    assert run(load(db, txn.id)).status == "DISBURSING"
+    assert len(paystack.called("transfer")) == 1
+
+# --- refund job (transfer.failed / transfer.reversed) ---
+
+def test_refund_job_refunds_failed_transfer(db, paystack):
+    txn = charged(status="TRANSFER_FAILED")
+    run(add(db, txn))
+    assert run(run_job(db, "refund", txn.id)).status == "DONE"
+    assert run(load(db, txn.id)).status == "REFUNDED"
+
+def test_refund_job_retries_transient_refund(db, paystack):
+    paystack.answers["refund"] = TRANSIENT
+    txn = charged(status="TRANSFER_FAILED")
+    run(add(db, txn))
+    job = run(run_job(db, "refund", txn.id))
+    assert job.status == "PENDING"
+    assert run(load(db, txn.id)).status == "TRANSFER_FAILED"
+
+def test_refund_job_records_rejected_refund(db, paystack):
+    paystack.answers["refund"] = REJECTED
+    txn = charged(status="TRANSFER_FAILED")
+    run(add(db, txn))
+    run(run_job(db, "refund", txn.id))
+    assert run(load(db, txn.id)).status == "REFUND_FAILED"
+
+def test_refund_job_refunds_a_split_leg_from_its_parent(db, paystack):
+    parent = charged(amount=60, status="DISBURSING", recipient_phone="")
+    failed = leg(parent, 20.5, "TRANSFER_FAILED")
+    paid = leg(parent, 39.5, "COMPLETE")
+    run(add(db, parent))
+    run(add(db, failed, paid))
+    run(run_job(db, "refund", failed.id))
+    assert paystack.called("refund") == [{"transaction": "txn_test", "amount": 2050}]
+    assert run(load(db, failed.id)).status == "REFUNDED"
+    assert run(load(db, parent.id)).status == "PARTIAL_REFUND"
+
+# --- split bill (bulk transfer) ---
+
+def bulk_accepting(*amounts_in_pesewas):
+    """
+    A /transfer/bulk answer that takes the transfers of the given amounts (all, when none are given).
+    """
+    def answer(body):
+        return {"status": True, "data": [
+            {"reference": item["reference"], "transfer_code": f"TRF_{item['amount']}"}
+            for item in body["transfers"] if not amounts_in_pesewas or item["amount"] in amounts_in_pesewas
+        ]}
+    return answer
+
+def split(amounts=(30.0, 20.0, 10.0), status="INIT"):
+    parent = charged(amount=sum(amounts), recipient_phone="")
+    return parent, [leg(parent, amount, status, recipient=f"02412345{i:02d}") for i, amount in enumerate(amounts)]
+
+def test_split_sends_every_leg_in_one_bulk_transfer(db, paystack):
+    paystack.answers["bulk_transfer"] = bulk_accepting()
+    parent, legs = split()
+    run(add(db, parent))
+    run(add(db, *legs))
+    assert run(run_job(db, "disburse", parent.id)).status == "DONE"
+    assert len(paystack.called("bulk_transfer")) == 1
+    assert [run(load(db, l.id)).status for l in legs] == ["DISBURSING"] * 3
+    assert run(load(db, parent.id)).status == "DISBURSING"
+    assert paystack.called("refund") == []
+
+def test_split_refunds_the_share_of_rejected_legs(db, paystack):
+    paystack.answers["bulk_transfer"] = bulk_accepting(3000, 2000)
+    parent, legs = split()
+    run(add(db, parent))
+    run(add(db, *legs))
+    run(run_job(db, "disburse", parent.id))
+    assert [run(load(db, l.id)).status for l in legs] == ["DISBURSING", "DISBURSING", "REFUNDED"]
+    assert run(load(db, parent.id)).status == "PARTIAL_REFUND"
+    assert paystack.called("refund") == [{"transaction": "txn_test", "amount": 1000}]
+
+def test_split_transient_bulk_transfer_is_retried_not_refunded(db, paystack):
+    paystack.answers["bulk_transfer"] = TRANSIENT
+    parent, legs = split()
+    run(add(db, parent))
+    run(add(db, *legs))
+    job = run(run_job(db, "disburse", parent.id))
+    assert job.status == "PENDING"
+    assert "not confirmed" in job.last_error
+    assert [run(load(db, l.id)).status for l in legs] == ["INIT"] * 3
+    assert run(load(db, parent.id)).status == "PENDING_DISBURSE"
+    assert paystack.called("refund") == []
+
+def test_split_retry_does_not_resend_when_verify_is_transient(db, paystack):
+    parent, legs = split()
+    paystack.answers["verify"] = lambda path: TRANSIENT if path.endswith(f"trf_{legs[1].id}") else NOT_FOUND
+    run(add(db, parent))
+    run(add(db, *legs))
+    job = run(run_job(db, "disburse", parent.id, attempts=2))
+    assert job.status == "PENDING"
+    assert [run(load(db, l.id)).status for l in legs] == ["INIT"] * 3
+    assert paystack.called("bulk_transfer") == []
+
+def test_split_retry_only_sends_legs_paystack_does_not_have(db, paystack):
+    parent, legs = split()
+    taken = f"trf_{legs[0].id}"
+    paystack.answers.update(
+        verify=lambda path: {"status": True, "data": {"transfer_code": "TRF_old"}} if path.endswith(taken) else NOT_FOUND,
+        bulk_transfer=bulk_accepting(),
+    )
+    run(add(db, parent))
+    # Stored recipients: SQLite would block the recipient upsert behind the job's open write
+    run(add(db, *legs, *(TransferRecipient(phone_number=l.recipient_phone, bank_code=get_paystack_bank_code(l.recipient_phone),
+                                           recipient_code="RCP_1") for l in legs)))
+    assert run(run_job(db, "disburse", parent.id, attempts=2)).status == "DONE"
+    sent = [item["reference"] for body in paystack.called("bulk_transfer") for item in body["transfers"]]
+    assert sorted(sent) == sorted(f"trf_{l.id}" for l in legs[1:])
+    assert [run(load(db, l.id)).transfer_code for l in legs] == ["TRF_old", "TRF_2000", "TRF_1000"]
+
+def test_split_transient_refund_keeps_payouts_and_retries_the_refund(db, paystack):
+    paystack.answers.update(bulk_transfer=bulk_accepting(3000), refund=TRANSIENT)
+    parent, legs = split()
+    run(add(db, parent))
+    run(add(db, *legs))
+    job = run(run_job(db, "disburse", parent.id))
+    assert job.status == "PENDING"
+    # The payouts are recorded; nothing is marked REFUND_FAILED
+    assert [run(load(db, l.id)).status for l in legs] == ["DISBURSING", "TRANSFER_FAILED", "TRANSFER_FAILED"]
+    assert run(load(db, parent.id)).status == "PENDING_DISBURSE"
+
+    paystack.answers["refund"] = REFUND_OK
+    assert run(run_job(db, "disburse", parent.id, attempts=2)).status == "DONE"
+    assert len(paystack.called("bulk_transfer")) == 1
+    assert paystack.called("refund")[-1] == {"transaction": "txn_test", "amount": 3000}
+    assert [run(load(db, l.id)).status for l in legs] == ["DISBURSING", "REFUNDED", "REFUNDED"]
+    assert run(load(db, parent.id)).status == "PARTIAL_REFUND"
@@ -0,0 +1,134 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import job_queue
+from job_queue import JobWorkerPool, RetryLater, enqueue, job_handler
+from models import Job
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def queue(sessions, kind: str, **fields) -> int:
+    async with sessions() as session:
+        job = enqueue(session, kind, {})
+        for name, value in fields.items():
+            setattr(job, name, value)
+        await session.commit()
+        return job.id
+
+async def load(sessions, job_id) -> Job:
+    async with sessions() as session:
+        return await session.get(Job, job_id)
+
+async def claim_and_run(sessions, pool: JobWorkerPool):
+    async with sessions() as session:
+        job = await pool.claim(session)
+        if job is not None:
+            await pool._execute(job, session)
+        return job
+
+@pytest.fixture
+def pool():
+    return JobWorkerPool(workers=1)
+
+def test_claim_leases_the_job_and_counts_the_attempt(db, pool):
+    job_id = run(queue(db, "noop"))
+
+    async def claim():
+        async with db() as session:
+            return await pool.claim(session)
+
+    job = run(claim())
+    assert (job.id, job.status, job.attempts) == (job_id, "RUNNING", 1)
+    assert job.locked_until > datetime.utcnow() + timedelta(seconds=job_queue.JOB_VISIBILITY_TIMEOUT - 5)
+    # Leased: nobody else gets it
+    assert run(claim()) is None
+
+def test_concurrent_claims_hand_a_job_to_one_worker(db):
+    job_id = run(queue(db, "noop"))
+
+    async def claim(pool):
+        async with db() as session:
+            return await pool.claim(session)
+
+    async def race():
+        return await asyncio.gather(*(claim(JobWorkerPool(workers=1)) for _ in range(5)))
+
+    winners = [job for job in run(race()) if job is not None]
+    assert [job.id for job in winners] == [job_id]
+    assert run(load(db, job_id)).attempts == 1
+
+def test_expired_lease_is_reclaimed(db, pool):
+    expired = datetime.utcnow() - timedelta(seconds=1)
+    job_id = run(queue(db, "noop", status="RUNNING", attempts=1, locked_until=expired))
+
+    async def claim():
+        async with db() as session:
+            return await pool.claim(session)
+
+    job = run(claim())
+    assert (job.id, job.attempts) == (job_id, 2)
+
+def test_recover_requeues_expired_running_jobs(db, pool):
+    expired = datetime.utcnow() - timedelta(seconds=1)
+    dead = run(queue(db, "noop", status="RUNNING", attempts=1, locked_until=expired))
+    live = run(queue(db, "noop", status="RUNNING", attempts=1, locked_until=datetime.utcnow() + timedelta(minutes=5)))
+    assert run(pool.recover()) == 1
+    assert run(load(db, dead)).status == "PENDING"
+    assert run(load(db, live)).status == "RUNNING"
+
+def test_failure_backs_off_and_dies_after_max_attempts(db, pool):
+    @job_handler("test_fails")
+    async def fails(job, session):
+        raise RuntimeError("boom")
+
+    job_id = run(queue(db, "test_fails", max_attempts=2))
+    run(claim_and_run(db, pool))
+    job = run(load(db, job_id))
+    assert (job.status, job.attempts, job.last_error) == ("PENDING", 1, "RuntimeError: boom")
+    assert job.run_at > datetime.utcnow()
+
+    run(_make_due(db, job_id))
+    run(claim_and_run(db, pool))
+    assert run(load(db, job_id)).status == "DEAD"
+
+async def _make_due(sessions, job_id):
+    async with sessions() as session:
+        job = await session.get(Job, job_id)
+        job.run_at = datetime.utcnow() - timedelta(seconds=1)
+        session.add(job)
+        await session.commit()
+
+def test_retry_later_does_not_use_up_an_attempt(db, pool):
+    seen = []
+
+    @job_handler("test_busy")
+    async def busy(job, session):
+        seen.append(job.attempts)
+        if len(seen) < 3:
+            raise RetryLater("row is locked", delay=0)
+
+    job_id = run(queue(db, "test_busy", max_attempts=1))
+    for _ in range(3):
+        run(claim_and_run(db, pool))
+    job = run(load(db, job_id))
+    # Every run is still "attempt 1", so the handler never mistakes it for a retry
+    assert seen == [1, 1, 1]
+    assert (job.status, job.attempts) == ("DONE", 1)
+
+def test_heartbeat_renews_the_lease_of_a_slow_job(db, pool, monkeypatch):
+    monkeypatch.setattr(job_queue, "JOB_HEARTBEAT_INTERVAL", 0.05)
+    leases = []
+
+    @job_handler("test_slow")
+    async def slow(job, session):
+        first = (await load(db, job.id)).locked_until
+        await asyncio.sleep(0.3)
+        leases.extend([first, (await load(db, job.id)).locked_until])
+
+    job_id = run(queue(db, "test_slow"))
+    run(claim_and_run(db, pool))
+    assert leases[1] > leases[0]
+    assert run(load(db, job_id)).status == "DONE"
@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+import migrations
+
+pytest.importorskip("aiosqlite")
+
+from sqlalchemy import inspect
+from sqlalchemy.pool import NullPool
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+
+def schema(engine) -> dict:
+    def read(conn):
+        db = inspect(conn)
+        return {
+            table: (
+                sorted(c["name"] for c in db.get_columns(table)),
+                sorted((tuple(fk["constrained_columns"]), fk["referred_table"]) for fk in db.get_foreign_keys(table)),
+            )
+            for table in db.get_table_names() if table != "schema_migration"
+        }
+
+    async def load():
+        async with engine.connect() as conn:
+            return await conn.run_sync(read)
+
+    return asyncio.run(load())
+
+def test_migrated_schema_matches_the_models(tmp_path, monkeypatch):
+    migrated = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'migrated.sqlite'}", poolclass=NullPool)
+    modelled = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'modelled.sqlite'}", poolclass=NullPool)
+    monkeypatch.setattr(migrations, "engine", migrated)
+
+    applied = asyncio.run(migrations.upgrade())
+
+    async def create_all():
+        async with modelled.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+
+    asyncio.run(create_all())
+    assert applied == [m.version for m in migrations.MIGRATIONS]
+    assert schema(migrated) == schema(modelled)
+    # Already up to date: nothing runs twice
+    assert asyncio.run(migrations.upgrade()) == []
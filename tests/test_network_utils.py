@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+import network_utils
+from network_utils import NetworkResolver, normalize_phone
+
+NETWORKS = {"MTN": ["024", "054", "055"], "VOD": ["020", "050"], "ATL": ["027", "057"]}
+
+@pytest.fixture
+def resolver(tmp_path):
+    path = tmp_path / "networks.json"
+    path.write_text(json.dumps(NETWORKS))
+    return NetworkResolver(path=str(path), default="MTN")
+
+@pytest.mark.parametrize("raw", [
+    "+233 20 123 4567",
+    "+233-20-123-4567",
+    "233 20 123 4567",
+    "020 123 4567",
+    "020-123-4567",
+    " (020) 123.4567 ",
+    "0201234567",
+    "201234567",
+])
+def test_normalize_phone_strips_separators_and_country_code(raw):
+    assert normalize_phone(raw) == "0201234567"
+
+@pytest.mark.parametrize("raw", ["+233 20 123 4567", "233-20-123-4567", "020 123 4567", "+233201234567"])
+def test_bank_code_for_spaced_and_dashed_vodafone_numbers(resolver, raw):
+    assert resolver.bank_code(raw) == "VOD"
+
+def test_bank_code_falls_back_to_default_for_unknown_prefix(resolver):
+    assert resolver.bank_code("+233 30 123 4567") == "MTN"
+    assert resolver.bank_code("+233 57 123 4567") == "ATL"
+
+@pytest.mark.parametrize("raw", ["0201234567", "+233 20 123 4567", "233-20-123-4567", "20 123 4567"])
+def test_bank_code_reads_spaced_numbers_without_normalising(resolver, monkeypatch, raw):
+    def normalize_phone(phone):
+        raise AssertionError("fast path normalised the number")
+
+    monkeypatch.setattr(network_utils, "normalize_phone", normalize_phone)
+    assert resolver.bank_code(raw) == "VOD"
+
+def test_bank_code_normalises_other_punctuation_on_a_miss(resolver):
+    assert resolver.bank_code("(020) 123.4567") == "VOD"
@@ -0,0 +1,110 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import outbox_utils
+from models import OutboxMessage
+from outbox_utils import OutboxRelay, queue_message, queue_receipt
+
+def run(coro):
+    return asyncio.run(coro)
+
+@pytest.fixture
+def telegram(monkeypatch):
+    """
+    Records what the relay sends; `answers` (chat_id -> response) overrides the default ok.
+    """
+    sent, answers = [], {}
+
+    async def send_message(chat_id, text):
+        sent.append((chat_id, text))
+        return answers.get(chat_id, {"ok": True})
+
+    async def send_photo(chat_id, image, caption="", filename=None):
+        sent.append((chat_id, caption))
+        return answers.get(chat_id, {"ok": True})
+
+    async def render_receipt_async(*args):
+        return b"png"
+
+    monkeypatch.setattr(outbox_utils, "send_message", send_message)
+    monkeypatch.setattr(outbox_utils, "send_photo", send_photo)
+    monkeypatch.setattr(outbox_utils, "render_receipt_async", render_receipt_async)
+    return sent, answers
+
+async def queue(sessions, *messages, commit=True):
+    async with sessions() as session:
+        for chat_id, text in messages:
+            queue_message(session, chat_id, text)
+        if commit:
+            await session.commit()
+
+async def rows(sessions) -> list:
+    async with sessions() as session:
+        return (await session.exec(outbox_utils.select(OutboxMessage).order_by(OutboxMessage.id))).all()
+
+def test_messages_are_delivered_in_order_per_chat(db, telegram):
+    sent, _ = telegram
+    run(queue(db, ("1", "a1"), ("1", "a2"), ("2", "b1")))
+    relay = OutboxRelay()
+    # One round takes the oldest open row of each chat
+    assert run(relay.deliver_batch()) == 2
+    assert sorted(sent) == [("1", "a1"), ("2", "b1")]
+    assert run(relay.deliver_batch()) == 1
+    assert sent[-1] == ("1", "a2")
+    assert run(relay.deliver_batch()) == 0
+    assert [row.status for row in run(rows(db))] == ["SENT"] * 3
+
+def test_rolled_back_notifications_are_never_sent(db, telegram):
+    sent, _ = telegram
+    run(queue(db, ("1", "lost"), commit=False))
+    assert run(OutboxRelay().deliver_batch()) == 0
+    assert sent == []
+
+def test_failed_send_is_retried_with_backoff_then_dead(db, telegram, monkeypatch):
+    monkeypatch.setattr(outbox_utils, "OUTBOX_MAX_ATTEMPTS", 2)
+    sent, answers = telegram
+    answers["1"] = None  # network error
+    run(queue(db, ("1", "hello"), ("1", "after")))
+    relay = OutboxRelay()
+
+    run(relay.deliver_batch())
+    (first, second) = run(rows(db))
+    assert (first.status, first.attempts) == ("PENDING", 1)
+    assert first.run_at > datetime.utcnow()
+    # The chat's later message waits behind the failed one
+    assert run(relay.deliver_batch()) == 0
+
+    async def make_due():
+        async with db() as session:
+            row = await session.get(OutboxMessage, first.id)
+            row.run_at = datetime.utcnow() - timedelta(seconds=1)
+            session.add(row)
+            await session.commit()
+
+    run(make_due())
+    run(relay.deliver_batch())
+    assert run(rows(db))[0].status == "DEAD"
+    assert relay.stats()["dead"] == 1
+
+def test_blocked_chat_is_dead_at_once(db, telegram):
+    _, answers = telegram
+    answers["1"] = {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+    run(queue(db, ("1", "hello")))
+    run(OutboxRelay().deliver_batch())
+    row = run(rows(db))[0]
+    assert (row.status, row.attempts) == ("DEAD", 1)
+    assert "blocked" in row.last_error
+
+def test_receipt_is_rendered_and_sent_as_a_photo(db, telegram):
+    sent, _ = telegram
+
+    async def add():
+        async with db() as session:
+            queue_receipt(session, "1", "0551234567", "0241234567", 25.0, "txn_1", caption="✅ Done")
+            await session.commit()
+
+    run(add())
+    run(OutboxRelay().deliver_batch())
+    assert sent == [("1", "✅ Done")]
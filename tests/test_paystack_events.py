@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from main import on_refund_failed
+from models import Transaction
+
+def run(coro):
+    return asyncio.run(coro)
+
+def txn(amount: float, status: str, parent: Transaction = None, reference: str = None) -> Transaction:
+    return Transaction(telegram_chat_id="42", sender_phone="0551234567", recipient_phone="" if parent is None else "0241234567",
+                       amount=amount, status=status, parent_id=parent.id if parent else None, paystack_reference=reference)
+
+@pytest.fixture
+def split_bill(db):
+    # Two legs paid back one at a time, one still paid out
+    parent = txn(60, "PARTIAL_REFUND", reference="txn_split")
+    legs = [txn(30, "REFUNDED", parent), txn(20, "REFUNDED", parent), txn(10, "DISBURSING", parent)]
+
+    async def add():
+        async with db() as session:
+            session.add(parent)
+            await session.commit()
+            session.add_all(legs)
+            await session.commit()
+
+    run(add())
+    return parent, legs
+
+def refund_failed(db, amount):
+    async def handle():
+        async with db() as session:
+            await on_refund_failed({"transaction_reference": "txn_split", "amount": amount, "status": "failed"}, session)
+
+    run(handle())
+
+def statuses(db, rows) -> list:
+    async def load():
+        async with db() as session:
+            return [(await session.get(Transaction, row.id)).status for row in rows]
+
+    return run(load())
+
+def test_failed_partial_refund_only_fails_its_leg(db, split_bill):
+    parent, legs = split_bill
+    refund_failed(db, 2000)
+    assert statuses(db, legs) == ["REFUNDED", "REFUND_FAILED", "DISBURSING"]
+    assert statuses(db, [parent]) == ["REFUND_FAILED"]
+
+def test_failed_combined_refund_fails_every_refunded_leg(db, split_bill):
+    parent, legs = split_bill
+    refund_failed(db, 5000)
+    assert statuses(db, legs) == ["REFUND_FAILED", "REFUND_FAILED", "DISBURSING"]
+
+def test_unmatched_refund_amount_leaves_legs_alone(db, split_bill):
+    parent, legs = split_bill
+    refund_failed(db, 1234)
+    assert statuses(db, legs) == ["REFUNDED", "REFUNDED", "DISBURSING"]
+    assert statuses(db, [parent]) == ["REFUND_FAILED"]
@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import paystack_utils
+from paystack_utils import CircuitBreaker, PaystackClient, to_pesewas
+
+def run(coro):
+    return asyncio.run(coro)
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(paystack_utils, "PAYSTACK_BACKOFF_BASE", 0)
+
+def client_for(handler, breaker: CircuitBreaker = None):
+    """
+    A PaystackClient whose HTTP calls go to `handler(request)`; returns it with the list of requests seen.
+    """
+    seen = []
+
+    def transport(request):
+        seen.append(request)
+        return handler(request)
+
+    client = PaystackClient(secret_key="sk_test")
+    client._client = httpx.AsyncClient(base_url=client.base_url, transport=httpx.MockTransport(transport))
+    if breaker is not None:
+        client.breaker = breaker
+    return client, seen
+
+def fails_with(error_cls):
+    def handler(request):
+        raise error_cls("boom", request=request)
+    return handler
+
+def test_answer_is_returned_as_is():
+    client, seen = client_for(lambda r: httpx.Response(400, json={"status": False, "message": "Invalid recipient"}))
+    result = run(client.call("POST", "/transfer", "transfer", json={}))
+    # A definite rejection: no transient flag, so callers may refund on it
+    assert result == {"status": False, "message": "Invalid recipient"}
+    assert len(seen) == 1
+
+def test_connect_error_is_retried_and_reported_unsent():
+    client, seen = client_for(fails_with(httpx.ConnectError))
+    result = run(client.call("POST", "/transfer", "transfer", json={}))
+    assert result["transient"] and result["unsent"]
+    assert len(seen) == paystack_utils.PAYSTACK_MAX_RETRIES + 1
+
+@pytest.mark.parametrize("handler", [
+    fails_with(httpx.ReadTimeout),
+    lambda r: httpx.Response(502, json={"status": False}),
+])
+def test_post_without_an_answer_is_transient_and_not_retried(handler):
+    client, seen = client_for(handler)
+    result = run(client.call("POST", "/transfer", "transfer", json={}))
+    # Paystack may have acted on it: transient, but not "unsent"
+    assert result["transient"] and not result.get("unsent")
+    assert len(seen) == 1
+
+def test_idempotent_get_is_retried_after_a_server_error():
+    answers = [httpx.Response(503), httpx.Response(200, json={"status": True, "data": {"status": "success"}})]
+    client, seen = client_for(lambda r: answers.pop(0))
+    result = run(client.call("GET", "/transfer/verify/trf_1", "verify", idempotent=True))
+    assert result["status"] is True
+    assert len(seen) == 2
+
+def test_open_breaker_fails_fast_as_unsent_then_lets_a_trial_through():
+    healthy = {"ok": False}
+
+    def handler(request):
+        if healthy["ok"]:
+            return httpx.Response(200, json={"status": True})
+        return httpx.Response(500)
+
+    client, seen = client_for(handler, CircuitBreaker(threshold=2, reset_after=0.05))
+    for _ in range(2):
+        run(client.call("POST", "/refund", "refund", json={}))
+    assert client.breaker.state == "OPEN"
+
+    calls = len(seen)
+    result = run(client.call("POST", "/refund", "refund", json={}))
+    assert result["transient"] and result["unsent"]
+    assert len(seen) == calls  # never reached Paystack
+
+    time.sleep(0.06)
+    assert client.breaker.state == "HALF_OPEN"
+    healthy["ok"] = True
+    assert run(client.call("POST", "/refund", "refund", json={}))["status"] is True
+    assert client.breaker.state == "CLOSED"
+
+def test_failed_trial_reopens_the_breaker():
+    breaker = CircuitBreaker(threshold=5, reset_after=0.05)
+    breaker.opened_at = time.monotonic() - 1
+    assert breaker.state == "HALF_OPEN"
+    breaker.record_failure()
+    assert breaker.state == "OPEN"
+
+@pytest.mark.parametrize("amount, pesewas", [(19.99, 1999), (0.005, 1), (10, 1000), (33.335, 3334)])
+def test_to_pesewas_rounds_half_up(amount, pesewas):
+    assert to_pesewas(amount) == pesewas
@@ -0,0 +1,39 @@
+import asyncio
+from io import BytesIO
+
+from PIL import Image
+
+import receipt_utils
+from receipt_utils import HEIGHT, WIDTH, generate_receipt, render_receipt_async, warm_up
+
+def test_warm_up_builds_the_template_once():
+    warm_up()
+    template = receipt_utils._template
+    warm_up()
+    assert template is not None
+    assert receipt_utils._template is template
+
+def test_receipt_is_a_png_of_the_template_size():
+    data = generate_receipt("0551234567", "0241234567", 25.5, "txn_123")
+    img = Image.open(BytesIO(data))
+    assert img.format == "PNG"
+    assert img.size == (WIDTH, HEIGHT)
+
+def test_rendering_leaves_the_template_untouched():
+    warm_up()
+    before = receipt_utils._template.tobytes()
+    generate_receipt("0551234567", "0241234567", 10, "txn_456")
+    assert receipt_utils._template.tobytes() == before
+
+def test_async_render_runs_on_the_worker_pool():
+    async def scenario():
+        return await asyncio.gather(*(
+            render_receipt_async("0551234567", "0241234567", amount, f"txn_{amount}") for amount in (1, 2, 3)
+        ))
+
+    try:
+        receipts = asyncio.run(scenario())
+    finally:
+        receipt_utils.shutdown()
+    assert len(receipts) == 3
+    assert all(Image.open(BytesIO(data)).size == (WIDTH, HEIGHT) for data in receipts)
@@ -0,0 +1,117 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+from sqlmodel import select
+
+from models import Job, Transaction
+from reconcile_utils import Reconciler
+
+SUCCESS = {"status": True, "data": {"status": "success"}}
+FAILED = {"status": True, "data": {"status": "failed"}}
+PENDING = {"status": True, "data": {"status": "pending"}}
+# No definite answer (read timeout, 5xx)
+TRANSIENT = {"status": False, "message": "Paystack verify failed (upstream) after 3 attempt(s)", "transient": True}
+
+def run(coro):
+    return asyncio.run(coro)
+
+def stuck(status: str, reference: str, age: float = 3600, **fields) -> Transaction:
+    """
+    A transaction that has sat in `status` for `age` seconds, past the webhook's window.
+    """
+    at = datetime.utcnow() - timedelta(seconds=age)
+    return Transaction(
+        telegram_chat_id="42", sender_phone="0551234567", recipient_phone="0241234567", amount=50.0,
+        status=status, paystack_reference=reference, created_at=at, updated_at=at, **fields,
+    )
+
+async def add(sessions, *rows):
+    async with sessions() as session:
+        for row in rows:
+            session.add(row)
+        await session.commit()
+
+async def statuses(sessions, *rows) -> list:
+    async with sessions() as session:
+        return [(await session.get(Transaction, row.id)).status for row in rows]
+
+async def jobs(sessions) -> list:
+    async with sessions() as session:
+        return [(job.kind, json.loads(job.payload)["transaction_id"]) for job in (await session.exec(select(Job))).all()]
+
+def answer_by_reference(answers: dict):
+    """
+    Verify answers keyed by the last path segment (charge reference, or trf_<id> for transfers).
+    """
+    return lambda path: answers[path.rsplit("/", 1)[-1]]
+
+def test_charges_settle_from_paystack(db, fake_paystack):
+    paid, declined, waiting = stuck("PENDING_DEBIT", "ref_paid"), stuck("PENDING_DEBIT", "ref_declined"), stuck("WAITING_FOR_OTP", "ref_waiting")
+    run(add(db, paid, declined, waiting))
+    fake_paystack.answers["verify"] = answer_by_reference({"ref_paid": SUCCESS, "ref_declined": FAILED, "ref_waiting": PENDING})
+    reconciler = Reconciler()
+
+    applied = run(reconciler.run_once())
+    assert applied == {"PENDING_DEBIT->PENDING_DISBURSE": 1, "PENDING_DEBIT->DEBIT_FAILED": 1}
+    assert run(statuses(db, paid, declined, waiting)) == ["PENDING_DISBURSE", "DEBIT_FAILED", "WAITING_FOR_OTP"]
+    # Only the paid charge is handed to the disburse worker
+    assert run(jobs(db)) == [("disburse", str(paid.id))]
+    assert reconciler.stats()["unresolved"] == 1
+
+def test_transient_answer_leaves_the_row_alone(db, fake_paystack):
+    txn = stuck("PENDING_DEBIT", "ref_1")
+    run(add(db, txn))
+    fake_paystack.answers["verify"] = TRANSIENT
+    reconciler = Reconciler()
+
+    assert run(reconciler.run_once()) == {}
+    assert run(statuses(db, txn)) == ["PENDING_DEBIT"]
+    assert run(jobs(db)) == []
+    assert reconciler.stats()["verify_errors"] == 1
+    assert reconciler.stats()["unresolved"] == 1
+
+def test_fresh_rows_are_left_to_the_webhook(db, fake_paystack):
+    run(add(db, stuck("PENDING_DEBIT", "ref_1", age=10)))
+    fake_paystack.answers["verify"] = SUCCESS
+    assert run(Reconciler().run_once()) == {}
+    assert not fake_paystack.called("verify")
+
+def test_long_pending_charge_is_abandoned(db, fake_paystack):
+    txn = stuck("PENDING_DEBIT", "ref_1", age=2 * 86400)
+    run(add(db, txn))
+    fake_paystack.answers["verify"] = PENDING
+    assert run(Reconciler().run_once()) == {"PENDING_DEBIT->ABANDONED": 1}
+    assert run(statuses(db, txn)) == ["ABANDONED"]
+
+def test_transfers_settle_from_paystack(db, fake_paystack):
+    sent, bounced = stuck("DISBURSING", "ref_sent"), stuck("DISBURSING", "ref_bounced")
+    run(add(db, sent, bounced))
+    fake_paystack.answers["verify"] = answer_by_reference({f"trf_{sent.id}": SUCCESS, f"trf_{bounced.id}": FAILED})
+
+    applied = run(Reconciler().run_once())
+    assert applied == {"DISBURSING->COMPLETE": 1, "DISBURSING->TRANSFER_FAILED": 1}
+    assert run(statuses(db, sent, bounced)) == ["COMPLETE", "TRANSFER_FAILED"]
+    # The sender's money goes back through the refund worker
+    assert run(jobs(db)) == [("refund", str(bounced.id))]
+
+def test_transient_transfer_answer_leaves_it_disbursing(db, fake_paystack):
+    txn = stuck("DISBURSING", "ref_1")
+    run(add(db, txn))
+    fake_paystack.answers["verify"] = TRANSIENT
+    assert run(Reconciler().run_once()) == {}
+    assert run(statuses(db, txn)) == ["DISBURSING"]
+    assert run(jobs(db)) == []
+
+def test_split_parent_completes_with_its_legs(db, fake_paystack):
+    parent = stuck("DISBURSING", "ref_parent")
+    run(add(db, parent))
+    leg = stuck("DISBURSING", None, parent_id=parent.id)
+    run(add(db, leg))
+    fake_paystack.answers["verify"] = SUCCESS
+
+    applied = run(Reconciler().run_once())
+    # Only the leg has a transfer to verify; the parent rolls up from it
+    assert [call for call in fake_paystack.calls if call[0] == "verify"] == [("verify", f"/transfer/verify/trf_{leg.id}")]
+    assert applied == {"DISBURSING->COMPLETE": 1, "DISBURSING->COMPLETE (split)": 1}
+    assert run(statuses(db, parent, leg)) == ["COMPLETE", "COMPLETE"]
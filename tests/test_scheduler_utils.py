@@ -0,0 +1,115 @@
+import time
+import asyncio
+
+from scheduler_utils import OutboundScheduler, RetryAfter, TokenBucket, HIGH, NORMAL
+
+def make_scheduler(send, **kwargs):
+    options = {"global_rate": 1000, "key_rate": 1000, "key_burst": 1000, "max_retries": 3}
+    options.update(kwargs)
+    return OutboundScheduler(send, **options)
+
+def test_token_bucket_wait_time():
+    bucket = TokenBucket(rate=2, capacity=1)
+    now = bucket.updated
+    assert bucket.wait_time(now) == 0.0
+    bucket.take(now)
+    assert bucket.wait_time(now) == 0.5
+    assert bucket.wait_time(now + 0.5) == 0.0
+
+def test_429_requeues_item_after_retry_after():
+    calls = []
+
+    async def send(key, text):
+        calls.append((key, text, time.monotonic()))
+        if key == "a" and len([c for c in calls if c[0] == "a"]) == 1:
+            raise RetryAfter(0.2, {"ok": False, "error_code": 429})
+        return {"ok": True, "text": text}
+
+    async def scenario():
+        scheduler = make_scheduler(send)
+        started = time.monotonic()
+        try:
+            first = scheduler.submit("a", "a", "one")
+            other = scheduler.submit("b", "b", "two")
+            assert await other == {"ok": True, "text": "two"}
+            # Only chat "a" is held back by its 429
+            assert time.monotonic() - started < 0.2
+            assert await first == {"ok": True, "text": "one"}
+            return scheduler.stats(), time.monotonic() - started
+        finally:
+            await scheduler.stop()
+
+    stats, elapsed = asyncio.run(scenario())
+    assert elapsed >= 0.2
+    assert [c[:2] for c in calls] == [("a", "one"), ("b", "two"), ("a", "one")]
+    assert calls[2][2] - calls[0][2] >= 0.2
+    assert stats["rate_limited"] == 1
+    assert stats["retries"] == 1
+    assert stats["sent"] == 2
+    assert stats["depth"] == 0
+
+def test_429_keeps_a_chats_messages_in_order():
+    sent = []
+    limited = {"done": False}
+
+    async def send(key, text):
+        if text == "first" and not limited["done"]:
+            limited["done"] = True
+            raise RetryAfter(0.1)
+        sent.append(text)
+        return text
+
+    async def scenario():
+        scheduler = make_scheduler(send)
+        try:
+            futures = [scheduler.submit("a", "a", text) for text in ("first", "second", "third")]
+            return await asyncio.gather(*futures)
+        finally:
+            await scheduler.stop()
+
+    assert asyncio.run(scenario()) == ["first", "second", "third"]
+    assert sent == ["first", "second", "third"]
+
+def test_429_gives_up_after_max_retries():
+    attempts = []
+
+    async def send(key, text):
+        attempts.append(text)
+        raise RetryAfter(0.01, {"ok": False, "error_code": 429})
+
+    async def scenario():
+        scheduler = make_scheduler(send, max_retries=2)
+        try:
+            result = await scheduler.submit("a", "a", "hello", priority=HIGH)
+            return result, scheduler.stats()
+        finally:
+            await scheduler.stop()
+
+    result, stats = asyncio.run(scenario())
+    assert result == {"ok": False, "error_code": 429}
+    assert len(attempts) == 3
+    assert stats["dropped"] == 1
+
+def test_429_on_unlimited_call_pauses_every_key():
+    calls = []
+
+    async def send(key, text):
+        calls.append((key, time.monotonic()))
+        if len(calls) == 1:
+            raise RetryAfter(0.2)
+        return text
+
+    async def scenario():
+        scheduler = make_scheduler(send)
+        try:
+            first = scheduler.submit("cb:1", "cb:1", "answer", limited=False)
+            await asyncio.sleep(0.05)
+            started = time.monotonic()
+            other = await scheduler.submit("b", "b", "text", priority=NORMAL)
+            return await first, other, time.monotonic() - started
+        finally:
+            await scheduler.stop()
+
+    first, other, waited = asyncio.run(scenario())
+    assert (first, other) == ("answer", "text")
+    assert waited >= 0.1
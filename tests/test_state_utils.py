@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+import state_utils
+from models import User
+from state_utils import ConversationStore, MemoryStateBackend, NoStateBackend, StateBackend, default_backend
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_backend_must_implement_get_set_delete():
+    class Partial(StateBackend):
+        async def get(self, chat_id):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()
+
+@pytest.mark.parametrize("processes, backend", [(1, MemoryStateBackend), (4, NoStateBackend)])
+def test_cache_is_only_used_by_a_single_process(monkeypatch, processes, backend):
+    monkeypatch.setattr(state_utils, "WEB_CONCURRENCY", processes)
+    assert isinstance(default_backend(), backend)
+
+def test_without_cache_every_process_reads_the_latest_state(db):
+    async def scenario():
+        async with db() as session:
+            session.add(User(telegram_id="42", phone_number="0551234567"))
+            await session.commit()
+        first, second = ConversationStore(NoStateBackend()), ConversationStore(NoStateBackend())
+        async with db() as session:
+            assert (await second.get(session, "42")).name == "IDLE"
+            await first.set(session, "42", "AWAITING_PIN_AUTH")
+        async with db() as session:
+            return (await second.get(session, "42")).name
+
+    assert run(scenario()) == "AWAITING_PIN_AUTH"
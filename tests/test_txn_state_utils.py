@@ -0,0 +1,97 @@
+import asyncio
+import uuid
+
+import pytest
+
+from txn_state_utils import (
+    TRANSITIONS, InvalidTransition, can_transition, set_status, sources, transition, transition_many,
+)
+from models import Transaction
+
+pytest.importorskip("aiosqlite")
+
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+def test_every_target_is_a_known_status():
+    known = set(TRANSITIONS)
+    for current, targets in TRANSITIONS.items():
+        assert targets <= known, current
+
+def test_failed_transfer_cannot_be_reset():
+    assert not can_transition("TRANSFER_FAILED", "INIT")
+    assert "TRANSFER_FAILED" not in sources("INIT")
+
+def test_set_status_rejects_invalid_transition():
+    txn = Transaction(sender_phone="0551234567", recipient_phone="0241234567", amount=10, status="COMPLETE")
+    with pytest.raises(InvalidTransition):
+        set_status(txn, "PENDING_DISBURSE")
+    assert txn.status == "COMPLETE"
+
+    set_status(txn, "TRANSFER_FAILED")
+    assert txn.status == "TRANSFER_FAILED"
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'txn.sqlite'}")
+
+    async def setup():
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+
+    asyncio.run(setup())
+    yield async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    asyncio.run(engine.dispose())
+
+async def _insert(sessions, status: str) -> uuid.UUID:
+    async with sessions() as session:
+        txn = Transaction(sender_phone="0551234567", recipient_phone="0241234567", amount=10, status=status)
+        session.add(txn)
+        await session.commit()
+        return txn.id
+
+async def _status(sessions, txn_id) -> str:
+    async with sessions() as session:
+        return (await session.get(Transaction, txn_id)).status
+
+def test_transition_cas_rejects_lost_race(db):
+    async def scenario():
+        txn_id = await _insert(db, "PENDING_DEBIT")
+        # Two deliveries of charge.success, each in its own session
+        async with db() as first, db() as second:
+            won = await transition(first, txn_id, "PENDING_DISBURSE")
+            await first.commit()
+            lost = await transition(second, txn_id, "PENDING_DISBURSE")
+            await second.commit()
+        return won, lost, await _status(db, txn_id)
+
+    assert asyncio.run(scenario()) == (True, False, "PENDING_DISBURSE")
+
+def test_transition_respects_expected_statuses(db):
+    async def scenario():
+        txn_id = await _insert(db, "PENDING_DEBIT")
+        async with db() as session:
+            # A webhook already moved the row past WAITING_FOR_OTP
+            moved = await transition(session, txn_id, "DEBIT_SUCCESS", expected=("WAITING_FOR_OTP",))
+            await session.commit()
+        return moved, await _status(db, txn_id)
+
+    assert asyncio.run(scenario()) == (False, "PENDING_DEBIT")
+
+def test_transition_many_returns_only_rows_it_moved(db):
+    async def scenario():
+        stuck = await _insert(db, "PENDING_DEBIT")
+        paid = await _insert(db, "PENDING_DISBURSE")
+        async with db() as session:
+            moved = await transition_many(session, [stuck, paid], "PENDING_DEBIT", "ABANDONED")
+            await session.commit()
+        return moved, stuck, await _status(db, stuck), await _status(db, paid)
+
+    moved, stuck, stuck_status, paid_status = asyncio.run(scenario())
+    assert moved == [stuck]
+    assert (stuck_status, paid_status) == ("ABANDONED", "PENDING_DISBURSE")
+
+def test_transition_many_rejects_invalid_edge(db):
+    with pytest.raises(InvalidTransition):
+        asyncio.run(transition_many(None, [uuid.uuid4()], "COMPLETE", "INIT"))
@@ -0,0 +1,154 @@
+"""
+Transaction status state machine.
+
+Every status change goes through this module:
+- transition() / transition_many(): compare-and-set UPDATEs, for code that
+  has not locked the row (webhooks, the reconciler). Only one of several
+  concurrent callers wins; the rest get False / fewer ids back.
+- lock_transaction() + set_status(): for the background jobs that move a row
+  through several steps around Paystack calls. The row stays locked
+  (SELECT ... FOR UPDATE) until the job commits, so a webhook's CAS UPDATE
+  waits for the job and then sees its final status.
+"""
+import os
+from datetime import datetime
+from sqlmodel import select
+from sqlalchemy import update, exists, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import aliased
+from dotenv import load_dotenv
+
+from models import Transaction
+from job_queue import RetryLater
+
+load_dotenv()
+
+# How long a job waits for a row another worker (or a webhook) holds before it is rescheduled
+TXN_LOCK_TIMEOUT_MS = int(os.getenv("TXN_LOCK_TIMEOUT_MS", "3000"))
+TXN_LOCK_RETRY_DELAY = float(os.getenv("TXN_LOCK_RETRY_DELAY", "2"))
+_LOCK_NOT_AVAILABLE = "55P03"  # Postgres SQLSTATE for lock_timeout / NOWAIT
+
+# status -> statuses it may move to
+TRANSITIONS = {
+    # Split legs are created as INIT and only move once the parent is paid
+    "INIT": {"DISBURSING", "TRANSFER_FAILED", "RECIPIENT_FAIL"},
+    "WAITING_FOR_OTP": {"DEBIT_SUCCESS", "PENDING_DISBURSE", "DEBIT_FAILED", "ABANDONED"},
+    # Saved as PENDING_DEBIT before the charge call; Paystack may then ask for an OTP
+    "PENDING_DEBIT": {"WAITING_FOR_OTP", "PENDING_DISBURSE", "DEBIT_FAILED", "ABANDONED"},
+    "DEBIT_SUCCESS": {"PENDING_DISBURSE", "DEBIT_FAILED", "ABANDONED"},
+    # A charge.success that arrives after we gave up still gets paid out
+    "DEBIT_FAILED": {"PENDING_DISBURSE"},
+    "ABANDONED": {"PENDING_DISBURSE"},
+    "PENDING_DISBURSE": {"DISBURSING", "TRANSFER_FAILED", "RECIPIENT_FAIL", "PARTIAL_REFUND", "REFUNDED", "REFUND_FAILED"},
+    "DISBURSING": {"COMPLETE", "TRANSFER_FAILED", "PARTIAL_REFUND"},
+    # transfer.reversed can follow transfer.success
+    "COMPLETE": {"TRANSFER_FAILED", "PARTIAL_REFUND"},
+    "TRANSFER_FAILED": {"REFUNDED", "REFUND_FAILED"},
+    "RECIPIENT_FAIL": {"REFUNDED", "REFUND_FAILED"},
+    "REFUNDED": {"REFUND_FAILED"},
+    # Every leg of a split refunded, one by one
+    "PARTIAL_REFUND": {"REFUNDED", "REFUND_FAILED"},
+    "REFUND_FAILED": {"REFUNDED"},
+}
+
+class InvalidTransition(Exception):
+    def __init__(self, current: str, target: str):
+        super().__init__(f"Transaction cannot move from {current} to {target}")
+        self.current = current
+        self.target = target
+
+def can_transition(current: str, target: str) -> bool:
+    return target in TRANSITIONS.get(current, ())
+
+def sources(target: str) -> set:
+    """
+    Every status that may move to `target`.
+    """
+    return {status for status, targets in TRANSITIONS.items() if target in targets}
+
+def set_status(txn: Transaction, target: str, now: datetime = None):
+    """
+    Moves a row the caller has locked (see lock_transaction). Raises InvalidTransition.
+    """
+    if txn.status == target:
+        return
+    if not can_transition(txn.status, target):
+        raise InvalidTransition(txn.status, target)
+    txn.status = target
+    txn.updated_at = now or datetime.utcnow()
+
+async def _set_lock_timeout(session):
+    # Postgres: lock waits in this transaction give up after TXN_LOCK_TIMEOUT_MS
+    if session.get_bind().dialect.name == "postgresql":
+        await session.execute(text(f"SET LOCAL lock_timeout = '{TXN_LOCK_TIMEOUT_MS}ms'"))
+
+async def _locked(session, statement):
+    """
+    Runs a SELECT ... FOR UPDATE. A row still held after TXN_LOCK_TIMEOUT_MS
+    raises RetryLater, so the job queue reschedules without counting an attempt.
+    """
+    await _set_lock_timeout(session)
+    try:
+        return await session.exec(statement.execution_options(populate_existing=True))
+    except DBAPIError as e:
+        if getattr(e.orig, "pgcode", None) == _LOCK_NOT_AVAILABLE:
+            raise RetryLater("Transaction row is locked by another worker", delay=TXN_LOCK_RETRY_DELAY) from e
+        raise
+
+async def lock_transaction(session, txn_id):
+    """
+    Loads a Transaction with SELECT ... FOR UPDATE, held until the session commits.
+    Waits up to TXN_LOCK_TIMEOUT_MS for a webhook or sibling job holding the row.
+    """
+    statement = select(Transaction).where(Transaction.id == txn_id).with_for_update()
+    return (await _locked(session, statement)).first()
+
+async def lock_legs(session, parent_id) -> list:
+    statement = select(Transaction).where(Transaction.parent_id == parent_id).order_by(Transaction.id).with_for_update()
+    return (await _locked(session, statement)).all()
+
+async def transition(session, txn_id, target: str, expected: tuple = None, **values) -> bool:
+    """
+    Compare-and-set: moves the row to `target` only if its current status may
+    (and is one of `expected`, when given). Returns whether this call moved it.
+    Does not commit.
+    """
+    allowed = sources(target)
+    if expected is not None:
+        allowed &= set(expected)
+    result = await session.execute(
+        update(Transaction)
+        .where(Transaction.id == txn_id, Transaction.status.in_(allowed))
+        .values(status=target, updated_at=datetime.utcnow(), **values)
+    )
+    return result.rowcount == 1
+
+async def transition_many(session, txn_ids: list, current: str, target: str) -> list:
+    """
+    Bulk compare-and-set from one status. Returns the ids that moved. Does not commit.
+    """
+    if not can_transition(current, target):
+        raise InvalidTransition(current, target)
+    result = await session.execute(
+        update(Transaction)
+        .where(Transaction.id.in_(txn_ids), Transaction.status == current)
+        .values(status=target, updated_at=datetime.utcnow())
+        .returning(Transaction.id)
+    )
+    return list(result.scalars().all())
+
+async def complete_split_parents(session, parent_ids: list = None) -> int:
+    """
+    Marks split parents still DISBURSING as COMPLETE once every leg is COMPLETE
+    (all of them, or just `parent_ids`). Does not commit.
+    """
+    leg = aliased(Transaction)
+    statement = update(Transaction).where(
+        Transaction.status == "DISBURSING",
+        exists().where(leg.parent_id == Transaction.id),
+        ~exists().where(leg.parent_id == Transaction.id, leg.status != "COMPLETE"),
+    )
+    if parent_ids is not None:
+        statement = statement.where(Transaction.id.in_(parent_ids))
+    result = await session.execute(statement.values(status="COMPLETE", updated_at=datetime.utcnow()))
+    return result.rowcount or 0